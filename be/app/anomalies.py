@@ -0,0 +1,318 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import ReplaceOne, UpdateOne
+
+from app import background, watchers
+from app.watermarks import STATE_COLLECTION, get_state, set_watermark
+
+MODELS = "timer_cycle_stats"
+ANOMALIES = "timer_anomalies"
+STATE_NAME = "anomalies"
+
+# 0.6745 = Phi^-1(0.75): makes MAD-based scores comparable to z-scores for normal data
+_MAD_SCALE = 0.6745
+
+_FIELDS = {"timerId": 1, "locationId": 1, "stopReason": 1, "createdAt": 1, "endedAt": 1}
+
+_BULK = 1000
+
+_lock = asyncio.Lock()
+_models: Optional[Dict[Any, "CycleModel"]] = None
+_wake = asyncio.Event()
+
+
+def refresh_interval() -> float:
+    return float(os.getenv("ANOMALY_REFRESH_SECONDS", "60"))
+
+
+def _lag_seconds() -> float:
+    return float(os.getenv("ANOMALY_LAG_SECONDS", "5"))
+
+
+def min_samples() -> int:
+    """Cycles a timer needs before its cycles are scored."""
+    return int(os.getenv("ANOMALY_MIN_SAMPLES", "30"))
+
+
+def store_threshold() -> float:
+    """Smallest |score| kept in ``ANOMALIES``; lower thresholds are answered from timerlogs."""
+    return float(os.getenv("ANOMALY_STORE_THRESHOLD", "2"))
+
+
+def robust_enabled() -> bool:
+    return os.getenv("ANOMALY_ROBUST", "1").lower() not in ("0", "false", "no")
+
+
+def _gamma() -> float:
+    # Relative accuracy of the median/MAD sketch (default 2%)
+    return 1 + 2 * float(os.getenv("ANOMALY_SKETCH_ACCURACY", "0.02"))
+
+
+class CycleModel:
+    """Running mean/variance of one timer's cycle durations (Welford), plus
+    a log-bucket histogram for an approximate median and MAD.
+
+    The persisted form is a plain document; ``through`` is the ``endedAt``
+    bound of the last batch folded in, so a batch replayed after a crash
+    is not counted twice.
+    """
+
+    def __init__(self, doc: Optional[Dict[str, Any]] = None):
+        doc = doc or {}
+        self.n: int = doc.get("n", 0)
+        self.mean: float = doc.get("mean", 0.0)
+        self.m2: float = doc.get("m2", 0.0)
+        self.buckets: Dict[str, int] = dict(doc.get("buckets", {}))
+        self.through: Optional[datetime] = doc.get("through")
+        self.location = doc.get("locationId")
+        self._robust: Optional[tuple] = None
+        self._robust_n = -1
+
+    @property
+    def std(self) -> float:
+        return math.sqrt(self.m2 / self.n) if self.n else 0.0
+
+    def add(self, x: float) -> None:
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+        if robust_enabled():
+            key = str(self._bucket(x))
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+
+    @staticmethod
+    def _bucket(x: float) -> int:
+        return math.ceil(math.log(x) / math.log(_gamma())) if x > 1 else 0
+
+    @staticmethod
+    def _value(bucket: int) -> float:
+        if bucket <= 0:
+            return 0.0
+        g = _gamma()
+        return 2 * g ** bucket / (g + 1)  # midpoint of (g^(b-1), g^b] in relative terms
+
+    def _quantile(self, pairs: List[tuple], total: int) -> float:
+        rank = 0
+        for value, count in pairs:
+            rank += count
+            if rank * 2 >= total:
+                return value
+        return pairs[-1][0] if pairs else 0.0
+
+    def median_mad(self) -> Optional[tuple]:
+        """(median, MAD) from the sketch, recomputed at most every 64 cycles."""
+        total = sum(self.buckets.values())
+        if not total:
+            return None
+        if self._robust is None or self.n - self._robust_n >= 64:
+            values = sorted((self._value(int(b)), c) for b, c in self.buckets.items())
+            median = self._quantile(values, total)
+            deviations = sorted((abs(v - median), c) for v, c in values)
+            self._robust = (median, self._quantile(deviations, total))
+            self._robust_n = self.n
+        return self._robust
+
+    def score(self, x: float) -> Optional[Dict[str, Any]]:
+        """Scores of ``x`` against the cycles seen so far, or None while warming up."""
+        if self.n < min_samples():
+            return None
+        std = self.std
+        z = (x - self.mean) / std if std > 0 else 0.0
+        out = {"zScore": z, "absZ": abs(z), "mean": self.mean, "std": std}
+        robust = self.median_mad() if robust_enabled() else None
+        if robust and robust[1] > 0:
+            rz = _MAD_SCALE * (x - robust[0]) / robust[1]
+            out.update({"robustZ": rz, "absRobustZ": abs(rz), "median": robust[0], "mad": robust[1]})
+        return out
+
+    def to_doc(self) -> Dict[str, Any]:
+        return {
+            "n": self.n,
+            "mean": self.mean,
+            "m2": self.m2,
+            "std": self.std,
+            "buckets": self.buckets,
+            "through": self.through,
+            "locationId": self.location,
+        }
+
+
+async def _load_models(db: AsyncIOMotorDatabase) -> Dict[Any, CycleModel]:
+    global _models
+    if _models is None:
+        _models = {doc["_id"]: CycleModel(doc) async for doc in db[MODELS].find({})}
+    return _models
+
+
+async def score_new_cycles(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    """Score timerlogs that ended since the last run, then fold them into their timer's model.
+
+    Progress is an ``endedAt`` high-water mark, so each log is scored once,
+    when it completes. Each cycle is scored against the model as it was
+    before that cycle.
+    """
+    global _models
+    async with _lock:
+        try:
+            return await _score(db, await _load_models(db))
+        except BaseException:
+            _models = None  # drop in-memory updates that were not persisted
+            raise
+
+
+async def _score(db: AsyncIOMotorDatabase, models: Dict[Any, CycleModel]) -> Dict[str, Any]:
+    low = (await get_state(db, STATE_NAME) or {}).get("watermark")
+    high = datetime.utcnow() - timedelta(seconds=_lag_seconds())
+    if low is not None and low >= high:
+        return {"watermark": low.isoformat(), "skipped": True}
+    ended: Dict[str, Any] = {"$lt": high}
+    if low is not None:
+        ended["$gte"] = low
+
+    touched = set()
+    anomalies: List[UpdateOne] = []
+    found = cycles = 0
+    threshold = store_threshold()
+    cursor = db.timerlogs.find({"endedAt": ended}, _FIELDS).sort("endedAt", 1)
+    async for doc in cursor:
+        created, end = doc.get("createdAt"), doc["endedAt"]
+        if not isinstance(created, datetime) or end < created:
+            continue
+        model = models.setdefault(doc.get("timerId"), CycleModel())
+        if model.through is not None and end < model.through:
+            continue  # already folded in by an interrupted run
+        x = (end - created).total_seconds() * 1000
+        scores = model.score(x)
+        if scores and max(scores["absZ"], scores.get("absRobustZ", 0)) >= threshold:
+            anomalies.append(UpdateOne({"_id": doc["_id"]}, {"$set": {
+                "timerId": doc.get("timerId"),
+                "locationId": doc.get("locationId"),
+                "time": created,
+                "duration": x,
+                "reason": doc.get("stopReason"),
+                **scores,
+            }}, upsert=True))
+            if len(anomalies) >= _BULK:
+                await db[ANOMALIES].bulk_write(anomalies, ordered=False)
+                found += len(anomalies)
+                anomalies = []
+        model.add(x)
+        model.location = doc.get("locationId", model.location)
+        touched.add(doc.get("timerId"))
+        cycles += 1
+
+    if anomalies:
+        await db[ANOMALIES].bulk_write(anomalies, ordered=False)
+        found += len(anomalies)
+    if touched:
+        for timer_id in touched:
+            models[timer_id].through = high
+        await db[MODELS].bulk_write(
+            [ReplaceOne({"_id": t}, models[t].to_doc(), upsert=True) for t in touched], ordered=False
+        )
+    await set_watermark(db, STATE_NAME, high)
+    return {"watermark": high.isoformat(), "cycles": cycles, "timers": len(touched), "anomalies": found}
+
+
+def _on_timerlog(event: watchers.Event) -> None:
+    if event["doc"] and event["doc"].get("endedAt") is not None:
+        _wake.set()
+
+
+async def _refresh(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    await ensure_anomaly_indexes(db)
+    return await score_new_cycles(db)
+
+
+def start(db: AsyncIOMotorDatabase) -> None:
+    """Score every ``ANOMALY_REFRESH_SECONDS``, or as soon as the watcher sees a log end."""
+    if watchers.watchers_enabled():
+        watchers.subscribe("timerlogs", _on_timerlog)
+    background.start_periodic("anomalies", refresh_interval(), lambda: _refresh(db), wake=_wake)
+
+
+async def ready(db: AsyncIOMotorDatabase) -> bool:
+    return await get_state(db, STATE_NAME) is not None
+
+
+async def find_anomalies(
+    db: AsyncIOMotorDatabase,
+    threshold: float,
+    method: str = "zscore",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    location_id: Optional[str] = None,
+    limit: int = 50,
+) -> List[Dict[str, Any]]:
+    """Most recent stored anomalies scoring at least ``threshold``."""
+    field = "absRobustZ" if method == "robust" else "absZ"
+    query: Dict[str, Any] = {field: {"$gt": threshold}}
+    if start is not None and end is not None:
+        query["time"] = {"$gte": start, "$lte": end}
+    if location_id:
+        query["locationId"] = location_id
+    return await db[ANOMALIES].find(query).sort("time", -1).limit(limit).to_list(limit)
+
+
+def raw_pipeline(match: Dict[str, Any], threshold: float, limit: int = 50) -> List[Dict[str, Any]]:
+    """Window z-scores straight from timerlogs, per timer over the matched logs.
+
+    ``$setWindowFields`` keeps one document per log instead of pushing a
+    timer's cycles into a single array.
+    """
+    return [
+        {"$match": {**match, "endedAt": {"$type": "date"}, "createdAt": {"$type": "date"}}},
+        {"$project": {
+            "timerId": 1,
+            "time": "$createdAt",
+            "reason": "$stopReason",
+            "duration": {"$subtract": ["$endedAt", "$createdAt"]},
+        }},
+        {"$setWindowFields": {
+            "partitionBy": "$timerId",
+            "output": {"mean": {"$avg": "$duration"}, "std": {"$stdDevPop": "$duration"}},
+        }},
+        {"$addFields": {"zScore": {"$cond": [
+            {"$gt": ["$std", 0]},
+            {"$divide": [{"$subtract": ["$duration", "$mean"]}, "$std"]},
+            0,
+        ]}}},
+        {"$match": {"$or": [{"zScore": {"$gt": threshold}}, {"zScore": {"$lt": -threshold}}]}},
+        {"$sort": {"time": -1}},
+        {"$limit": limit},
+    ]
+
+
+async def ensure_anomaly_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db[ANOMALIES].create_index([("time", -1)])
+    await db[ANOMALIES].create_index([("locationId", 1), ("time", -1)])
+
+
+async def _main():
+    from app.db import get_db, close_db
+
+    parser = argparse.ArgumentParser(description="Score completed timerlog cycles for anomalies")
+    parser.add_argument("--reset", action="store_true", help="drop the models and anomalies and rescore from scratch")
+    args = parser.parse_args()
+
+    db = get_db()
+    if args.reset:
+        await db[MODELS].drop()
+        await db[ANOMALIES].drop()
+        await db[STATE_COLLECTION].delete_one({"_id": STATE_NAME})
+    await ensure_anomaly_indexes(db)
+    print(await score_new_cycles(db))
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
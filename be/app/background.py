@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+_tasks: List[asyncio.Task] = []
+last_runs: Dict[str, Dict[str, object]] = {}
+
+
+async def _loop(name: str, interval: float, fn: Callable[[], Awaitable[object]], wake: Optional[asyncio.Event]):
+    while True:
+        try:
+            result = await fn()
+            last_runs[name] = {"ok": True, "result": result}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("background task %s failed: %s", name, e)
+            last_runs[name] = {"ok": False, "error": str(e)}
+        if wake is None:
+            await asyncio.sleep(interval)
+            continue
+        try:
+            await asyncio.wait_for(wake.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+
+def start_periodic(
+    name: str,
+    interval: float,
+    fn: Callable[[], Awaitable[object]],
+    wake: Optional[asyncio.Event] = None,
+) -> None:
+    """Run ``fn`` now and then every ``interval`` seconds until shutdown;
+    setting ``wake`` runs it early."""
+    if interval <= 0:
+        return
+    _tasks.append(asyncio.create_task(_loop(name, interval, fn, wake), name=name))
+
+
+async def _once(name: str, coro: Awaitable[object]):
+    try:
+        last_runs[name] = {"ok": True, "result": await coro}
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.warning("background task %s failed: %s", name, e)
+        last_runs[name] = {"ok": False, "error": str(e)}
+
+
+def start(name: str, coro: Awaitable[object]) -> None:
+    """Run ``coro`` once in the background; its outcome lands in ``last_runs``."""
+    _tasks.append(asyncio.create_task(_once(name, coro), name=name))
+
+
+def spawn(name: str, coro: Awaitable[object]) -> asyncio.Task:
+    """Run ``coro`` as a task that is cancelled at shutdown, for tasks started
+    on demand (finished ones are forgotten)."""
+    _tasks[:] = [t for t in _tasks if not t.done()]
+    task = asyncio.create_task(coro, name=name)
+    _tasks.append(task)
+    return task
+
+
+async def stop_all() -> None:
+    for t in _tasks:
+        t.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
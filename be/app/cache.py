@@ -0,0 +1,305 @@
+from __future__ import annotations
+
+import functools
+import inspect
+import os
+import time
+from collections import OrderedDict
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from urllib.parse import urlencode
+
+from bson import json_util
+from starlette.responses import Response
+
+_MISS = object()
+
+
+class LRUCache:
+    """Bounded in-process cache; entries expire after their TTL."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.evictions = 0
+
+    async def get(self, key: str) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return _MISS
+        expires_at, value = item
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            return _MISS
+        self._data.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    async def ttl(self, key: str) -> Optional[float]:
+        """Seconds until ``key`` expires, or None when it is not cached."""
+        item = self._data.get(key)
+        if item is None:
+            return None
+        left = item[0] - time.monotonic()
+        return left if left > 0 else None
+
+    async def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    async def clear(self) -> None:
+        self._data.clear()
+
+    def size(self) -> int:
+        return len(self._data)
+
+
+class RedisCache:
+    """Backend for any redis-compatible async client (``redis.asyncio`` or a fake).
+
+    The client needs ``get``, ``set(name, value, ex=...)``, ``ttl``, ``delete``
+    and ``scan_iter(match=...)``. Values are stored as extended JSON so ObjectId
+    and datetime survive the round trip.
+    """
+
+    def __init__(self, client: Any, prefix: str = "apms:cache:"):
+        self.client = client
+        self.prefix = prefix
+        self.evictions = 0
+
+    async def get(self, key: str) -> Any:
+        raw = await self.client.get(self.prefix + key)
+        if raw is None:
+            return _MISS
+        return json_util.loads(raw)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        await self.client.set(self.prefix + key, json_util.dumps(value), ex=max(1, int(ttl)))
+
+    async def ttl(self, key: str) -> Optional[float]:
+        left = await self.client.ttl(self.prefix + key)
+        return float(left) if left and left > 0 else None
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(self.prefix + key)
+
+    async def clear(self) -> None:
+        async for k in self.client.scan_iter(match=self.prefix + "*"):
+            await self.client.delete(k)
+
+    def size(self) -> Optional[int]:
+        return None
+
+
+def _backend_from_env():
+    url = os.getenv("CACHE_REDIS_URL")
+    if url:
+        import redis.asyncio as redis
+
+        return RedisCache(redis.from_url(url))
+    return LRUCache(int(os.getenv("CACHE_MAX_ENTRIES", "1024")))
+
+
+_backend: Any = None
+_stats: Dict[str, Dict[str, int]] = {}
+
+# Installed per request by the HTTP layer: route -> (seconds left, key) of every cached()
+# call that produced a cacheable result, so encoded response bytes can be cached alongside
+# without outliving it
+response_marks: ContextVar[Optional[Dict[str, Tuple[float, str]]]] = ContextVar("cache_response_marks", default=None)
+
+# What each cached key was computed from, for targeted invalidation:
+# key -> (collections, locationId, window start, window end, expires at)
+_Tag = Tuple[Tuple[str, ...], Optional[str], Optional[datetime], Optional[datetime], float]
+_tags: Dict[str, _Tag] = {}
+_invalidations: Dict[str, int] = {}
+
+_LOCATION_PARAMS = ("location_id",)
+_WINDOW_PARAMS = (("start_date", "end_date"), ("from_ts", "to_ts"))
+
+
+def _mark(route: str, ttl: float, key: str) -> None:
+    marks = response_marks.get()
+    if marks is not None:
+        marks[route] = (ttl, key)
+
+
+def get_cache():
+    global _backend
+    if _backend is None:
+        _backend = _backend_from_env()
+    return _backend
+
+
+def set_cache(backend: Any) -> None:
+    global _backend
+    _backend = backend
+
+
+def cache_enabled() -> bool:
+    return os.getenv("CACHE_ENABLED", "1").lower() not in ("0", "false", "no")
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def cache_key(route: str, params: Dict[str, Any]) -> str:
+    """Route name plus query params sorted by name, ignoring unset ones."""
+    items = sorted(
+        (k, str(_normalize(v))) for k, v in params.items() if v is not None and v != ""
+    )
+    return f"{route}?{urlencode(items)}"
+
+
+def _bound(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        dt = value if isinstance(value, datetime) else datetime.fromisoformat(str(value).strip())
+    except ValueError:
+        return None
+    # timerlogs dates come back naive UTC
+    return dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt
+
+
+def _sweep() -> None:
+    now = time.monotonic()
+    for key in [k for k, tag in _tags.items() if tag[4] <= now]:
+        del _tags[key]
+
+
+def _tag(key: str, collections: Tuple[str, ...], params: Dict[str, Any], ttl: float) -> None:
+    location = next((str(params[p]) for p in _LOCATION_PARAMS if params.get(p)), None)
+    start = end = None
+    for lo, hi in _WINDOW_PARAMS:
+        if params.get(lo) or params.get(hi):
+            start, end = _bound(params.get(lo)), _bound(params.get(hi))
+            break
+    if len(_tags) >= 4 * int(os.getenv("CACHE_MAX_ENTRIES", "1024")):
+        _sweep()
+    _tags[key] = (collections, location, start, end, time.monotonic() + ttl)
+
+
+def link(key: str, dependent: str) -> None:
+    """Give ``dependent`` (e.g. the encoded response bytes) the tags and expiry
+    of ``key``, so ``invalidate`` drops both."""
+    tag = _tags.get(key)
+    if tag is not None:
+        _tags[dependent] = tag
+
+
+def _affected(tag: _Tag, collection: str, location: Optional[str], day: Optional[datetime]) -> bool:
+    collections, loc, start, end, _ = tag
+    if collection not in collections:
+        return False
+    if location is not None and loc is not None and loc != location:
+        return False
+    if day is not None:
+        # Open (relative) windows always include today
+        if end is not None and end < day:
+            return False
+        if start is not None and start >= day + timedelta(days=1):
+            return False
+    return True
+
+
+async def invalidate(changes: Iterable[Tuple[str, Optional[str], Optional[datetime]]]) -> int:
+    """Drop cached entries computed from data that changed.
+
+    ``changes`` are ``(collection, locationId, day)`` triples; a None
+    location or day matches every entry of that collection. Only entries
+    from ``cached(collections=...)`` routes are tracked, the rest expire
+    with their TTL.
+    """
+    changes = {(c, str(loc) if loc is not None else None, day) for c, loc, day in changes}
+    if not changes:
+        return 0
+    backend = get_cache()
+    now = time.monotonic()
+    dropped = 0
+    for key, tag in list(_tags.items()):
+        if tag[4] <= now:
+            del _tags[key]
+            continue
+        hit = next((c for c, loc, day in changes if _affected(tag, c, loc, day)), None)
+        if hit is not None:
+            await backend.delete(key)
+            del _tags[key]
+            _invalidations[hit] = _invalidations.get(hit, 0) + 1
+            dropped += 1
+    return dropped
+
+
+def cache_stats() -> Dict[str, Any]:
+    backend = get_cache()
+    hits = sum(s["hits"] for s in _stats.values())
+    misses = sum(s["misses"] for s in _stats.values())
+    return {
+        "backend": type(backend).__name__,
+        "enabled": cache_enabled(),
+        "entries": backend.size(),
+        "evictions": backend.evictions,
+        "hits": hits,
+        "misses": misses,
+        "hitRatio": round(hits / (hits + misses), 4) if hits + misses else 0,
+        "tracked": len(_tags),
+        "invalidations": _invalidations,
+        "routes": _stats,
+    }
+
+
+def cached(ttl: Optional[float] = None, collections: Tuple[str, ...] = ()):
+    """Cache an async endpoint's result, keyed on route and normalized query params.
+
+    Results carrying an ``error`` key and ``Response`` objects (streams)
+    are never stored. ``collections`` names the collections the result is
+    computed from; such entries are dropped by ``invalidate`` when those
+    change for their ``location_id`` and date window.
+    """
+
+    def decorator(fn: Callable):
+        route = f"{fn.__module__.rsplit('.', 1)[-1]}.{fn.__name__}"
+        sig = inspect.signature(fn)
+        route_ttl = ttl if ttl is not None else float(os.getenv("CACHE_DEFAULT_TTL", "60"))
+        stats = _stats.setdefault(route, {"hits": 0, "misses": 0})
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            if not cache_enabled():
+                return await fn(*args, **kwargs)
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = cache_key(route, bound.arguments)
+            backend = get_cache()
+            value = await backend.get(key)
+            if value is not _MISS:
+                stats["hits"] += 1
+                if response_marks.get() is not None:
+                    left = await backend.ttl(key)
+                    if left:
+                        _mark(route, left, key)
+                return value
+            stats["misses"] += 1
+            value = await fn(*args, **kwargs)
+            if not (isinstance(value, Response) or (isinstance(value, dict) and "error" in value)):
+                await backend.set(key, value, route_ttl)
+                if collections:
+                    _tag(key, tuple(collections), bound.arguments, route_ttl)
+                _mark(route, route_ttl, key)
+            return value
+
+        wrapper.cache_route = route
+        wrapper.cache_ttl = route_ttl
+        wrapper.cache_collections = tuple(collections)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import io
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+try:  # optional: only needed for Arrow / Parquet output
+    import pyarrow as pa
+    import pyarrow.ipc as ipc
+    import pyarrow.parquet as pq
+except ImportError:  # pragma: no cover
+    pa = None
+
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+PARQUET_MEDIA_TYPE = "application/vnd.apache.parquet"
+
+# Low-cardinality categorical columns are dictionary-encoded
+DICTIONARY_FIELDS = ("stopReason", "locationId")
+
+# (column name, kind) with kind one of: timestamp, float, dictionary, string
+Field = Tuple[str, str]
+
+_BUCKET_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%d", "%Y-%m")
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def _batch_rows() -> int:
+    return int(os.getenv("COLUMNAR_BATCH_ROWS", "65536"))
+
+
+def columnar_format(format: Optional[str], accept: Optional[str]) -> Optional[str]:
+    """``"arrow"``, ``"parquet"`` or None (plain JSON) for a request."""
+    fmt = (format or "").lower()
+    if fmt in ("arrow", "parquet"):
+        return fmt
+    if accept and ARROW_STREAM_MEDIA_TYPE in accept:
+        return "arrow"
+    return None
+
+
+def category_kind(field: str) -> str:
+    return "dictionary" if field in DICTIONARY_FIELDS else "string"
+
+
+def _epoch_ms(value: Any) -> Optional[int]:
+    """Timestamps travel as int64 milliseconds since the epoch (naive = UTC)."""
+    if isinstance(value, str):
+        for fmt in _BUCKET_FORMATS:
+            try:
+                value = datetime.strptime(value, fmt)
+                break
+            except ValueError:
+                continue
+        else:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return (value - _EPOCH) // timedelta(milliseconds=1)
+
+
+def _float(value: Any) -> Optional[float]:
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else None
+
+
+def _text(value: Any) -> Optional[str]:
+    return None if value is None else str(value)
+
+
+_CONVERTERS: Dict[str, Callable[[Any], Any]] = {
+    "timestamp": _epoch_ms,
+    "float": _float,
+    "dictionary": _text,
+    "string": _text,
+}
+
+
+def _arrow_type(kind: str):
+    return {
+        "timestamp": pa.int64(),
+        "float": pa.float64(),
+        "dictionary": pa.dictionary(pa.int32(), pa.string()),
+        "string": pa.string(),
+    }[kind]
+
+
+def arrow_schema(fields: Sequence[Field]):
+    return pa.schema([pa.field(name, _arrow_type(kind)) for name, kind in fields])
+
+
+def _to_batch(schema, fields: Sequence[Field], cols: List[List[Any]]):
+    arrays = []
+    for (_, kind), values, field in zip(fields, cols, schema):
+        if kind == "dictionary":
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode())
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+async def record_batches(
+    rows: AsyncIterator[Any],
+    fields: Sequence[Field],
+    to_row: Callable[[Any], Sequence[Any]],
+) -> AsyncIterator[Any]:
+    """Build typed record batches column by column straight from a cursor.
+
+    Only one batch (``COLUMNAR_BATCH_ROWS`` rows) of Python values is held
+    at a time.
+    """
+    schema = arrow_schema(fields)
+    converters = [_CONVERTERS[kind] for _, kind in fields]
+    limit = _batch_rows()
+    cols: List[List[Any]] = [[] for _ in fields]
+    n = 0
+    async for doc in rows:
+        for col, convert, value in zip(cols, converters, to_row(doc)):
+            col.append(convert(value))
+        n += 1
+        if n >= limit:
+            yield _to_batch(schema, fields, cols)
+            cols, n = [[] for _ in fields], 0
+    if n:
+        yield _to_batch(schema, fields, cols)
+
+
+def _unavailable() -> JSONResponse:
+    return JSONResponse(status_code=501, content={"error": "Arrow/Parquet output requires pyarrow"})
+
+
+async def _arrow_stream(rows, fields, to_row) -> AsyncIterator[bytes]:
+    sink = io.BytesIO()
+    writer = ipc.new_stream(sink, arrow_schema(fields))
+
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate()
+        return data
+
+    yield drain()  # schema message first, so clients can start decoding
+    async for batch in record_batches(rows, fields, to_row):
+        writer.write_batch(batch)
+        yield drain()
+    writer.close()
+    yield drain()
+
+
+async def columnar_response(
+    fmt: str,
+    rows: AsyncIterator[Any],
+    fields: Sequence[Field],
+    to_row: Callable[[Any], Sequence[Any]],
+) -> Response:
+    """Arrow IPC stream (sent batch by batch) or a Parquet file for ``rows``.
+
+    Returns 501 when pyarrow is not installed.
+    """
+    if pa is None:
+        return _unavailable()
+    if fmt == "arrow":
+        return StreamingResponse(_arrow_stream(rows, fields, to_row), media_type=ARROW_STREAM_MEDIA_TYPE)
+    # Parquet needs its footer written last, so the file is assembled in memory
+    sink = io.BytesIO()
+    with pq.ParquetWriter(sink, arrow_schema(fields)) as writer:
+        async for batch in record_batches(rows, fields, to_row):
+            writer.write_batch(batch)
+    return Response(
+        content=sink.getvalue(),
+        media_type=PARQUET_MEDIA_TYPE,
+        headers={"Content-Disposition": 'attachment; filename="query.parquet"'},
+    )
@@ -0,0 +1,227 @@
+from __future__ import annotations
+
+import os
+import zlib
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from app.cache import cache_enabled, get_cache, link, response_marks
+from app.responses import negotiate
+
+try:  # optional: br is only offered when the package is installed
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+_COMPRESSIBLE = (
+    "application/json",
+    "application/x-ndjson",
+    "application/msgpack",
+    "application/vnd.apache.arrow.stream",
+    "application/javascript",
+    "application/xml",
+)
+
+# Encoded response bytes cached next to the cached() results they were rendered from
+stats: Dict[str, int] = {"hits": 0, "misses": 0, "stored": 0}
+
+
+def compression_enabled() -> bool:
+    return os.getenv("COMPRESSION_ENABLED", "1").lower() not in ("0", "false", "no")
+
+
+def _min_size() -> int:
+    return int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+
+
+def _gzip_level() -> int:
+    return int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+
+
+def _brotli_quality() -> int:
+    return int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+
+
+def choose_encoding(accept_encoding: str) -> str:
+    """``br``, ``gzip`` or ``identity`` for an Accept-Encoding header."""
+    if not compression_enabled():
+        return "identity"
+    accepted = set()
+    for item in accept_encoding.lower().split(","):
+        coding, *params = [p.strip() for p in item.split(";")]
+        q = next((p[2:] for p in params if p.startswith("q=")), "1")
+        try:
+            if coding and float(q) > 0:
+                accepted.add(coding)
+        except ValueError:
+            continue
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return "identity"
+
+
+def _compressible(content_type: str) -> bool:
+    media_type = content_type.split(";")[0].strip().lower()
+    if media_type == "text/event-stream":
+        return False
+    return media_type.startswith("text/") or media_type in _COMPRESSIBLE
+
+
+class _Encoder:
+    """Incremental gzip/brotli encoder; each chunk is flushed so streams stay live."""
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == "br":
+            self._br = brotli.Compressor(quality=_brotli_quality())
+        else:
+            self._gz = zlib.compressobj(_gzip_level(), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def chunk(self, data: bytes) -> bytes:
+        if self.encoding == "br":
+            return self._br.process(data) + self._br.flush()
+        return self._gz.compress(data) + self._gz.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        if self.encoding == "br":
+            return self._br.finish()
+        return self._gz.flush()
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(data, quality=_brotli_quality())
+    gz = zlib.compressobj(_gzip_level(), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return gz.compress(data) + gz.flush()
+
+
+def response_cache_key(scope: Scope, headers: Headers, encoding: str) -> str:
+    """Path + sorted query + negotiated body format + content encoding."""
+    query = urlencode(sorted(parse_qsl(scope.get("query_string", b"").decode("latin-1"), keep_blank_values=True)))
+    fmt, typed = negotiate(headers.get("accept"))
+    return f"http:{scope['path']}?{query}|{fmt}{'+typed' if typed else ''}|{encoding}"
+
+
+class CompressionMiddleware:
+    """gzip/brotli response compression with a size threshold.
+
+    Complete bodies of at least ``COMPRESSION_MIN_SIZE`` bytes are
+    compressed in one go; streamed bodies are compressed chunk by chunk.
+    For GET requests answered by a ``cached()`` endpoint the encoded bytes
+    are cached too, expiring with the cached result and dropped with it by
+    ``invalidate``, so later hits skip rendering and compression.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        encoding = choose_encoding(headers.get("accept-encoding", ""))
+        key = None
+        if scope["method"] == "GET" and cache_enabled():
+            key = response_cache_key(scope, headers, encoding)
+            entry = await get_cache().get(key)
+            if isinstance(entry, dict):
+                stats["hits"] += 1
+                await _send_cached(send, entry)
+                return
+            stats["misses"] += 1
+        marks: Dict[str, Tuple[float, str]] = {}
+        response_marks.set(marks)
+        await self.app(scope, receive, _Responder(scope, send, encoding, key, marks))
+
+
+async def _send_cached(send: Send, entry: Dict[str, Any]) -> None:
+    body = entry["body"]
+    raw = [(k.encode("latin-1"), v.encode("latin-1")) for k, v in entry["headers"]]
+    raw += [(b"content-length", str(len(body)).encode()), (b"x-response-cache", b"hit")]
+    await send({"type": "http.response.start", "status": 200, "headers": raw})
+    await send({"type": "http.response.body", "body": body})
+
+
+_STORED_HEADERS = ("content-type", "content-encoding", "vary")
+
+
+class _Responder:
+    def __init__(self, scope: Scope, send: Send, encoding: str, key: Optional[str], marks: Dict[str, Tuple[float, str]]):
+        self.scope = scope
+        self.send = send
+        self.encoding = encoding
+        self.key = key
+        self.marks = marks
+        self.start: Optional[Message] = None
+        self.encoder: Optional[_Encoder] = None
+        self.passthrough = False
+
+    def _mark(self) -> Optional[Tuple[float, str]]:
+        """(seconds left, data key) of the endpoint's own cached() result, if any."""
+        route = getattr(self.scope.get("endpoint"), "cache_route", None)
+        return self.marks.get(route) if route else None
+
+    async def __call__(self, message: Message) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if self.passthrough or self.encoder is not None:
+            await self._stream(message)
+            return
+        if message["type"] != "http.response.body" or self.start is None:
+            await self.send(message)
+            return
+
+        start, self.start = self.start, None
+        headers = MutableHeaders(raw=list(start["headers"]))
+        body = message.get("body", b"")
+        compressible = (
+            self.encoding != "identity"
+            and "content-encoding" not in headers
+            and _compressible(headers.get("content-type", ""))
+        )
+
+        if message.get("more_body", False):
+            if compressible:
+                self.encoder = _Encoder(self.encoding)
+                del headers["content-length"]
+                headers["content-encoding"] = self.encoding
+                headers.add_vary_header("Accept-Encoding")
+            else:
+                self.passthrough = True
+            await self.send({**start, "headers": headers.raw})
+            await self._stream(message)
+            return
+
+        if compressible and len(body) >= _min_size():
+            body = compress(body, self.encoding)
+            headers["content-encoding"] = self.encoding
+            headers["content-length"] = str(len(body))
+        if _compressible(headers.get("content-type", "")):
+            headers.add_vary_header("Accept-Encoding")
+        await self.send({**start, "headers": headers.raw})
+        await self.send({"type": "http.response.body", "body": body})
+
+        mark = self._mark()
+        if self.key and start["status"] == 200 and mark:
+            ttl, data_key = mark
+            entry = {"headers": [(k, v) for k, v in headers.items() if k in _STORED_HEADERS], "body": body}
+            await get_cache().set(self.key, entry, ttl)
+            link(data_key, self.key)
+            stats["stored"] += 1
+
+    async def _stream(self, message: Message) -> None:
+        if self.encoder is None:
+            await self.send(message)
+            return
+        more = message.get("more_body", False)
+        data = self.encoder.chunk(message.get("body", b""))
+        if not more:
+            data += self.encoder.finish()
+        await self.send({"type": "http.response.body", "body": data, "more_body": more})
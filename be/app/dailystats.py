@@ -0,0 +1,204 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.cache import invalidate
+from app.rollups import DURATION_MS
+from app.rebuild import bucket_ranges, rebuild, touched
+from app.watermarks import changed_logs, get_state, set_watermark
+
+DAILY = "timerdailystats"
+STATE_NAME = "timerdailystats"
+# Marks the rows this builder writes; imported rows without it are never touched
+OWNED = {"builtFrom": "timerlogs"}
+
+DAY_OF_CREATED_AT = {
+    "$dateFromParts": {
+        "year": {"$year": "$createdAt"},
+        "month": {"$month": "$createdAt"},
+        "day": {"$dayOfMonth": "$createdAt"},
+    }
+}
+
+_PRODUCED = {"$eq": ["$stopReason", "Unit Created"]}
+_NOT_DOWNTIME = {"$in": [{"$ifNull": ["$stopReason", None]}, ["Unit Created", None]]}
+
+_lock = asyncio.Lock()
+
+
+def refresh_interval() -> float:
+    """Seconds between background builds; 0 (the default) leaves it to the CLI."""
+    return float(os.getenv("DAILYSTATS_REFRESH_SECONDS", "0"))
+
+
+def _lag_seconds() -> float:
+    return float(os.getenv("DAILYSTATS_LAG_SECONDS", "5"))
+
+
+def _batch_days() -> int:
+    return int(os.getenv("DAILYSTATS_BATCH_DAYS", "31"))
+
+
+def _pct(num: Any, den: Any) -> Dict[str, Any]:
+    return {"$cond": [{"$gt": [den, 0]}, {"$multiply": [{"$divide": [num, den]}, 100]}, None]}
+
+
+def day_ranges(days: List[datetime]) -> List[Dict[str, Any]]:
+    return bucket_ranges(days, timedelta(days=1))
+
+
+def daily_pipeline(days: List[datetime], built_at: datetime) -> List[Dict[str, Any]]:
+    """Recompute whole days of ``DAILY`` rows (one per date, locationId, timerId).
+
+    Durations come from ``endedAt - createdAt``. ``totalRuntime`` is the time
+    spent producing units ("Unit Created") and ``totalDowntime`` the time of
+    any other stop reason, both in seconds. ``availability`` is runtime over
+    runtime + downtime and ``efficiency`` runtime over all logged time.
+    ``performance`` is the ideal time (``cycle`` seconds per unit) over
+    runtime, when cycles are recorded. Timerlogs carry no reject counts, so
+    ``quality`` is 100 and ``oee`` is availability x performance.
+
+    Keys that already have an imported row (one without ``builtFrom``) on
+    that day are skipped, and the cleanup in ``rebuild_days`` removes any
+    row an earlier build wrote for them.
+    """
+    return [
+        {"$match": {"$or": day_ranges(days)}},
+        {"$addFields": {"__dur": DURATION_MS}},
+        {"$group": {
+            "_id": {"date": DAY_OF_CREATED_AT, "locationId": "$locationId", "timerId": "$timerId"},
+            "machineId": {"$first": "$machineId"},
+            "machineClassId": {"$first": "$machineClassId"},
+            "logs": {"$sum": 1},
+            "totalProduced": {"$sum": {"$cond": [_PRODUCED, 1, 0]}},
+            "runMs": {"$sum": {"$cond": [_PRODUCED, "$__dur", 0]}},
+            "downMs": {"$sum": {"$cond": [_NOT_DOWNTIME, 0, "$__dur"]}},
+            "loggedMs": {"$sum": "$__dur"},
+            "idealMs": {"$sum": {"$cond": [
+                {"$and": [_PRODUCED, {"$gt": ["$cycle", 0]}]},
+                {"$multiply": ["$cycle", 1000]},
+                0,
+            ]}},
+        }},
+        # Keys an imported row already covers for the day are left to it, so
+        # readers that sum the day's rows do not count the day twice
+        {"$lookup": {
+            "from": DAILY,
+            "let": {"date": "$_id.date", "locationId": "$_id.locationId", "timerId": "$_id.timerId"},
+            "pipeline": [
+                {"$match": {
+                    **{k: {"$exists": False} for k in OWNED},
+                    "$expr": {"$and": [
+                        {"$gte": ["$date", "$$date"]},
+                        {"$lt": ["$date", {"$add": ["$$date", 86400000]}]},
+                        {"$eq": ["$locationId", "$$locationId"]},
+                        {"$eq": ["$timerId", "$$timerId"]},
+                    ]},
+                }},
+                {"$limit": 1},
+                {"$project": {"_id": 1}},
+            ],
+            "as": "__imported",
+        }},
+        {"$match": {"__imported": {"$size": 0}}},
+        {"$project": {
+            "date": "$_id.date",
+            "locationId": "$_id.locationId",
+            "timerId": "$_id.timerId",
+            "machineId": 1,
+            "machineClassId": 1,
+            "logs": 1,
+            "totalProduced": 1,
+            "totalRuntime": {"$divide": ["$runMs", 1000]},
+            "totalDowntime": {"$divide": ["$downMs", 1000]},
+            "availability": _pct("$runMs", {"$add": ["$runMs", "$downMs"]}),
+            "efficiency": _pct("$runMs", "$loggedMs"),
+            "performance": {"$cond": [
+                {"$and": [{"$gt": ["$idealMs", 0]}, {"$gt": ["$runMs", 0]}]},
+                {"$min": [100, _pct("$idealMs", "$runMs")]},
+                None,
+            ]},
+            "quality": {"$literal": 100},
+            **{k: {"$literal": v} for k, v in OWNED.items()},
+            "builtAt": {"$literal": built_at},
+        }},
+        {"$addFields": {"oee": {"$cond": [
+            {"$and": [{"$ne": ["$availability", None]}, {"$ne": ["$performance", None]}]},
+            {"$divide": [{"$multiply": ["$availability", "$performance", "$quality"]}, 10000]},
+            None,
+        ]}}},
+        {"$merge": {"into": DAILY, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+
+async def touched_days(db: AsyncIOMotorDatabase, match: Dict[str, Any]) -> List[datetime]:
+    return await touched(db, [match], DAY_OF_CREATED_AT)
+
+
+async def rebuild_days(db: AsyncIOMotorDatabase, days: List[datetime]) -> int:
+    """Rebuild ``days`` in batches. Rows of those days written by an earlier
+    build and not by this one (keys without logs any more) are removed;
+    imported rows, which lack ``builtFrom``, are left alone."""
+    return await rebuild(db, DAILY, days, "date", daily_pipeline, _batch_days(), owned=OWNED)
+
+
+async def refresh_daily_stats(
+    db: AsyncIOMotorDatabase,
+    since: Optional[datetime] = None,
+    days: Iterable[datetime] = (),
+) -> Dict[str, Any]:
+    """Recompute the days that received or closed timerlogs since the last run.
+
+    Progress is an ``_id`` high-water mark plus an ``endedAt`` one; every
+    touched day is rebuilt from all of its logs, so reruns are idempotent.
+    ``since`` additionally rebuilds every day from that date on (e.g. after
+    backfills or edits to old logs), and ``days`` those days (e.g. the ones
+    a watcher saw logs change in).
+    """
+    async with _lock:
+        filters, high, closed_high = changed_logs(await get_state(db, STATE_NAME), _lag_seconds())
+        days = set(days)
+        days.update(await touched(db, filters, DAY_OF_CREATED_AT))
+        if since is not None:
+            days.update(await touched_days(db, {"createdAt": {"$gte": since}}))
+        rebuilt = await rebuild_days(db, sorted(days))
+        await set_watermark(db, STATE_NAME, high, closedWatermark=closed_high)
+        await invalidate([(DAILY, None, d) for d in days])
+        return {
+            "watermark": str(high),
+            "days": rebuilt,
+            "from": min(days).date().isoformat() if days else None,
+            "to": max(days).date().isoformat() if days else None,
+        }
+
+
+async def ensure_daily_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db[DAILY].create_index([("date", 1), ("locationId", 1)])
+
+
+async def _main():
+    from app.db import get_db, close_db
+
+    parser = argparse.ArgumentParser(description="Materialize timerdailystats from timerlogs")
+    parser.add_argument("--since", help="also rebuild every day from this ISO date on")
+    parser.add_argument("--days", type=int, help="also rebuild the last N days")
+    args = parser.parse_args()
+
+    since = datetime.fromisoformat(args.since) if args.since else None
+    if args.days:
+        since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=args.days - 1)
+
+    db = get_db()
+    await ensure_daily_indexes(db)
+    print(await refresh_daily_stats(db, since))
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -1,24 +1,38 @@
 from __future__ import annotations
 
 import os
-from typing import Any
+from typing import Any, Dict, List, Optional
 
-from pymongo import MongoClient
+from bson import json_util
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection, AsyncIOMotorDatabase
 from dotenv import load_dotenv
 
+from app.singleflight import group, singleflight_enabled
+
 load_dotenv()
 
-_client: MongoClient | None = None
-_db: Any | None = None
+_client: AsyncIOMotorClient | None = None
+_db: AsyncIOMotorDatabase | None = None
+
+
+def _client_options() -> Dict[str, Any]:
+    # Concurrency is bounded by the Mongo connection pool, not by Python threads
+    return {
+        "maxPoolSize": int(os.getenv("MONGODB_MAX_POOL_SIZE", "100")),
+        "minPoolSize": int(os.getenv("MONGODB_MIN_POOL_SIZE", "0")),
+        "serverSelectionTimeoutMS": int(os.getenv("MONGODB_SERVER_SELECTION_TIMEOUT_MS", "5000")),
+        "connectTimeoutMS": int(os.getenv("MONGODB_CONNECT_TIMEOUT_MS", "10000")),
+        "socketTimeoutMS": int(os.getenv("MONGODB_SOCKET_TIMEOUT_MS", "30000")),
+    }
 
 
-def get_db():
+def get_db() -> AsyncIOMotorDatabase:
     global _client, _db
     if _db is not None:
         return _db
     uri = os.getenv("MONGODB_URI", "mongodb://localhost:27018")
     dbname = os.getenv("MONGODB_DB", "apms")
-    _client = MongoClient(uri)
+    _client = AsyncIOMotorClient(uri, **_client_options())
     _db = _client[dbname]
     return _db
 
@@ -30,3 +44,29 @@ def close_db():
     _client = None
     _db = None
 
+
+async def _coalesced(coll: AsyncIOMotorCollection, op: str, args: Any, fn):
+    if not singleflight_enabled():
+        return await fn()
+    label = f"{coll.name}.{op}"
+    key = f"{coll.database.name}.{label}:{json_util.dumps(args)}"
+    result = await group.do(key, fn, label=label)
+    # Waiters share one result; hand each its own list so callers can't trip over each other
+    return list(result) if isinstance(result, list) else result
+
+
+async def aggregate(coll: AsyncIOMotorCollection, pipeline: List[Dict[str, Any]], **options: Any) -> List[Dict[str, Any]]:
+    """Run an aggregation, sharing the execution with identical concurrent pipelines.
+
+    ``options`` (e.g. ``hint``) are passed to ``aggregate`` and are part of the sharing key.
+    """
+    args = [pipeline, options] if options else pipeline
+    return await _coalesced(coll, "aggregate", args, lambda: coll.aggregate(pipeline, **options).to_list(None))
+
+
+async def count_documents(coll: AsyncIOMotorCollection, filter: Dict[str, Any]) -> int:
+    return await _coalesced(coll, "count_documents", filter, lambda: coll.count_documents(filter))
+
+
+async def distinct(coll: AsyncIOMotorCollection, field: str, filter: Optional[Dict[str, Any]] = None) -> List[Any]:
+    return await _coalesced(coll, "distinct", [field, filter], lambda: coll.distinct(field, filter))
@@ -0,0 +1,241 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.dailystats import DAY_OF_CREATED_AT, day_ranges, touched_days
+from app.rebuild import rebuild, touched
+from app.rollups import DURATION_MS
+from app.watermarks import changed_logs, get_state, set_watermark
+
+FEATURES = "machine_daily_features"
+STATE_NAME = "machine_daily_features"
+WINDOWS = (7, 30, 90)
+
+# Health below this is flagged for immediate maintenance
+HEALTH_ALERT = 70.0
+
+_lock = asyncio.Lock()
+
+
+def refresh_interval() -> float:
+    return float(os.getenv("FEATURES_REFRESH_SECONDS", "300"))
+
+
+def _lag_seconds() -> float:
+    return float(os.getenv("FEATURES_LAG_SECONDS", "5"))
+
+
+def _batch_days() -> int:
+    return int(os.getenv("FEATURES_BATCH_DAYS", "31"))
+
+
+def _trend_days() -> int:
+    return int(os.getenv("FEATURES_TREND_DAYS", "30"))
+
+
+def features_pipeline(days: List[datetime], built_at: datetime) -> List[Dict[str, Any]]:
+    """Recompute whole days of ``FEATURES`` rows, one per (date, machineId).
+
+    Downtime events are logs whose stop reason is not "Unit Created";
+    ``dur*`` cover logs with both ``createdAt`` and ``endedAt``.
+    """
+    return [
+        {"$match": {"$or": day_ranges(days)}},
+        {"$addFields": {"__dur": DURATION_MS}},
+        {"$sort": {"createdAt": 1}},
+        {"$group": {
+            "_id": {"date": DAY_OF_CREATED_AT, "machineId": "$machineId"},
+            "locationId": {"$last": "$locationId"},
+            "events": {"$sum": 1},
+            "downtimeEvents": {"$sum": {"$cond": [{"$ne": ["$stopReason", "Unit Created"]}, 1, 0]}},
+            "durCount": {"$sum": {"$cond": [{"$eq": ["$__dur", None]}, 0, 1]}},
+            "durSum": {"$sum": "$__dur"},
+            "durSumSq": {"$sum": {"$multiply": ["$__dur", "$__dur"]}},
+            "lastEvent": {"$max": "$createdAt"},
+        }},
+        {"$addFields": {
+            "date": "$_id.date",
+            "machineId": "$_id.machineId",
+            "builtAt": {"$literal": built_at},
+        }},
+        {"$merge": {"into": FEATURES, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+
+async def rebuild_days(db: AsyncIOMotorDatabase, days: List[datetime]) -> int:
+    return await rebuild(db, FEATURES, days, "date", features_pipeline, _batch_days())
+
+
+async def refresh_machine_features(db: AsyncIOMotorDatabase, since: Optional[datetime] = None) -> Dict[str, Any]:
+    """Rebuild the days that received or closed timerlogs since the last run
+    (``_id`` and ``endedAt`` watermarks), plus every day from ``since`` on."""
+    async with _lock:
+        filters, high, closed_high = changed_logs(await get_state(db, STATE_NAME), _lag_seconds())
+        days = set(await touched(db, filters, DAY_OF_CREATED_AT))
+        if since is not None:
+            days.update(await touched_days(db, {"createdAt": {"$gte": since}}))
+        rebuilt = await rebuild_days(db, sorted(days))
+        await set_watermark(db, STATE_NAME, high, closedWatermark=closed_high)
+        return {"watermark": str(high), "days": rebuilt}
+
+
+async def ensure_feature_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db[FEATURES].create_index([("date", 1), ("locationId", 1)])
+
+
+async def ready(db: AsyncIOMotorDatabase) -> bool:
+    return await get_state(db, STATE_NAME) is not None
+
+
+class FeatureMatrix:
+    """Daily feature rows laid out as machines x days arrays (oldest day first)."""
+
+    FIELDS = ("events", "downtimeEvents", "durCount", "durSum", "durSumSq")
+
+    def __init__(self, rows: List[Dict[str, Any]], today: datetime, days: int):
+        self.machines: List[Any] = []
+        self.locations: List[Any] = []
+        self.last_event: List[Optional[datetime]] = []
+        index: Dict[Any, int] = {}
+        for row in rows:
+            m = index.get(row["machineId"])
+            if m is None:
+                m = index[row["machineId"]] = len(self.machines)
+                self.machines.append(row["machineId"])
+                self.locations.append(row.get("locationId"))
+                self.last_event.append(row.get("lastEvent"))
+            else:
+                # rows come sorted by date: the latest location wins
+                self.locations[m] = row.get("locationId", self.locations[m])
+                self.last_event[m] = row.get("lastEvent") or self.last_event[m]
+
+        shape = (len(self.machines), days)
+        self.data = {f: np.zeros(shape) for f in self.FIELDS}
+        first = today - timedelta(days=days - 1)
+        for row in rows:
+            d = (row["date"] - first).days
+            if 0 <= d < days:
+                m = index[row["machineId"]]
+                for f in self.FIELDS:
+                    self.data[f][m, d] = row.get(f) or 0
+
+    def window(self, days: int) -> Dict[str, np.ndarray]:
+        """Health features over the last ``days`` days, one value per machine."""
+        s = {f: v[:, -days:].sum(axis=1) for f, v in self.data.items()}
+        events, down = s["events"], s["downtimeEvents"]
+        n, total, sq = s["durCount"], s["durSum"], s["durSumSq"]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(events > 0, down / events, np.nan)
+            mean = np.where(n > 0, total / n, np.nan)
+            std = np.sqrt(np.maximum(np.where(n > 0, sq / n, np.nan) - mean ** 2, 0))
+            variability = np.where(mean > 0, std / mean, 0.0)
+        return {
+            "events": events,
+            "downtimeRatio": ratio,
+            "healthScore": (1 - ratio) * 100,
+            "variabilityScore": variability,
+        }
+
+    def trend(self, days: int, days_ahead: int) -> Dict[str, np.ndarray]:
+        """Least-squares line through each machine's daily health score (days
+        without events are skipped), evaluated ``days_ahead`` after today."""
+        events = self.data["events"][:, -days:]
+        down = self.data["downtimeEvents"][:, -days:]
+        mask = events > 0
+        with np.errstate(divide="ignore", invalid="ignore"):
+            y = np.where(mask, (1 - down / events) * 100, 0.0)
+        x = np.broadcast_to(np.arange(days, dtype=float), y.shape) * mask
+        n = mask.sum(axis=1)
+        sx, sy = x.sum(axis=1), y.sum(axis=1)
+        sxx, sxy = (x * x).sum(axis=1), (x * y).sum(axis=1)
+        den = n * sxx - sx * sx
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where(den > 0, (n * sxy - sx * sy) / den, 0.0)
+            intercept = np.where(n > 0, (sy - slope * sx) / n, np.nan)
+        projected = np.clip(intercept + slope * (days - 1 + days_ahead), 0, 100)
+        current = np.clip(intercept + slope * (days - 1), 0, 100)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            until_alert = np.where(
+                (slope < 0) & (current > HEALTH_ALERT), (HEALTH_ALERT - current) / slope, np.nan
+            )
+        return {"slope": slope, "projected": projected, "daysUntilAlert": until_alert}
+
+
+async def load_matrix(db: AsyncIOMotorDatabase, location_id: Optional[str] = None) -> FeatureMatrix:
+    """The last ``max(WINDOWS)`` days of feature rows; reads at most machines x 90 small rows."""
+    days = max(WINDOWS)
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    query: Dict[str, Any] = {"date": {"$gte": today - timedelta(days=days - 1)}}
+    if location_id:
+        query["locationId"] = location_id
+    fields = {"_id": 0, "date": 1, "machineId": 1, "locationId": 1, "lastEvent": 1, **{f: 1 for f in FeatureMatrix.FIELDS}}
+    rows = await db[FEATURES].find(query, fields).sort("date", 1).to_list(None)
+    return FeatureMatrix(rows, today, days)
+
+
+def _num(value: Any, digits: int = 1) -> Optional[float]:
+    value = float(value)
+    return None if np.isnan(value) else round(value, digits)
+
+
+async def machine_health(db: AsyncIOMotorDatabase, location_id: Optional[str], days_ahead: int) -> List[Dict[str, Any]]:
+    """Per-machine features over every window plus the projected health, worst 30-day health first."""
+    matrix = await load_matrix(db, location_id)
+    windows = {w: matrix.window(w) for w in WINDOWS}
+    trend = matrix.trend(_trend_days(), days_ahead)
+    out = []
+    for m, machine_id in enumerate(matrix.machines):
+        month = windows[30]
+        if not month["events"][m]:
+            continue  # no activity in the last 30 days
+        out.append({
+            "machineId": machine_id,
+            "location": matrix.locations[m],
+            "lastEvent": matrix.last_event[m],
+            "totalEvents": int(month["events"][m]),
+            "downtimeRatio": float(month["downtimeRatio"][m]),
+            "healthScore": float(month["healthScore"][m]),
+            "variabilityScore": float(month["variabilityScore"][m]),
+            "windows": {
+                f"{w}d": {
+                    "healthScore": _num(f["healthScore"][m]),
+                    "downtimeRatio": _num(f["downtimeRatio"][m], 3),
+                    "variabilityScore": _num(f["variabilityScore"][m], 3),
+                }
+                for w, f in windows.items()
+            },
+            "trendPerDay": _num(trend["slope"][m], 2),
+            "projectedHealthScore": _num(trend["projected"][m]),
+            "daysUntilAlert": _num(trend["daysUntilAlert"][m]),
+        })
+    out.sort(key=lambda r: r["healthScore"])
+    return out
+
+
+async def _main():
+    from app.db import get_db, close_db
+
+    parser = argparse.ArgumentParser(description="Materialize machine_daily_features from timerlogs")
+    parser.add_argument("--since", help="also rebuild every day from this ISO date on")
+    parser.add_argument("--days", type=int, help="also rebuild the last N days")
+    args = parser.parse_args()
+
+    since = datetime.fromisoformat(args.since) if args.since else None
+    if args.days:
+        since = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=args.days - 1)
+
+    db = get_db()
+    await ensure_feature_indexes(db)
+    print(await refresh_machine_features(db, since))
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
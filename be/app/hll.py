@@ -0,0 +1,224 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Set
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from app.rollups import floor_hour, mark_refreshed
+from app.watermarks import get_state, id_range, id_upper_bound, set_watermark
+
+HLL = "timerlogs_hll"
+# Fields with a distinct-count sketch; locations are the rows' own key
+HLL_FIELDS = ("timerId", "machineId")
+
+# 2^14 registers: about 0.8% standard error. Stored register indexes depend
+# on it, so changing it requires dropping HLL and its etl_state entry.
+PRECISION = 14
+_M = 1 << PRECISION
+_ALPHA = 0.7213 / (1 + 1.079 / _M)
+_REST_BITS = 64 - PRECISION
+
+_BULK = 1000
+_BATCH = 50000
+
+_lock = asyncio.Lock()
+
+
+def _lag_seconds() -> float:
+    return float(os.getenv("ROLLUP_LAG_SECONDS", "5"))
+
+
+def register(value: Any) -> tuple:
+    """(register index, rank) of ``value`` from a stable 64-bit hash of its string form."""
+    h = int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), "big")
+    rest = h & ((1 << _REST_BITS) - 1)
+    return h >> _REST_BITS, _REST_BITS - rest.bit_length() + 1
+
+
+class HyperLogLog:
+    """Sparse HyperLogLog: only non-zero registers are kept, as the stored
+    ``{index: rank}`` objects are. Merging is a per-register max."""
+
+    def __init__(self):
+        self.registers: Dict[int, int] = {}
+
+    def add(self, value: Any) -> None:
+        if value is None:
+            return
+        idx, rank = register(value)
+        if rank > self.registers.get(idx, 0):
+            self.registers[idx] = rank
+
+    def merge(self, stored: Optional[Dict[str, int]]) -> None:
+        for idx, rank in (stored or {}).items():
+            idx = int(idx)
+            if rank > self.registers.get(idx, 0):
+                self.registers[idx] = rank
+
+    def estimate(self) -> int:
+        zeros = _M - len(self.registers)
+        raw = _ALPHA * _M * _M / (zeros + sum(2.0 ** -r for r in self.registers.values()))
+        if raw <= 2.5 * _M and zeros:
+            return round(_M * math.log(_M / zeros))  # linear counting, near exact for small sets
+        return round(raw)
+
+
+def _floor_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _key(grain: str, t: datetime, location_id: Any) -> Dict[str, Any]:
+    return {"g": grain, "t": t, "locationId": location_id}
+
+
+async def _flush(db: AsyncIOMotorDatabase, pending: Dict[tuple, Dict[str, Dict[int, int]]]) -> None:
+    ops: List[UpdateOne] = []
+    for (grain, t, loc), fields in pending.items():
+        key = _key(grain, t, loc)
+        ops.append(UpdateOne(
+            {"_id": key},
+            {"$max": {f"{f}.{idx}": rank for f, regs in fields.items() for idx, rank in regs.items()},
+             "$setOnInsert": key},
+            upsert=True,
+        ))
+        if len(ops) >= _BULK:
+            await db[HLL].bulk_write(ops, ordered=False)
+            ops = []
+    if ops:
+        await db[HLL].bulk_write(ops, ordered=False)
+    pending.clear()
+
+
+async def refresh_hll(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    """Fold timerlogs inserted since the last run into hourly and daily sketches
+    per location (``g`` = "h" / "d").
+
+    Registers are written with ``$max``, so a batch replayed after a crash
+    leaves the sketches unchanged.
+    """
+    async with _lock:
+        low = (await get_state(db, HLL) or {}).get("watermark")
+        high = id_upper_bound(_lag_seconds())
+        if low is not None and low >= high:
+            return {"watermark": str(low), "skipped": True}
+        pending: Dict[tuple, Dict[str, Dict[int, int]]] = {}
+        logs = 0
+        fields = {"createdAt": 1, "locationId": 1, **{f: 1 for f in HLL_FIELDS}}
+        async for doc in db.timerlogs.find({**id_range(low, high), "createdAt": {"$type": "date"}}, fields):
+            hour = floor_hour(doc["createdAt"])
+            for grain, t in (("h", hour), ("d", _floor_day(hour))):
+                regs = pending.setdefault((grain, t, doc.get("locationId")), {})
+                for f in HLL_FIELDS:
+                    if doc.get(f) is None:
+                        continue  # not a distinct value, as for $addToSet / distinct
+                    idx, rank = register(doc.get(f))
+                    field = regs.setdefault(f, {})
+                    if rank > field.get(idx, 0):
+                        field[idx] = rank
+            logs += 1
+            if logs % _BATCH == 0:
+                await _flush(db, pending)
+        await _flush(db, pending)
+        await set_watermark(db, HLL, high)
+        mark_refreshed(HLL)
+        return {"watermark": str(high), "logs": logs}
+
+
+async def ensure_hll_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db[HLL].create_index([("g", 1), ("t", 1), ("locationId", 1)])
+
+
+def window_query(start: Optional[datetime], end: Optional[datetime], hourly: bool = False) -> Dict[str, Any]:
+    """Rows covering every hour that overlaps ``[start, end]``: daily rows for
+    whole days inside it, hourly rows for the partial days at either end
+    (or throughout, with ``hourly``)."""
+    lo = floor_hour(start) if start is not None else None
+    hi = floor_hour(end) + timedelta(hours=1) if end is not None else None
+    if hourly:
+        t: Dict[str, Any] = {}
+        if lo is not None:
+            t["$gte"] = lo
+        if hi is not None:
+            t["$lt"] = hi
+        return {"g": "h", **({"t": t} if t else {})}
+    if lo is None and hi is None:
+        return {"g": "d"}
+    day_lo = _floor_day(lo + timedelta(hours=23)) if lo is not None else None
+    day_hi = _floor_day(hi) if hi is not None else None
+    if day_lo is not None and day_hi is not None and day_lo >= day_hi:
+        return {"g": "h", "t": {"$gte": lo, "$lt": hi}}
+
+    parts: List[Dict[str, Any]] = []
+    days: Dict[str, Any] = {}
+    if day_lo is not None:
+        days["$gte"] = day_lo
+        if lo < day_lo:
+            parts.append({"g": "h", "t": {"$gte": lo, "$lt": day_lo}})
+    if day_hi is not None:
+        days["$lt"] = day_hi
+        if day_hi < hi:
+            parts.append({"g": "h", "t": {"$gte": day_hi, "$lt": hi}})
+    parts.append({"g": "d", "t": days})
+    return {"$or": parts}
+
+
+class UniqueCounts:
+    """Merged timer and machine sketches, plus the exact location set, of one bucket."""
+
+    def __init__(self):
+        self.sketches = {f: HyperLogLog() for f in HLL_FIELDS}
+        self.locations: Set[Any] = set()
+
+    def to_dict(self) -> Dict[str, int]:
+        return {
+            "timers": self.sketches["timerId"].estimate(),
+            "machines": self.sketches["machineId"].estimate(),
+            "locations": len(self.locations),
+        }
+
+
+async def unique_counts(
+    db: AsyncIOMotorDatabase,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    location_id: Optional[str] = None,
+    bucket: Optional[str] = None,
+) -> Dict[Optional[str], Dict[str, int]]:
+    """Approximate distinct timers and machines (and exact locations) over the
+    hours overlapping ``[start, end]``.
+
+    With ``bucket`` (a ``strftime`` format matching the routers'
+    ``$dateToString`` formats) the counts are per bucket; daily rows are
+    used for it only when every hour of a day falls in the same bucket,
+    which holds for day, week and month formats.
+    """
+    query = window_query(start, end, hourly=bucket is not None and "%H" in bucket)
+    if location_id:
+        query["locationId"] = location_id
+    merged: Dict[Optional[str], UniqueCounts] = {}
+    async for row in db[HLL].find(query, {"_id": 0, "g": 0}):
+        counts = merged.setdefault(row["t"].strftime(bucket) if bucket else None, UniqueCounts())
+        if row.get("locationId") is not None:
+            counts.locations.add(row.get("locationId"))
+        for f in HLL_FIELDS:
+            counts.sketches[f].merge(row.get(f))
+    return {k: v.to_dict() for k, v in merged.items()}
+
+
+async def _main():
+    from app.db import get_db, close_db
+
+    db = get_db()
+    await ensure_hll_indexes(db)
+    print(await refresh_hll(db))
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+logger = logging.getLogger(__name__)
+
+Keys = Tuple[Tuple[str, int], ...]
+
+# router -> [(collection, index keys)] for the query shapes the router runs.
+# No entry may be a prefix of another one on the same collection: the
+# compound index serves both shapes, and every extra index on timerlogs is
+# paid for on each insert.
+REQUIRED_INDEXES: Dict[str, List[Tuple[str, Keys]]] = {
+    "production": [
+        ("counts", (("startAt", 1),)),
+        ("counts", (("locationId", 1), ("startAt", 1))),
+    ],
+    "runrate": [
+        ("counts", (("timerId", 1), ("startAt", 1))),
+    ],
+    "downtime": [
+        ("timerlogs", (("createdAt", 1), ("_id", 1))),
+        ("timerlogs", (("endedAt", 1), ("locationId", 1))),
+        ("timerlogs", (("locationId", 1), ("createdAt", 1))),
+    ],
+    "utilization": [
+        ("timerlogs", (("createdAt", 1), ("_id", 1))),
+        ("timerlogs", (("endedAt", 1), ("locationId", 1))),
+        ("timerlogs", (("locationId", 1), ("createdAt", 1))),
+    ],
+    "cycles": [
+        # _id last: keyset pages sort on (start time, _id)
+        ("cycletimers", (("timerId", 1), ("clientStartedAt", 1), ("_id", 1))),
+        ("cycletimers", (("clientStartedAt", 1), ("_id", 1))),
+        ("timerlogs", (("timerId", 1), ("createdAt", 1), ("_id", 1))),
+    ],
+    "refs": [
+        ("locations", (("name", 1),)),
+        ("machineclasses", (("name", 1),)),
+    ],
+    "simple_timerlogs": [
+        ("timerlogs", (("createdAt", 1), ("_id", 1))),
+    ],
+    "simple_dashboard": [
+        ("timerlogs", (("createdAt", 1), ("_id", 1))),
+        ("machines", (("status", 1),)),
+    ],
+    "advanced_charts": [
+        ("timerlogs", (("stopReason", 1), ("createdAt", 1))),
+        ("timerlogs", (("locationId", 1), ("stopReason", 1))),
+    ],
+    "timerlogs": [
+        ("timerlogs", (("createdAt", 1), ("_id", 1))),
+        ("timerlogs", (("locationId", 1), ("createdAt", 1))),
+        ("timerlogs", (("stopReason", 1), ("createdAt", 1))),
+    ],
+    "timerdailystats": [
+        ("timerdailystats", (("date", 1), ("locationId", 1))),
+    ],
+    "machines": [
+        ("timerlogs", (("machineId", 1), ("createdAt", 1))),
+        ("machines", (("locationId", 1), ("machineClassId", 1))),
+    ],
+    "comprehensive_dashboard": [
+        ("timerlogs", (("locationId", 1), ("createdAt", 1))),
+        ("timerlogs", (("endedAt", 1), ("locationId", 1))),
+        ("timerdailystats", (("date", 1), ("locationId", 1))),
+        ("machines", (("locationId", 1), ("machineClassId", 1))),
+    ],
+}
+
+# Placeholder replaced by a value that exists in the collection when probing
+SAMPLE = "$$sample"
+
+
+def _window(days: int = 14) -> Dict[str, datetime]:
+    return {"$gte": datetime.utcnow() - timedelta(days=days)}
+
+
+def probe_pipelines() -> Dict[str, List[Tuple[str, List[Dict[str, Any]]]]]:
+    """Representative leading stages of each router's pipelines, for ``explain``."""
+    return {
+        "production": [("counts", [{"$match": {"locationId": SAMPLE, "startAt": _window()}}])],
+        "runrate": [("counts", [{"$match": {"timerId": SAMPLE, "startAt": _window()}}])],
+        "downtime": [("timerlogs", [
+            {"$match": {"locationId": SAMPLE, "$or": [{"createdAt": _window()}, {"endedAt": _window()}]}},
+        ])],
+        "cycles": [
+            ("cycletimers", [
+                {"$match": {"timerId": SAMPLE, "clientStartedAt": _window()}},
+                {"$sort": {"clientStartedAt": 1, "_id": 1}},
+            ]),
+            ("timerlogs", [
+                {"$match": {"timerId": SAMPLE, "createdAt": _window()}},
+                {"$sort": {"createdAt": 1, "_id": 1}},
+            ]),
+        ],
+        "simple_dashboard": [("timerlogs", [{"$match": {"createdAt": _window(1)}}])],
+        "advanced_charts": [
+            ("timerlogs", [{"$match": {"createdAt": _window(), "stopReason": "Unit Created"}}]),
+            ("timerlogs", [{"$match": {"locationId": SAMPLE, "stopReason": "Unit Created"}}]),
+        ],
+        "timerlogs": [("timerlogs", [{"$match": {"createdAt": _window(), "locationId": SAMPLE}}])],
+        "timerdailystats": [("timerdailystats", [{"$match": {"date": _window(30), "locationId": SAMPLE}}])],
+        "machines": [("timerlogs", [{"$match": {"machineId": SAMPLE, "createdAt": _window(30)}}])],
+        "comprehensive_dashboard": [
+            ("timerlogs", [{"$match": {"locationId": SAMPLE, "createdAt": _window()}}]),
+            ("timerlogs", [{"$match": {"locationId": SAMPLE, "endedAt": None}}]),
+            ("timerdailystats", [{"$match": {"locationId": SAMPLE, "date": _window(30)}}]),
+        ],
+    }
+
+
+def declared_indexes() -> Dict[Tuple[str, Keys], List[str]]:
+    """Unique (collection, keys) -> routers that need it."""
+    out: Dict[Tuple[str, Keys], List[str]] = {}
+    for router, specs in REQUIRED_INDEXES.items():
+        for spec in specs:
+            out.setdefault(spec, []).append(router)
+    return out
+
+
+def _fmt(keys: Keys) -> str:
+    return ", ".join(f"{f}: {d}" for f, d in keys)
+
+
+async def existing_indexes(db: AsyncIOMotorDatabase, collection: str) -> List[Keys]:
+    info = await db[collection].index_information()
+    return [tuple((f, int(d)) for f, d in ix["key"]) for ix in info.values()]
+
+
+async def _missing(db: AsyncIOMotorDatabase) -> List[Tuple[str, Keys, List[str]]]:
+    existing: Dict[str, List[Keys]] = {}
+    missing = []
+    for (collection, keys), routers in declared_indexes().items():
+        if collection not in existing:
+            existing[collection] = await existing_indexes(db, collection)
+        if keys not in existing[collection]:
+            missing.append((collection, keys, routers))
+    return missing
+
+
+async def missing_indexes(db: AsyncIOMotorDatabase) -> List[Dict[str, Any]]:
+    return [{"collection": c, "keys": _fmt(k), "routers": r} for c, k, r in await _missing(db)]
+
+
+async def ensure_indexes(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    """Create declared indexes that do not exist yet (matched on keys, not names)."""
+    created, failed = [], []
+    for collection, keys, routers in await _missing(db):
+        item = {"collection": collection, "keys": _fmt(keys), "routers": routers}
+        try:
+            await db[collection].create_index(list(keys), background=True)
+            created.append(item)
+        except Exception as e:
+            logger.warning("creating index {%s} on %s failed: %s", item["keys"], collection, e)
+            failed.append({**item, "error": str(e)})
+    return {"created": created, "failed": failed}
+
+
+def bootstrap_enabled() -> bool:
+    """Index builds on a busy collection are not free, so startup only
+    reports missing indexes unless ``INDEX_BOOTSTRAP=1``."""
+    return os.getenv("INDEX_BOOTSTRAP", "0").lower() in ("1", "true", "yes")
+
+
+async def report_missing(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    missing = await missing_indexes(db)
+    for item in missing:
+        logger.warning("missing index {%s} on %s (%s)", item["keys"], item["collection"], ", ".join(item["routers"]))
+    return {"missing": missing}
+
+
+def _walk(obj: Any, key: str) -> Iterator[Any]:
+    """Every value stored under ``key`` anywhere in an explain document."""
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            if k == key:
+                yield v
+            yield from _walk(v, key)
+    elif isinstance(obj, list):
+        for v in obj:
+            yield from _walk(v, key)
+
+
+def summarize_explain(explain: Dict[str, Any]) -> Dict[str, Any]:
+    stages = set()
+    for plan in _walk(explain, "winningPlan"):
+        stages.update(s for s in _walk(plan, "stage") if isinstance(s, str))
+    stats = list(_walk(explain, "executionStats"))
+    examined = sum(s.get("totalDocsExamined", 0) for s in stats if isinstance(s, dict))
+    returned = sum(s.get("nReturned", 0) for s in stats if isinstance(s, dict))
+    return {
+        "collscan": "COLLSCAN" in stages,
+        "stages": sorted(stages),
+        "docsExamined": examined,
+        "nReturned": returned,
+        "examinedPerReturned": round(examined / returned, 2) if returned else None,
+    }
+
+
+async def _fill_samples(db: AsyncIOMotorDatabase, collection: str, match: Dict[str, Any]) -> Dict[str, Any]:
+    filled = {}
+    for field, value in match.items():
+        if value == SAMPLE:
+            doc = await db[collection].find_one({field: {"$ne": None}}, {field: 1})
+            value = doc.get(field) if doc else None
+        filled[field] = value
+    return filled
+
+
+async def explain_probes(db: AsyncIOMotorDatabase, router: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Explain every registered probe pipeline with ``executionStats``."""
+    report = []
+    for name, probes in probe_pipelines().items():
+        if router and name != router:
+            continue
+        for collection, pipeline in probes:
+            pipeline = [
+                {"$match": await _fill_samples(db, collection, s["$match"])} if "$match" in s else s
+                for s in pipeline
+            ]
+            entry: Dict[str, Any] = {"router": name, "collection": collection, "match": str(pipeline[0].get("$match"))}
+            try:
+                explain = await db.command(
+                    "explain", {"aggregate": collection, "pipeline": pipeline, "cursor": {}}, verbosity="executionStats"
+                )
+                entry.update(summarize_explain(explain))
+            except Exception as e:
+                entry["error"] = str(e)
+            report.append(entry)
+    return report
+
+
+async def _main():
+    from app.db import get_db, close_db
+
+    parser = argparse.ArgumentParser(description="Check, create and explain the indexes the routers rely on")
+    parser.add_argument("--create", action="store_true", help="create missing indexes")
+    parser.add_argument("--explain", action="store_true", help="explain registered pipelines and report COLLSCANs")
+    parser.add_argument("--router", help="limit --explain to one router")
+    args = parser.parse_args()
+
+    db = get_db()
+    if args.create:
+        result = await ensure_indexes(db)
+        for item in result["created"]:
+            print(f"created  {item['collection']} {{{item['keys']}}}")
+        for item in result["failed"]:
+            print(f"FAILED   {item['collection']} {{{item['keys']}}}: {item['error']}")
+    for item in await missing_indexes(db):
+        print(f"missing  {item['collection']} {{{item['keys']}}} ({', '.join(item['routers'])})")
+    if args.explain:
+        for entry in await explain_probes(db, args.router):
+            if "error" in entry:
+                print(f"ERROR    {entry['router']:<24} {entry['collection']}: {entry['error']}")
+                continue
+            flag = "COLLSCAN" if entry["collscan"] else "ok"
+            print(
+                f"{flag:<8} {entry['router']:<24} {entry['collection']:<16} "
+                f"examined={entry['docsExamined']} returned={entry['nReturned']} "
+                f"ratio={entry['examinedPerReturned']} {entry['match']}"
+            )
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,223 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, AsyncIterator, Dict, Optional, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app import background, open_timers, watchers
+from app.open_timers import registry
+from app.responses import dumps
+
+logger = logging.getLogger(__name__)
+
+SSE_MEDIA_TYPE = "text/event-stream"
+WINDOW = timedelta(hours=1)
+PRODUCED = "Unit Created"
+
+_FIELDS = {"locationId": 1, "stopReason": 1, "createdAt": 1, "endedAt": 1}
+
+
+def _push_seconds() -> float:
+    return float(os.getenv("LIVE_PUSH_SECONDS", "1"))
+
+
+def _reseed_seconds() -> float:
+    return float(os.getenv("LIVE_RESEED_SECONDS", "15"))
+
+
+def _heartbeat_seconds() -> float:
+    return float(os.getenv("LIVE_HEARTBEAT_SECONDS", "15"))
+
+
+def _now() -> datetime:
+    # timerlogs dates are naive UTC
+    return datetime.utcnow()
+
+
+class RealTimeStatus:
+    """Units completed in the last hour, for ``/dashboard/real-time-status``.
+
+    Keyed by log ``_id`` so replayed change events are idempotent; entries
+    leave when their ``createdAt`` falls out of the one-hour window. Active
+    timers and alerts come from the open-timer registry.
+    """
+
+    def __init__(self):
+        self.produced: Dict[Any, Tuple[datetime, str, Optional[str]]] = {}
+        self.seeded_at: Optional[float] = None
+        self.version = 0
+
+    def apply(self, _id: Any, doc: Optional[Dict[str, Any]]) -> None:
+        changed = self.produced.pop(_id, None) is not None
+        created = (doc or {}).get("createdAt")
+        if (
+            isinstance(created, datetime)
+            and created >= _now() - WINDOW
+            and doc.get("stopReason") == PRODUCED
+            and isinstance(doc.get("endedAt"), datetime)
+        ):
+            loc = doc.get("locationId")
+            self.produced[_id] = (created, doc["endedAt"].strftime("%H:%M"), str(loc) if loc is not None else None)
+            changed = True
+        if changed:
+            self.version += 1
+
+    def prune(self) -> None:
+        cutoff = _now() - WINDOW
+        stale = [k for k, v in self.produced.items() if v[0] < cutoff]
+        for k in stale:
+            del self.produced[k]
+        if stale:
+            self.version += 1
+
+    async def seed(self, db: AsyncIOMotorDatabase) -> int:
+        """Reload the window with one ``(stopReason, createdAt)`` range scan."""
+        fresh = RealTimeStatus()
+        query = {"stopReason": PRODUCED, "createdAt": {"$gte": _now() - WINDOW}}
+        async for doc in db.timerlogs.find(query, _FIELDS):
+            fresh.apply(doc["_id"], doc)
+        self.produced = fresh.produced
+        self.seeded_at = time.monotonic()
+        self.version += 1
+        return len(self.produced)
+
+    def snapshot(self, location_id: Optional[str] = None) -> Dict[str, Any]:
+        """Same shape as the polled endpoint; alerts also carry ``startTime``."""
+        now = _now()
+        slots: Dict[str, int] = {}
+        for _, minute, loc in self.produced.values():
+            if location_id is None or loc == location_id:
+                slots[minute] = slots.get(minute, 0) + 1
+        times = sorted(slots)[-12:]  # Last 12 time slots
+
+        alerts = registry.ongoing_alerts(location_id)
+        return {
+            "activeTimers": registry.active_timers(location_id),
+            "recentProduction": {"times": times, "counts": [slots[t] for t in times]},
+            "alerts": [
+                {
+                    "machineId": a["machineId"],
+                    "type": a["stopReason"],
+                    "startTime": a["createdAt"],
+                    "duration": int((now - a["createdAt"]).total_seconds() / 60) if a["createdAt"] else None,  # minutes
+                    "location": a["locationId"],
+                }
+                for a in alerts
+            ],
+            "systemStatus": "operational" if len(alerts) < 3 else "warning" if len(alerts) < 6 else "critical",
+        }
+
+
+state = RealTimeStatus()
+
+# One queue per connected dashboard, grouped by location filter
+_subscribers: Dict[Optional[str], Set[asyncio.Queue]] = {}
+_broadcaster: Optional[asyncio.Task] = None
+
+
+def _on_timerlog(event: watchers.Event) -> None:
+    state.apply(event["id"], event["doc"])
+
+
+def live_from_watchers() -> bool:
+    """True when change events keep ``state`` current (inserts and updates)."""
+    return watchers.watchers_enabled() and watchers.stats["timerlogs"]["mode"] == "changeStream"
+
+
+def ready() -> bool:
+    return state.seeded_at is not None and live_from_watchers() and open_timers.ready()
+
+
+def start(db: AsyncIOMotorDatabase) -> None:
+    """Feed ``state`` from the timerlogs watcher, seeded from the last hour."""
+    if not watchers.watchers_enabled():
+        return
+    watchers.subscribe("timerlogs", _on_timerlog)
+    background.start("live", state.seed(db))
+
+
+def _diff(old: Optional[Dict[str, Any]], new: Dict[str, Any]) -> Dict[str, Any]:
+    if old is None:
+        return new
+    return {k: v for k, v in new.items() if old.get(k) != v}
+
+
+async def _broadcast(db: AsyncIOMotorDatabase) -> None:
+    """Compute each location's snapshot once per tick and hand the changed
+    keys to every dashboard watching it."""
+    last: Dict[Optional[str], Dict[str, Any]] = {}
+    seen_version = None
+    seen_minute = None
+    while _subscribers:
+        try:
+            if not live_from_watchers() and (state.seeded_at is None or time.monotonic() - state.seeded_at >= _reseed_seconds()):
+                # Polled or disabled watchers miss endedAt updates: reload the window instead
+                await state.seed(db)
+            state.prune()
+            minute = _now().replace(second=0, microsecond=0)  # alert durations are in minutes
+            version = (state.version, registry.version)
+            if version != seen_version or minute != seen_minute:
+                seen_version, seen_minute = version, minute
+                for gone in [k for k in last if k not in _subscribers]:
+                    del last[gone]
+                for location_id, queues in list(_subscribers.items()):
+                    snap = state.snapshot(location_id)
+                    delta = _diff(last.get(location_id), snap)
+                    last[location_id] = snap
+                    if delta:
+                        for q in list(queues):
+                            _offer(q, ("delta", delta), snap)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("real-time status broadcast failed: %s", e)
+        await asyncio.sleep(_push_seconds())
+
+
+def _offer(q: asyncio.Queue, message: Tuple[str, Dict[str, Any]], snap: Dict[str, Any]) -> None:
+    try:
+        q.put_nowait(message)
+    except asyncio.QueueFull:
+        # A slow client gets the full state instead of an ever-growing backlog
+        while not q.empty():
+            q.get_nowait()
+        q.put_nowait(("snapshot", snap))
+
+
+def _event(name: str, data: Dict[str, Any]) -> bytes:
+    return b"event: " + name.encode() + b"\ndata: " + dumps(data) + b"\n\n"
+
+
+async def events(db: AsyncIOMotorDatabase, location_id: Optional[str] = None) -> AsyncIterator[bytes]:
+    """SSE stream: a ``snapshot`` event, then ``delta`` events with the keys that changed."""
+    global _broadcaster
+    if state.seeded_at is None:
+        await state.seed(db)
+    q: asyncio.Queue = asyncio.Queue(maxsize=32)
+    _subscribers.setdefault(location_id, set()).add(q)
+    if _broadcaster is None or _broadcaster.done():
+        _broadcaster = background.spawn("live-broadcast", _broadcast(db))
+    try:
+        yield b"retry: 3000\n\n" + _event("snapshot", state.snapshot(location_id))
+        while True:
+            try:
+                name, data = await asyncio.wait_for(q.get(), _heartbeat_seconds())
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"
+                continue
+            yield _event(name, data)
+    finally:
+        queues = _subscribers.get(location_id)
+        if queues is not None:
+            queues.discard(q)
+            if not queues:
+                del _subscribers[location_id]
+
+
+def subscriber_count() -> int:
+    return sum(len(qs) for qs in _subscribers.values())
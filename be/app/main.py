@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
@@ -13,7 +15,71 @@ from app.routers.analytics import router as analytics_router
 from app.routers.simple_timerlogs import router as simple_timerlogs_router
 from app.routers.simple_dashboard import router as simple_dashboard_router
 from app.routers.advanced_charts import router as advanced_charts_router
-app = FastAPI(title="APMS Analytics API", version="1.0.1")
+from app.routers.timerlogs import router as timerlogs_router
+from app.routers.timerdailystats import router as timerdailystats_router
+from app.routers.machines import router as machines_router
+from app.routers.comprehensive_dashboard import router as comprehensive_dashboard_router
+from app.routers.ops import router as ops_router
+from app.db import get_db, close_db
+from app import anomalies, background, dailystats, features, hll, indexes, live, open_timers, rollups, sketches, watchers
+from app.compression import CompressionMiddleware
+from app.responses import FastJSONResponse
+
+
+async def _refresh_rollups():
+    db = get_db()
+    await rollups.ensure_rollup_indexes(db)
+    await sketches.ensure_sketch_indexes(db)
+    await hll.ensure_hll_indexes(db)
+    return {
+        **await rollups.refresh_hourly_rollup(db),
+        "sketch": await sketches.refresh_hourly_sketch(db),
+        "hll": await hll.refresh_hll(db),
+    }
+
+
+async def _refresh_dailystats():
+    db = get_db()
+    await dailystats.ensure_daily_indexes(db)
+    return await dailystats.refresh_daily_stats(db)
+
+
+async def _refresh_features():
+    db = get_db()
+    await features.ensure_feature_indexes(db)
+    return await features.refresh_machine_features(db)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    db = get_db()
+    if indexes.bootstrap_enabled():
+        background.start("indexes", indexes.ensure_indexes(db))
+    else:
+        background.start("indexes", indexes.report_missing(db))
+    background.start_periodic("rollups", rollups.refresh_interval(), _refresh_rollups)
+    background.start_periodic("dailystats", dailystats.refresh_interval(), _refresh_dailystats)
+    background.start_periodic("features", features.refresh_interval(), _refresh_features)
+    open_timers.start(db)
+    anomalies.start(db)
+    live.start(db)
+    watchers.start(db)
+    try:
+        yield
+    finally:
+        await background.stop_all()
+        close_db()
+
+
+app = FastAPI(
+    title="APMS Analytics API",
+    version="1.0.1",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
+)
+
+# Inside CORS, so responses served from the response cache still get CORS headers
+app.add_middleware(CompressionMiddleware)
 
 # Allow local FE dev by default
 app.add_middleware(
@@ -25,7 +91,7 @@ app.add_middleware(
 
 
 @app.get("/health")
-def health():
+async def health():
     return {"ok": True}
 
 
@@ -42,3 +108,10 @@ app.include_router(analytics_router)
 app.include_router(simple_timerlogs_router)
 app.include_router(simple_dashboard_router)
 app.include_router(advanced_charts_router)
+app.include_router(timerlogs_router)
+app.include_router(timerdailystats_router)
+app.include_router(machines_router)
+app.include_router(comprehensive_dashboard_router)
+
+# Operational endpoints (cache stats, ...)
+app.include_router(ops_router)
@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app import background, watchers
+
+PRODUCED = "Unit Created"
+
+_FIELDS = {"timerId": 1, "machineId": 1, "locationId": 1, "stopReason": 1, "createdAt": 1}
+
+
+def resync_interval() -> float:
+    """Seconds between full reloads while change events can't keep the registry current."""
+    return float(os.getenv("OPEN_TIMERS_RESYNC_SECONDS", "60"))
+
+
+def reconcile_interval() -> float:
+    """Seconds between full reloads while change events do keep the registry
+    current, so drift from a missed event (lost resume token, failed
+    listener) does not last."""
+    return float(os.getenv("OPEN_TIMERS_RECONCILE_SECONDS", "600"))
+
+
+def _is_downtime(entry: Dict[str, Any]) -> bool:
+    return entry["stopReason"] not in (PRODUCED, None)
+
+
+class OpenTimers:
+    """Open timerlogs (``endedAt`` unset) indexed by timerId and machineId.
+
+    Every index is kept once overall (key None) and once per location, so
+    active timer and in-progress counts are dictionary lookups. Downtime
+    logs are also grouped by machine for the ongoing alerts.
+    """
+
+    def __init__(self):
+        self.logs: Dict[Any, Dict[str, Any]] = {}
+        # location -> timerId -> open logs of that timer
+        self._timers: Dict[Optional[str], Dict[Any, int]] = {}
+        # location -> machineId -> {log _id: entry} for open downtime logs
+        self._downtime: Dict[Optional[str], Dict[Any, Dict[Any, Dict[str, Any]]]] = {}
+        self._counts: Dict[Optional[str], int] = {}
+        self.built_at: Optional[float] = None
+        self.version = 0
+        # Changes seen while a rebuild is reading, replayed onto its result
+        self._replay: Optional[List[Any]] = None
+
+    @staticmethod
+    def _keys(entry: Dict[str, Any]):
+        return (None,) if entry["locationId"] is None else (None, entry["locationId"])
+
+    def _add(self, _id: Any, entry: Dict[str, Any]) -> None:
+        self.logs[_id] = entry
+        for key in self._keys(entry):
+            timers = self._timers.setdefault(key, {})
+            timers[entry["timerId"]] = timers.get(entry["timerId"], 0) + 1
+            self._counts[key] = self._counts.get(key, 0) + 1
+            if _is_downtime(entry):
+                self._downtime.setdefault(key, {}).setdefault(entry["machineId"], {})[_id] = entry
+
+    def _remove(self, _id: Any) -> bool:
+        entry = self.logs.pop(_id, None)
+        if entry is None:
+            return False
+        for key in self._keys(entry):
+            timers = self._timers[key]
+            timers[entry["timerId"]] -= 1
+            if not timers[entry["timerId"]]:
+                del timers[entry["timerId"]]
+            self._counts[key] -= 1
+            if _is_downtime(entry):
+                machines = self._downtime[key]
+                machines[entry["machineId"]].pop(_id, None)
+                if not machines[entry["machineId"]]:
+                    del machines[entry["machineId"]]
+        return True
+
+    def apply(self, _id: Any, doc: Optional[Dict[str, Any]]) -> None:
+        """Track a change to one timerlog; ``doc`` is None for deletes."""
+        if self._replay is not None:
+            self._replay.append((_id, doc))
+        changed = self._remove(_id)
+        if doc is not None and doc.get("endedAt") is None:
+            loc = doc.get("locationId")
+            self._add(_id, {
+                "timerId": doc.get("timerId"),
+                "machineId": doc.get("machineId"),
+                "locationId": str(loc) if loc is not None else None,
+                "stopReason": doc.get("stopReason"),
+                "createdAt": doc.get("createdAt"),
+            })
+            changed = True
+        if changed:
+            self.version += 1
+
+    async def rebuild(self, db: AsyncIOMotorDatabase) -> int:
+        """Reload from one ``{endedAt: null}`` query on the ``endedAt`` index."""
+        fresh = OpenTimers()
+        self._replay = []
+        try:
+            async for doc in db.timerlogs.find({"endedAt": None}, _FIELDS):
+                fresh.apply(doc["_id"], doc)
+            for _id, doc in self._replay:
+                fresh.apply(_id, doc)
+        finally:
+            self._replay = None
+        self.logs, self._timers, self._downtime, self._counts = fresh.logs, fresh._timers, fresh._downtime, fresh._counts
+        self.built_at = time.monotonic()
+        self.version += 1
+        return len(self.logs)
+
+    def active_timers(self, location_id: Optional[str] = None) -> int:
+        return len(self._timers.get(location_id, ()))
+
+    def in_progress(self, location_id: Optional[str] = None) -> int:
+        return self._counts.get(location_id, 0)
+
+    def ongoing_alerts(self, location_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Longest-running open downtime log per machine, oldest first."""
+        alerts = []
+        for machine_id, logs in self._downtime.get(location_id, {}).items():
+            first = min(logs.values(), key=lambda e: e["createdAt"] or datetime.max)
+            alerts.append({"machineId": machine_id, **first})
+        alerts.sort(key=lambda e: e["createdAt"] or datetime.max)
+        return alerts
+
+
+registry = OpenTimers()
+
+
+def ready() -> bool:
+    """Built, and kept current by change events or a recent enough reload."""
+    if registry.built_at is None:
+        return False
+    if watchers.watchers_enabled() and watchers.stats["timerlogs"]["mode"] == "changeStream":
+        return True
+    return time.monotonic() - registry.built_at <= 2 * resync_interval()
+
+
+def _on_timerlog(event: watchers.Event) -> None:
+    registry.apply(event["id"], event["doc"])
+
+
+async def _maintain(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    if (
+        registry.built_at is not None
+        and watchers.stats["timerlogs"]["mode"] == "changeStream"
+        and time.monotonic() - registry.built_at < reconcile_interval()
+    ):
+        return {"open": len(registry.logs), "source": "changeStream"}
+    return {"open": await registry.rebuild(db), "source": "reload"}
+
+
+def start(db: AsyncIOMotorDatabase) -> None:
+    """Build the registry now; change events keep it current, otherwise it is
+    reloaded every ``OPEN_TIMERS_RESYNC_SECONDS``. With change events it is
+    still reloaded every ``OPEN_TIMERS_RECONCILE_SECONDS``."""
+    if watchers.watchers_enabled():
+        watchers.subscribe("timerlogs", _on_timerlog)
+    background.start_periodic("open-timers", resync_interval(), lambda: _maintain(db))
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app import open_timers
+from app.db import aggregate
+from app.hll import HLL, unique_counts
+from app.rollups import HOURLY, rollup_available
+
+# Every KPI facet yields [{"n": value}] (or [] when nothing matched)
+_COUNT = [{"$count": "n"}]
+_ROLLUP_SUM = [{"$group": {"_id": None, "n": {"$sum": "$count"}}}]
+_STARTS = {"stopReason": {"$in": ["Started", "Auto-Start"]}}
+_PRODUCED = {"stopReason": "Unit Created"}
+_DOWNTIME = {"stopReason": {"$nin": ["Unit Created", None]}}
+
+
+def _distinct_count(field: str) -> List[Dict[str, Any]]:
+    # Missing and null values are not a distinct value, as with distinct()
+    return [{"$match": {field: {"$ne": None}}}, {"$group": {"_id": f"${field}"}}, *_COUNT]
+
+
+# name -> (facet over timerlogs, facet over the hourly rollup or None if it can't answer)
+TIMERLOG_FACETS: Dict[str, Tuple[List[Dict[str, Any]], Optional[List[Dict[str, Any]]]]] = {
+    "totalLogs": (_COUNT, _ROLLUP_SUM),
+    "produced": ([{"$match": _PRODUCED}, *_COUNT], [{"$match": _PRODUCED}, *_ROLLUP_SUM]),
+    "downtime": ([{"$match": _DOWNTIME}, *_COUNT], [{"$match": _DOWNTIME}, *_ROLLUP_SUM]),
+    "starts": ([{"$match": _STARTS}, *_COUNT], [{"$match": _STARTS}, *_ROLLUP_SUM]),
+    "locations": (_distinct_count("locationId"), _distinct_count("locationId")),
+    "timers": (_distinct_count("timerId"), _distinct_count("timerId")),
+    "machines": (_distinct_count("machineId"), _distinct_count("machineId")),
+    # Open timers and the cycle field are not part of the rollup
+    "inProgress": ([{"$match": {"endedAt": None}}, *_COUNT], None),
+    "avgCycle": (
+        [{"$match": {"cycle": {"$exists": True, "$gt": 0}}},
+         {"$group": {"_id": None, "n": {"$avg": "$cycle"}}}],
+        None,
+    ),
+}
+
+# Distinct-count KPIs the HyperLogLog sketches can answer (same keys as unique_counts())
+APPROX_KPIS = ("locations", "timers", "machines")
+
+MACHINE_FACETS: Dict[str, List[Dict[str, Any]]] = {
+    "total": _COUNT,
+    "active": [{"$match": {"status": "active"}}, *_COUNT],
+}
+
+
+def _unpack(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: (values[0]["n"] if values else None) for name, values in row.items()}
+
+
+def _facet_timings(explain: Dict[str, Any]) -> Dict[str, Optional[int]]:
+    """Best-effort per-facet ``executionTimeMillisEstimate`` from explain output."""
+    timings: Dict[str, Optional[int]] = {}
+    for stage in explain.get("stages", []):
+        facet = stage.get("$facet")
+        if not isinstance(facet, dict):
+            continue
+        for name, sub in facet.items():
+            estimates = [s.get("executionTimeMillisEstimate") for s in sub if isinstance(s, dict)]
+            estimates = [e for e in estimates if e is not None]
+            timings[name] = max(estimates) if estimates else None
+    return timings
+
+
+async def _run_facets(
+    db: AsyncIOMotorDatabase,
+    collection: str,
+    facets: Dict[str, List[Dict[str, Any]]],
+    timings: Dict[str, Any],
+    profile: bool,
+) -> Dict[str, Any]:
+    if not facets:
+        return {}
+    pipeline = [{"$facet": facets}]
+    t0 = time.perf_counter()
+    rows = await aggregate(db[collection], pipeline)
+    timings[collection] = round((time.perf_counter() - t0) * 1000, 2)
+    if profile:
+        explain = await db.command(
+            "explain", {"aggregate": collection, "pipeline": pipeline, "cursor": {}}, verbosity="executionStats"
+        )
+        timings.setdefault("facets", {}).update(
+            {f"{collection}.{k}": v for k, v in _facet_timings(explain).items()}
+        )
+    return _unpack(rows[0]) if rows else {name: None for name in facets}
+
+
+async def compute_kpis(
+    db: AsyncIOMotorDatabase,
+    timerlog_kpis: Iterable[str],
+    machine_kpis: Iterable[str] = (),
+    profile: bool = False,
+    approx: bool = False,
+) -> Dict[str, Any]:
+    """Compute overview KPIs with one ``$facet`` pass per collection.
+
+    Timerlog KPIs the hourly rollup can answer are read from it when it is
+    fresh, and ``inProgress`` from the open-timer registry when it is
+    ready, and with ``approx`` the distinct counts from the HyperLogLog
+    sketches; the rest share one pass over ``timerlogs``. Passes run
+    concurrently and their wall times are reported in ``timings``; with
+    ``profile`` the per-facet estimates from ``explain`` are added.
+    """
+    names = list(timerlog_kpis)
+    use_rollup = await rollup_available(db)
+    raw: Dict[str, List[Dict[str, Any]]] = {}
+    rolled: Dict[str, List[Dict[str, Any]]] = {}
+    registry: Dict[str, Any] = {}
+    if "inProgress" in names and open_timers.ready():
+        registry["inProgress"] = open_timers.registry.in_progress()
+        names.remove("inProgress")
+    approximate: Dict[str, Any] = {}
+    wanted = [n for n in names if n in APPROX_KPIS]
+    if approx and wanted and await rollup_available(db, HLL):
+        counts = (await unique_counts(db)).get(None, {})
+        for name in wanted:
+            approximate[name] = counts.get(name, 0)
+            names.remove(name)
+    for name in names:
+        raw_facet, rollup_facet = TIMERLOG_FACETS[name]
+        if use_rollup and rollup_facet is not None:
+            rolled[name] = rollup_facet
+        else:
+            raw[name] = raw_facet
+
+    timings: Dict[str, Any] = {}
+    results = await asyncio.gather(
+        _run_facets(db, "timerlogs", raw, timings, profile),
+        _run_facets(db, HOURLY, rolled, timings, profile),
+        _run_facets(db, "machines", {k: MACHINE_FACETS[k] for k in machine_kpis}, timings, profile),
+    )
+    return {
+        "timerlogs": {**results[0], **results[1], **registry, **approximate},
+        "machines": results[2],
+        "source": {**{k: "timerlogs" for k in raw}, **{k: HOURLY for k in rolled}, **{k: "open_timers" for k in registry}, **{k: HLL for k in approximate}},
+        "timings": timings,
+    }
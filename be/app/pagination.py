@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import base64
+import hashlib
+import json
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from fastapi.responses import JSONResponse
+
+
+class CursorError(ValueError):
+    """The continuation token is malformed or belongs to a different query."""
+
+
+def fingerprint(**params: Any) -> str:
+    """Short digest of the filters a cursor is valid for."""
+    raw = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.sha1(raw).hexdigest()[:12]
+
+
+def encode_cursor(source: str, value: Any, _id: Any, query: str) -> str:
+    """Opaque token for the page after (``value``, ``_id``) in ``source``."""
+    payload = {
+        "s": source,
+        "v": value.isoformat() if isinstance(value, datetime) else value,
+        "d": isinstance(value, datetime),
+        "i": str(_id),
+        "o": isinstance(_id, ObjectId),
+        "q": query,
+    }
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(token: str, query: str) -> Tuple[str, Any, Any]:
+    """(source, sort value, ``_id``) of the last row of the previous page."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+        payload = json.loads(raw)
+        value = datetime.fromisoformat(payload["v"]) if payload["d"] else payload["v"]
+        _id = ObjectId(payload["i"]) if payload["o"] else payload["i"]
+        source = payload["s"]
+    except (ValueError, KeyError, TypeError, InvalidId):
+        raise CursorError("cursor is not a valid continuation token")
+    if payload.get("q") != query:
+        raise CursorError("cursor was issued for different filters")
+    return source, value, _id
+
+
+def after(field: str, value: Any, _id: Any) -> Dict[str, Any]:
+    """Rows strictly after (``value``, ``_id``) in ``(field, _id)`` order."""
+    return {"$or": [{field: {"$gt": value}}, {field: value, "_id": {"$gt": _id}}]}
+
+
+def keyset_match(match: Dict[str, Any], field: str, position: Optional[Tuple[Any, Any]]) -> Dict[str, Any]:
+    """``match`` restricted to rows after ``position`` (all rows when None).
+
+    Rows whose ``field`` is missing, null or not a date are left out: they
+    sort before every date, so a page ending on one could not be continued.
+    """
+    match = {**match, field: {**match.get(field, {}), "$type": "date"}}
+    if position is None:
+        return match
+    return {"$and": [match, after(field, *position)]}
+
+
+def sort_keys(field: str) -> List[Tuple[str, int]]:
+    return [(field, 1), ("_id", 1)]
+
+
+def bad_cursor(e: CursorError) -> JSONResponse:
+    return JSONResponse(status_code=400, content={"error": str(e)})
+
+
+class Page:
+    """Collects the next-page token while a page is produced or streamed."""
+
+    def __init__(self):
+        self.next_cursor: Optional[str] = None
+
+    async def with_trailer(self, items: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """``items`` followed by ``{"nextCursor": ...}`` when there is a next page
+        (for NDJSON, where the token is only known at the end)."""
+        async for item in items:
+            yield item
+        if self.next_cursor:
+            yield {"nextCursor": self.next_cursor}
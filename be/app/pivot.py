@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+Cell = Tuple[Hashable, Hashable]
+
+
+def _identity(record: Any) -> Any:
+    return record
+
+
+def index_cells(
+    records: Iterable[Any],
+    key: Callable[[Any], Cell],
+    value: Callable[[Any], Any] = _identity,
+    combine: Optional[Callable[[Any, Any], Any]] = None,
+) -> Dict[Cell, Any]:
+    """Index aggregation rows by (row, column) in a single pass.
+
+    The first record for a cell wins, like ``next(r for r in rows if ...)``,
+    unless ``combine`` is given to fold duplicates (e.g. ``operator.add``).
+    """
+    cells: Dict[Cell, Any] = {}
+    for record in records:
+        k = key(record)
+        if k in cells:
+            if combine is not None:
+                cells[k] = combine(cells[k], value(record))
+        else:
+            cells[k] = value(record)
+    return cells
+
+
+def series_by_column(
+    cells: Dict[Cell, Any],
+    rows: Sequence[Hashable],
+    columns: Sequence[Hashable],
+    fill: Any = 0,
+) -> Dict[Hashable, List[Any]]:
+    """Dense ``{column: [value per row]}`` with ``fill`` for empty cells."""
+    get = cells.get
+    return {c: [get((r, c), fill) for r in rows] for c in columns}
+
+
+def heatmap_triples(
+    cells: Dict[Cell, Any],
+    xs: Sequence[Hashable],
+    ys: Sequence[Hashable],
+    fill: Any = 0,
+) -> List[List[Any]]:
+    """ECharts heatmap ``[x index, y index, value]`` for every x/y pair."""
+    get = cells.get
+    return [[i, j, get((x, y), fill)] for i, x in enumerate(xs) for j, y in enumerate(ys)]
@@ -0,0 +1,515 @@
+from __future__ import annotations
+
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.indexes import existing_indexes, summarize_explain
+from app.rollups import HOURLY, ROLLUP_KEYS, avg_of, rollup_available, window_match
+from app.sketches import SKETCH, SKETCH_FIELDS, bucket_key, merge_pipeline, quantiles
+
+DURATION = "durationSec"
+PERCENTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+OPS = ("sum", "avg", "min", "max", "count", *PERCENTILES)
+BUCKETS = {"hour": "%Y-%m-%d %H:00", "day": "%Y-%m-%d", "month": "%Y-%m"}
+
+
+class QueryError(ValueError):
+    """The payload does not fit the collection's schema."""
+
+
+class Schema:
+    """What an analytics query may reference in one collection.
+
+    ``duration`` is the (start, end) pair of date fields behind the derived
+    ``durationSec`` measure, if the collection has one.
+    """
+
+    def __init__(
+        self,
+        time_fields: Sequence[str],
+        dimensions: Sequence[str],
+        measures: Sequence[str] = (),
+        duration: Optional[Tuple[str, str]] = None,
+    ):
+        self.time_fields = tuple(time_fields)
+        self.dimensions = tuple(dimensions)
+        self.measures = tuple(measures) + ((DURATION,) if duration else ())
+        self.duration = duration
+
+
+_TIMERLOG = Schema(
+    time_fields=("createdAt", "endedAt"),
+    dimensions=("locationId", "machineId", "machineClassId", "timerId", "stopReason"),
+    measures=("cycle",),
+    duration=("createdAt", "endedAt"),
+)
+
+SCHEMAS: Dict[str, Schema] = {
+    "timerlogs": _TIMERLOG,
+    "timerloghistories": _TIMERLOG,
+    "controllertimers": _TIMERLOG,
+    "counts": Schema(("startAt", "createdAt"), ("locationId", "machineId", "timerId"), ("tons",)),
+    "cycletimers": Schema(
+        ("clientStartedAt", "endAt", "createdAt"),
+        ("locationId", "machineId", "timerId"),
+        duration=("clientStartedAt", "endAt"),
+    ),
+    "timerdailystats": Schema(
+        ("date", "createdAt"),
+        ("locationId", "machineId", "machineClassId", "timerId"),
+        ("logs", "totalProduced", "totalRuntime", "totalDowntime",
+         "availability", "efficiency", "performance", "quality", "oee"),
+    ),
+}
+
+
+def _max_limit() -> int:
+    return int(os.getenv("ANALYTICS_MAX_LIMIT", "10000"))
+
+
+def _parse_dt(name: str, value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value))
+    except ValueError:
+        raise QueryError(f"filters.{name} is not an ISO date: {value!r}")
+
+
+def _one_of(name: str, value: Any, allowed: Sequence[str]) -> str:
+    if value not in allowed:
+        raise QueryError(f"{name} must be one of {', '.join(allowed)}; got {value!r}")
+    return value
+
+
+def _of_type(name: str, value: Any, kind: type, what: str) -> Any:
+    if not isinstance(value, kind):
+        raise QueryError(f"{name} must be {what}; got {value!r}")
+    return value
+
+
+_SCALARS = (str, int, float, bool)
+
+
+def _filter_value(name: str, value: Any) -> Any:
+    """A dimension filter: one scalar (equality) or a list of scalars (``$in``).
+
+    Objects are rejected so that no operator (``$where``, ``$ne``, ...)
+    reaches the ``$match``.
+    """
+    if isinstance(value, list):
+        if not all(isinstance(v, _SCALARS) for v in value):
+            raise QueryError(f"filters.{name} must be a value or a list of values")
+        return {"$in": value}
+    if not isinstance(value, _SCALARS):
+        raise QueryError(f"filters.{name} must be a value or a list of values")
+    return value
+
+
+class Metric:
+    def __init__(self, op: str, field: Optional[str], alias: str):
+        self.op = op
+        self.field = field
+        self.alias = alias
+
+
+class QueryPlan:
+    """A validated analytics query: ``$match`` first, then a ``$project`` of
+    the referenced fields, ``$group``, ``$sort`` and ``$limit``."""
+
+    def __init__(self, collection: str, schema: Schema):
+        self.collection = collection
+        self.schema = schema
+        self.match: Dict[str, Any] = {}
+        self.time_field: str = "createdAt"
+        self.range_field: Optional[str] = None
+        self.time_bucket: str = ""
+        self.bucket_field: str = "createdAt"
+        self.cats: List[str] = []
+        self.metrics: List[Metric] = []
+        self.sort: Optional[Tuple[str, int]] = None
+        self.limit: int = 200
+        self.hint: Optional[List[Tuple[str, int]]] = None
+        self.source = collection
+        self.dt_from: Optional[datetime] = None
+        self.dt_to: Optional[datetime] = None
+        # Percentiles counted into sketch buckets from the raw documents (no $percentile)
+        self.sketch_raw = False
+
+    @property
+    def from_rollup(self) -> bool:
+        return self.source in (HOURLY, SKETCH)
+
+    @property
+    def from_sketch(self) -> bool:
+        return self.source == SKETCH or self.sketch_raw
+
+    @property
+    def columns(self) -> List[str]:
+        return ["t", *self.cats, *[m.alias for m in self.metrics]]
+
+    def projection(self) -> Dict[str, Any]:
+        fields: Dict[str, Any] = {"_id": 0}
+        if self.time_bucket:
+            fields[self.bucket_field] = 1
+        for c in self.cats:
+            fields[c] = 1
+        for m in self.metrics:
+            if m.op == "count":
+                continue
+            if m.field == DURATION:
+                start, end = self.schema.duration
+                fields["__durationSec"] = {"$cond": [
+                    {"$and": [{"$ne": [f"${end}", None]}, {"$ne": [f"${start}", None]}]},
+                    {"$divide": [{"$subtract": [f"${end}", f"${start}"]}, 1000]},
+                    None,
+                ]}
+            else:
+                fields[m.field] = 1
+        return fields
+
+    def accumulators(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """``$group`` accumulators over raw documents, and the ``$set`` that
+        unwraps percentiles (``$percentile`` returns an array)."""
+        accum: Dict[str, Any] = {}
+        finish: Dict[str, Any] = {}
+        for m in self.metrics:
+            src = "$__durationSec" if m.field == DURATION else f"${m.field}"
+            if m.op == "sum":
+                accum[m.alias] = {"$sum": {"$ifNull": [src, 0]}}
+            elif m.op == "count":
+                accum[m.alias] = {"$sum": 1}
+            elif m.op in PERCENTILES:
+                accum[m.alias] = {"$percentile": {"input": src, "p": [PERCENTILES[m.op]], "method": "approximate"}}
+                finish[m.alias] = {"$arrayElemAt": [f"${m.alias}", 0]}
+            else:
+                accum[m.alias] = {f"${m.op}": src}
+        return accum, finish
+
+    def rollup_accumulators(self) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """``$group`` accumulators over ``HOURLY`` rows, and the ``$set`` that
+        finishes averages (durations are stored in ms)."""
+        accum: Dict[str, Any] = {}
+        finish: Dict[str, Any] = {}
+        for m in self.metrics:
+            if m.op == "count":
+                accum[m.alias] = {"$sum": "$count"}
+            elif m.op == "avg":
+                accum[f"{m.alias}__sum"] = {"$sum": "$durSum"}
+                accum[f"{m.alias}__n"] = {"$sum": "$durCount"}
+                finish[m.alias] = {"$divide": [avg_of(f"{m.alias}__sum", f"{m.alias}__n"), 1000]}
+            else:
+                src = {"sum": "$durSum", "min": "$durMin", "max": "$durMax"}[m.op]
+                accum[m.alias] = {f"${m.op}": {"$divide": [src, 1000]}}
+        return accum, finish
+
+    def group_id(self) -> Dict[str, Any]:
+        group_id: Dict[str, Any] = {}
+        if self.time_bucket:
+            date = "$h" if self.from_rollup else f"${self.bucket_field}"
+            group_id["t"] = {"$dateToString": {"format": BUCKETS[self.time_bucket], "date": date}}
+        for c in self.cats:
+            group_id[c] = f"${c}"
+        return group_id
+
+    def raw_sketch_pipeline(self) -> List[Dict[str, Any]]:
+        """Count the raw values of each percentile field per group and sketch
+        bucket, like ``merge_pipeline`` over ``SKETCH`` rows."""
+        fields = sorted({m.field for m in self.metrics})
+        pipeline: List[Dict[str, Any]] = [{"$match": self.match}] if self.match else []
+        return pipeline + [
+            {"$project": self.projection()},
+            {"$addFields": {"__v": [
+                {"f": f, "x": "$__durationSec" if f == DURATION else f"${f}"} for f in fields
+            ]}},
+            {"$unwind": "$__v"},
+            {"$match": {"__v.x": {"$type": "number"}}},
+            {"$group": {"_id": {**self.group_id(), "f": "$__v.f", "k": bucket_key("$__v.x")}, "n": {"$sum": 1}}},
+        ]
+
+    def pipeline(self) -> List[Dict[str, Any]]:
+        if self.sketch_raw:
+            return self.raw_sketch_pipeline()
+        if self.from_sketch:
+            # Sorting and the limit apply after merge_sketches()
+            return merge_pipeline(self.match, self.group_id())
+
+        pipeline: List[Dict[str, Any]] = []
+        if self.match:
+            pipeline.append({"$match": self.match})
+        if not self.from_rollup:
+            pipeline.append({"$project": self.projection()})
+
+        group_id = self.group_id()
+        accum, finish = self.rollup_accumulators() if self.from_rollup else self.accumulators()
+        if group_id or accum:
+            pipeline.append({"$group": {"_id": group_id or None, **accum}})
+        if finish:
+            pipeline.append({"$set": finish})
+            if self.from_rollup:
+                pipeline.append({"$unset": [f"{a}__{part}" for a in finish for part in ("sum", "n")]})
+
+        if self.sort:
+            pipeline.append({"$sort": {self.sort[0]: self.sort[1]}})
+        elif self.time_bucket:
+            pipeline.append({"$sort": {"_id.t": 1}})
+        pipeline.append({"$limit": self.limit})
+        return pipeline
+
+    def merge_sketches(self, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Fold per-bucket rows from the sketch pipeline into one row per group,
+        with each percentile metric read off its field's merged sketch."""
+        groups: Dict[Tuple[Any, ...], Dict[str, Any]] = {}
+        for r in rows:
+            rid = r["_id"]
+            key = tuple(rid.get(c) for c in ("t", *self.cats))
+            group = groups.setdefault(key, {"_id": {c: rid.get(c) for c in ("t", *self.cats)}, "sketches": {}})
+            group["sketches"].setdefault(rid["f"], []).append((rid.get("k"), r["n"]))
+
+        out = []
+        for group in groups.values():
+            row = {"_id": group["_id"]}
+            for m in self.metrics:
+                row[m.alias] = quantiles(group["sketches"].get(m.field, []), [PERCENTILES[m.op]])[0]
+            out.append(row)
+
+        if self.sort or self.time_bucket:
+            path, order = self.sort or ("_id.t", 1)
+
+            def value(row: Dict[str, Any]) -> Any:
+                return row["_id"].get(path[4:]) if path.startswith("_id.") else row.get(path)
+
+            present = [r for r in out if value(r) is not None]
+            present.sort(key=value, reverse=order < 0)
+            out = present + [r for r in out if value(r) is None]
+        return out[:self.limit]
+
+    def options(self) -> Dict[str, Any]:
+        return {"hint": self.hint} if self.hint else {}
+
+    def to_row(self, r: Dict[str, Any]) -> List[Any]:
+        rid = r.get("_id") or {}
+        row = [rid.get("t")]
+        for c in self.cats:
+            row.append(rid.get(c))
+        for m in self.metrics:
+            val = r.get(m.alias)
+            row.append(float(val) if isinstance(val, (int, float)) else val)
+        return row
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "collection": self.source,
+            "source": "rollup" if self.from_rollup else "raw",
+            "pipeline": self.pipeline(),
+            "hint": [list(k) for k in self.hint] if self.hint else None,
+            "columns": self.columns,
+        }
+
+
+def compile_query(payload: Dict[str, Any]) -> QueryPlan:
+    """Validate an ``/v1/analytics/query`` payload and build its plan.
+
+    Raises ``QueryError`` for unknown collections, fields, operators,
+    buckets and sort keys, for filter values that are not plain values, and
+    for payload pieces of the wrong type.
+    """
+    collection = payload.get("collection")
+    schema = SCHEMAS.get(collection) if isinstance(collection, str) else None
+    if schema is None:
+        raise QueryError(f"collection must be one of {', '.join(SCHEMAS)}; got {collection!r}")
+    plan = QueryPlan(collection, schema)
+    filters = _of_type("filters", payload.get("filters", {}) or {}, dict, "an object")
+    group = _of_type("group", payload.get("group", {}) or {}, dict, "an object")
+
+    for k, v in filters.items():
+        if k in ("from", "to", "timeField") or v is None or v == "":
+            continue
+        _one_of(f"filters.{k}", k, schema.dimensions)
+        plan.match[k] = _filter_value(k, v)
+
+    plan.time_field = _one_of(
+        "filters.timeField", filters.get("timeField") or group.get("timeField") or schema.time_fields[0], schema.time_fields
+    )
+    dt_from = plan.dt_from = _parse_dt("from", filters.get("from"))
+    dt_to = plan.dt_to = _parse_dt("to", filters.get("to"))
+    if dt_from or dt_to:
+        window: Dict[str, Any] = {}
+        if dt_from:
+            window["$gte"] = dt_from
+        if dt_to:
+            window["$lte"] = dt_to
+        plan.match[plan.time_field] = window
+        plan.range_field = plan.time_field
+
+    bucket = _of_type("group.timeBucket", group.get("timeBucket") or "", str, "a string").lower()
+    if bucket:
+        plan.time_bucket = _one_of("group.timeBucket", bucket, tuple(BUCKETS))
+        plan.bucket_field = _one_of("group.timeField", group.get("timeField") or plan.time_field, schema.time_fields)
+    for b in _of_type("group.by", group.get("by", []) or [], list, "a list"):
+        plan.cats.append(_one_of("group.by", b, schema.dimensions))
+
+    taken = {"t", *plan.cats}
+    for m in _of_type("metrics", payload.get("metrics", []) or [], list, "a list"):
+        _of_type("metrics entry", m, dict, "an object")
+        op = _one_of("metrics.op", _of_type("metrics.op", m.get("op") or "", str, "a string").lower(), OPS)
+        field = m.get("field")
+        if op != "count":
+            _one_of(f"metrics.field for {op}", field, schema.measures)
+        alias = _of_type("metrics.as", m.get("as") or f"{op}_{field}", str, "a string")
+        if alias in taken or alias.startswith("$") or "." in alias:
+            raise QueryError(f"metrics.as {alias!r} is reserved, repeated or not a plain name")
+        taken.add(alias)
+        plan.metrics.append(Metric(op, field, alias))
+
+    sort = _of_type("sort", payload.get("sort") or {}, dict, "an object")
+    if sort.get("by"):
+        key = _one_of("sort.by", sort["by"], plan.columns)
+        order = sort.get("order", -1)
+        if isinstance(order, bool) or order not in (1, -1):
+            raise QueryError(f"sort.order must be 1 or -1; got {order}")
+        plan.sort = (key if key in {m.alias for m in plan.metrics} else f"_id.{key}", order)
+
+    try:
+        limit = int(payload.get("limit", 200) or 200)
+    except (TypeError, ValueError):
+        raise QueryError(f"limit must be an integer; got {payload.get('limit')!r}")
+    if not 0 < limit <= _max_limit():
+        raise QueryError(f"limit must be between 1 and {_max_limit()}; got {limit}")
+    plan.limit = limit
+    return plan
+
+
+def _rollup_window(plan: QueryPlan) -> Optional[Dict[str, Any]]:
+    """The rollup match equivalent to the plan's, or None when no rollup can answer it.
+
+    Both rollups are keyed by the hour of ``createdAt`` and ``ROLLUP_KEYS``,
+    so filters and group-by fields must stay within those, and the window
+    must fall on hours.
+    """
+    if plan.collection != "timerlogs":
+        return None
+    if plan.range_field not in (None, "createdAt") or (plan.time_bucket and plan.bucket_field != "createdAt"):
+        return None
+    filters = {k: v for k, v in plan.match.items() if k != plan.range_field}
+    if any(k not in ROLLUP_KEYS for k in [*filters, *plan.cats]):
+        return None
+    if plan.range_field is None:
+        return filters
+    window = window_match(plan.dt_from, plan.dt_to)
+    return None if window is None else {**window, **filters}
+
+
+def _rollup_for(plan: QueryPlan) -> Optional[str]:
+    """``HOURLY`` keeps count plus duration sum/count/min/max; ``SKETCH`` keeps
+    the cycle and duration distributions, for plans made of percentiles only."""
+    if all(m.op in PERCENTILES and m.field in SKETCH_FIELDS for m in plan.metrics) and plan.metrics:
+        return SKETCH
+    if all(m.op == "count" or (m.op not in PERCENTILES and m.field == DURATION) for m in plan.metrics):
+        return HOURLY
+    return None
+
+
+async def route_to_rollup(db: AsyncIOMotorDatabase, plan: QueryPlan) -> bool:
+    """Rewrite the plan to read ``HOURLY`` or ``SKETCH`` when it can and that rollup is fresh."""
+    rollup = _rollup_for(plan)
+    match = _rollup_window(plan) if rollup else None
+    if match is None or not await rollup_available(db, rollup):
+        return False
+    if rollup == SKETCH:
+        match["f"] = {"$in": sorted({m.field for m in plan.metrics})}
+    plan.source = rollup
+    plan.match = match
+    plan.range_field = "h" if "h" in match else None
+    return True
+
+
+_server_version: Optional[Tuple[int, ...]] = None
+
+
+async def percentile_supported(db: AsyncIOMotorDatabase) -> bool:
+    """``$percentile`` needs MongoDB 7.0 or later."""
+    global _server_version
+    if _server_version is None:
+        info = await db.client.server_info()
+        _server_version = tuple(info.get("versionArray") or (0,))
+    return _server_version >= (7, 0)
+
+
+async def fit_percentiles(db: AsyncIOMotorDatabase, plan: QueryPlan) -> None:
+    """On servers without ``$percentile``, count raw percentile-only plans into
+    sketch buckets instead (same 1% accuracy as ``SKETCH``).
+
+    Checked before running, so streamed responses never fail after their
+    headers are sent. Raises ``QueryError`` when such a plan also has other
+    metrics.
+    """
+    if plan.from_rollup or not any(m.op in PERCENTILES for m in plan.metrics):
+        return
+    if await percentile_supported(db):
+        return
+    if not all(m.op in PERCENTILES for m in plan.metrics):
+        raise QueryError("this MongoDB server has no $percentile (7.0+): query percentiles without other metrics")
+    plan.sketch_raw = True
+
+
+_index_cache: Dict[str, Tuple[float, List[Tuple[Tuple[str, int], ...]]]] = {}
+
+
+async def _indexes(db: AsyncIOMotorDatabase, collection: str) -> List[Tuple[Tuple[str, int], ...]]:
+    cached = _index_cache.get(collection)
+    if cached is None or time.monotonic() - cached[0] > 300:
+        cached = _index_cache[collection] = (time.monotonic(), await existing_indexes(db, collection))
+    return cached[1]
+
+
+def _index_score(keys: Tuple[Tuple[str, int], ...], equality: set, range_field: Optional[str]) -> int:
+    """Equality keys first, then the range key (ESR); 0 when the index can't bound the scan."""
+    score = 0
+    for field, _ in keys:
+        if field in equality:
+            score += 2
+            continue
+        if field == range_field:
+            score += 1
+        break
+    return score
+
+
+async def choose_hint(db: AsyncIOMotorDatabase, plan: QueryPlan) -> None:
+    """Hint the existing index that covers the most leading ``$match`` fields."""
+    equality = {k for k in plan.match if k != plan.range_field}
+    best, best_score = None, 0
+    for keys in await _indexes(db, plan.source):
+        score = _index_score(keys, equality, plan.range_field)
+        if score > best_score or (score == best_score and best is not None and len(keys) < len(best)):
+            best, best_score = keys, score
+    plan.hint = [tuple(k) for k in best] if best else None
+
+
+async def estimate_cost(db: AsyncIOMotorDatabase, plan: QueryPlan) -> Dict[str, Any]:
+    """Planner-only explain plus document counts; the aggregation itself is not run."""
+    coll = db[plan.source]
+    command: Dict[str, Any] = {"aggregate": plan.source, "pipeline": plan.pipeline(), "cursor": {}}
+    if plan.hint:
+        command["hint"] = dict(plan.hint)
+    explain = await db.command("explain", command, verbosity="queryPlanner")
+    summary = summarize_explain(explain)
+    total = await coll.estimated_document_count()
+    try:
+        matched = await coll.count_documents(plan.match, maxTimeMS=2000, **plan.options())
+    except Exception:
+        matched = None  # too expensive to count within the time limit
+    scanned = total if summary["collscan"] else matched
+    return {
+        "stages": summary["stages"],
+        "collscan": summary["collscan"],
+        "collectionDocs": total,
+        "matchedDocs": matched,
+        "selectivity": round(matched / total, 4) if matched is not None and total else None,
+        "estimatedDocsScanned": scanned,
+    }
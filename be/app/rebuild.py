@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+# (bucket starts, build time) -> timerlogs pipeline ending in a $merge
+Build = Callable[[List[datetime], datetime], List[Dict[str, Any]]]
+
+
+def bucket_ranges(starts: List[datetime], width: timedelta) -> List[Dict[str, Any]]:
+    return [{"createdAt": {"$gte": s, "$lt": s + width}} for s in starts]
+
+
+async def touched(db: AsyncIOMotorDatabase, filters: List[Dict[str, Any]], bucket: Dict[str, Any]) -> List[datetime]:
+    """Distinct ``bucket`` values (a ``createdAt`` expression) of the logs matching any of ``filters``."""
+    if not filters:
+        return []
+    rows = await db.timerlogs.aggregate([
+        {"$match": {"$or": filters, "createdAt": {"$type": "date"}}},
+        {"$group": {"_id": bucket}},
+        {"$sort": {"_id": 1}},
+    ], allowDiskUse=True).to_list(None)
+    return [r["_id"] for r in rows]
+
+
+async def rebuild(
+    db: AsyncIOMotorDatabase,
+    target: str,
+    starts: List[datetime],
+    field: str,
+    build: Build,
+    batch: int,
+    owned: Optional[Dict[str, Any]] = None,
+) -> int:
+    """Recompute the buckets starting at ``starts``, ``batch`` buckets per aggregation.
+
+    ``build`` writes whole buckets into ``target`` stamped with ``builtAt``;
+    rows of those buckets (``field``) from earlier builds that this one did
+    not rewrite are deleted afterwards. ``owned`` limits the delete to the
+    rows the builder wrote, for targets that also hold other documents.
+    """
+    now = datetime.now(timezone.utc)
+    built_at = now.replace(microsecond=now.microsecond // 1000 * 1000)  # BSON dates are ms
+    for i in range(0, len(starts), batch):
+        chunk = starts[i:i + batch]
+        await db.timerlogs.aggregate(build(chunk, built_at), allowDiskUse=True).to_list(None)
+        await db[target].delete_many({**(owned or {}), field: {"$in": chunk}, "builtAt": {"$ne": built_at}})
+    return len(starts)
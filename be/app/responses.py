@@ -0,0 +1,209 @@
+from __future__ import annotations
+
+import functools
+import inspect
+import json
+import os
+import sys
+import typing
+from array import array
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Callable, Optional, Tuple
+
+from bson import Decimal128, ObjectId
+from fastapi.datastructures import DefaultPlaceholder
+from fastapi.responses import JSONResponse
+from fastapi.routing import APIRoute
+from starlette.requests import Request
+from starlette.responses import Response
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:  # optional: only needed for application/msgpack
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+_MSGPACK_TYPES = (MSGPACK_MEDIA_TYPE, "application/x-msgpack")
+
+# msgpack ext codes for typed numeric arrays (little-endian payloads)
+EXT_FLOAT32_ARRAY = 1
+EXT_FLOAT64_ARRAY = 2
+EXT_INT32_ARRAY = 3
+EXT_INT64_ARRAY = 4
+
+# float32 keeps ~7 significant digits; larger magnitudes stay float64
+_FLOAT32_MAX = 1e7
+_INT32 = 2 ** 31
+
+
+def _default(value: Any) -> Any:
+    """Types orjson does not know natively (and datetimes for the stdlib fallback)."""
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, Decimal128):
+        return float(value.to_decimal())
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    _OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+    def dumps(content: Any) -> bytes:
+        return orjson.dumps(content, default=_default, option=_OPTIONS)
+else:  # pragma: no cover
+    def dumps(content: Any) -> bytes:
+        return json.dumps(content, default=_default, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def _typed_array_min() -> int:
+    return int(os.getenv("MSGPACK_TYPED_ARRAY_MIN", "16"))
+
+
+def _pack_array(code: int, typecode: str, values: list) -> Any:
+    arr = array(typecode, values)
+    if sys.byteorder != "little":
+        arr.byteswap()
+    return msgpack.ExtType(code, arr.tobytes())
+
+
+def _typed_array(values: list) -> Optional[Any]:
+    """ExtType for a homogeneous numeric list, or None to pack it as usual."""
+    if all(type(v) is int for v in values):
+        if all(-_INT32 <= v < _INT32 for v in values):
+            return _pack_array(EXT_INT32_ARRAY, "i", values)
+        return _pack_array(EXT_INT64_ARRAY, "q", values)
+    if all(type(v) in (int, float) for v in values):
+        if all(abs(v) < _FLOAT32_MAX for v in values):
+            return _pack_array(EXT_FLOAT32_ARRAY, "f", values)
+        return _pack_array(EXT_FLOAT64_ARRAY, "d", values)
+    return None
+
+
+def _with_typed_arrays(content: Any, min_len: int) -> Any:
+    if isinstance(content, dict):
+        return {k: _with_typed_arrays(v, min_len) for k, v in content.items()}
+    if isinstance(content, (list, tuple)):
+        if len(content) >= min_len:
+            typed = _typed_array(list(content))
+            if typed is not None:
+                return typed
+        return [_with_typed_arrays(v, min_len) for v in content]
+    return content
+
+
+def packb(content: Any, typed_arrays: bool = False) -> bytes:
+    if typed_arrays:
+        content = _with_typed_arrays(content, _typed_array_min())
+    return msgpack.packb(content, default=_default, use_bin_type=True)
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response rendered by orjson, with ObjectId/Decimal128/datetime handled natively."""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+class MsgPackResponse(Response):
+    """MessagePack response; with ``typed_arrays`` long numeric lists become ext typed arrays."""
+
+    media_type = MSGPACK_MEDIA_TYPE
+
+    def __init__(self, content: Any, typed_arrays: bool = False, **kwargs: Any):
+        self.typed_arrays = typed_arrays
+        super().__init__(content, **kwargs)
+
+    def render(self, content: Any) -> bytes:
+        return packb(content, self.typed_arrays)
+
+
+def negotiate(accept: Optional[str]) -> Tuple[str, bool]:
+    """Pick ``("msgpack", typed_arrays)`` or ``("json", False)`` from an Accept header.
+
+    ``application/msgpack; arrays=typed`` opts in to typed arrays.
+    """
+    if msgpack is None or not accept:
+        return "json", False
+    for media_range in accept.split(","):
+        media_type, *params = [p.strip().lower() for p in media_range.split(";")]
+        if media_type not in _MSGPACK_TYPES or "q=0" in params:
+            continue
+        return "msgpack", "arrays=typed" in params
+    return "json", False
+
+
+def render(content: Any, accept: Optional[str]) -> Response:
+    fmt, typed = negotiate(accept)
+    if fmt == "msgpack":
+        return MsgPackResponse(content, typed_arrays=typed, headers={"Vary": "Accept"})
+    return FastJSONResponse(content, headers={"Vary": "Accept"})
+
+
+def _wants_fast_path(endpoint: Callable, response_model: Any) -> bool:
+    if not (response_model is None or isinstance(response_model, DefaultPlaceholder)):
+        return False
+    if not inspect.iscoroutinefunction(endpoint):
+        return False
+    return inspect.signature(endpoint).return_annotation is inspect.Signature.empty
+
+
+class FastJSONRoute(APIRoute):
+    """Route that skips FastAPI's ``jsonable_encoder`` pass for untyped endpoints.
+
+    Endpoints without a ``response_model`` or return annotation have their
+    result rendered straight to JSON, or MessagePack when the Accept header
+    asks for it; typed endpoints and endpoints returning a ``Response``
+    behave as usual.
+    """
+
+    def __init__(self, path: str, endpoint: Callable[..., Any], **kwargs: Any):
+        if _wants_fast_path(endpoint, kwargs.get("response_model")):
+            endpoint = _render_directly(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+_REQUEST_PARAM = "_negotiation_request"
+
+
+def _resolved_signature(endpoint: Callable[..., Any]) -> inspect.Signature:
+    """The endpoint's signature with string annotations evaluated in its own module.
+
+    FastAPI resolves annotations against the callable's ``__globals__``,
+    which for a wrapper is this module rather than the router's.
+    """
+    sig = inspect.signature(endpoint)
+    try:
+        hints = typing.get_type_hints(endpoint)
+    except Exception:
+        return sig
+    return sig.replace(parameters=[p.replace(annotation=hints.get(p.name, p.annotation)) for p in sig.parameters.values()])
+
+
+def _render_directly(endpoint: Callable[..., Any]) -> Callable[..., Any]:
+    @functools.wraps(endpoint)
+    async def wrapper(*args, **kwargs):
+        request: Request = kwargs.pop(_REQUEST_PARAM)
+        result = await endpoint(*args, **kwargs)
+        if isinstance(result, Response):
+            return result
+        return render(result, request.headers.get("accept"))
+
+    # The request is injected for content negotiation only; the endpoint never sees it
+    sig = _resolved_signature(endpoint)
+    wrapper.__signature__ = sig.replace(parameters=[
+        *sig.parameters.values(),
+        inspect.Parameter(_REQUEST_PARAM, inspect.Parameter.KEYWORD_ONLY, annotation=Request),
+    ])
+    return wrapper
@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.rebuild import bucket_ranges, rebuild, touched
+from app.watermarks import changed_logs, get_state, set_watermark
+
+HOURLY = "timerlogs_hourly"
+ROLLUP_KEYS = ("locationId", "machineId", "timerId", "stopReason")
+
+# endedAt - createdAt in ms, or null for open / malformed logs (ignored by $sum/$min/$max)
+DURATION_MS = {
+    "$cond": [
+        {"$and": [
+            {"$eq": [{"$type": "$endedAt"}, "date"]},
+            {"$eq": [{"$type": "$createdAt"}, "date"]},
+        ]},
+        {"$subtract": ["$endedAt", "$createdAt"]},
+        None,
+    ]
+}
+
+HOUR_OF_CREATED_AT = {
+    "$dateFromParts": {
+        "year": {"$year": "$createdAt"},
+        "month": {"$month": "$createdAt"},
+        "day": {"$dayOfMonth": "$createdAt"},
+        "hour": {"$hour": "$createdAt"},
+    }
+}
+
+_lock = asyncio.Lock()
+# rollup collection -> time until which it counts as fresh without rereading etl_state
+_ready_until: Dict[str, datetime] = {}
+
+
+def refresh_interval() -> float:
+    return float(os.getenv("ROLLUP_REFRESH_SECONDS", "300"))
+
+
+def _lag_seconds() -> float:
+    return float(os.getenv("ROLLUP_LAG_SECONDS", "5"))
+
+
+def _batch_hours() -> int:
+    return int(os.getenv("ROLLUP_BATCH_HOURS", "168"))
+
+
+def _max_staleness() -> timedelta:
+    return timedelta(seconds=float(os.getenv("ROLLUP_MAX_STALENESS_SECONDS", "900")))
+
+
+def hourly_pipeline(hours: List[datetime], built_at: datetime) -> List[Dict[str, Any]]:
+    """Recompute whole hours of ``HOURLY`` rows from the raw timerlogs."""
+    return [
+        {"$match": {"$or": bucket_ranges(hours, timedelta(hours=1))}},
+        {"$addFields": {"__dur": DURATION_MS}},
+        {"$group": {
+            "_id": {"h": HOUR_OF_CREATED_AT, **{k: f"${k}" for k in ROLLUP_KEYS}},
+            "count": {"$sum": 1},
+            "durCount": {"$sum": {"$cond": [{"$eq": ["$__dur", None]}, 0, 1]}},
+            "durSum": {"$sum": "$__dur"},
+            "durMin": {"$min": "$__dur"},
+            "durMax": {"$max": "$__dur"},
+            "durSumSq": {"$sum": {"$multiply": ["$__dur", "$__dur"]}},
+        }},
+        # Keys are repeated at the top level so range queries can use a plain {h, ...} index
+        {"$addFields": {
+            "h": "$_id.h",
+            **{k: f"$_id.{k}" for k in ROLLUP_KEYS},
+            "builtAt": {"$literal": built_at},
+        }},
+        {"$merge": {"into": HOURLY, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+
+async def rebuild_hours(db: AsyncIOMotorDatabase, hours: List[datetime]) -> int:
+    """Recompute ``hours`` of ``HOURLY`` now (e.g. for logs a watcher saw change)."""
+    async with _lock:
+        return await rebuild(db, HOURLY, sorted(hours), "h", hourly_pipeline, _batch_hours())
+
+
+async def refresh_hourly_rollup(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    """Recompute the hours of ``HOURLY`` that received or closed timerlogs
+    since the last run.
+
+    Progress is an ``_id`` high-water mark for new logs plus an ``endedAt``
+    one for closed logs. Touched hours are rebuilt from all of their logs,
+    so a log closed after it was first rolled up gets its duration counted
+    and reruns are idempotent.
+    """
+    async with _lock:
+        filters, high, closed_high = changed_logs(await get_state(db, HOURLY), _lag_seconds())
+        hours = await touched(db, filters, HOUR_OF_CREATED_AT)
+        await rebuild(db, HOURLY, hours, "h", hourly_pipeline, _batch_hours())
+        await set_watermark(db, HOURLY, high, closedWatermark=closed_high)
+        mark_refreshed(HOURLY)
+        return {"watermark": str(high), "generatedAt": high.generation_time.isoformat(), "hours": len(hours)}
+
+
+async def ensure_rollup_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db[HOURLY].create_index([("h", 1), ("locationId", 1)])
+    await db[HOURLY].create_index([("stopReason", 1), ("h", 1)])
+
+
+def mark_refreshed(name: str) -> None:
+    _ready_until.pop(name, None)
+
+
+async def rollup_available(db: AsyncIOMotorDatabase, name: str = HOURLY) -> bool:
+    """True when routing is enabled and the rollup ``name`` was refreshed recently enough."""
+    if os.getenv("ROLLUP_ROUTING", "1").lower() in ("0", "false", "no"):
+        return False
+    now = datetime.now(timezone.utc)
+    if name in _ready_until and now < _ready_until[name]:
+        return True
+    state = await get_state(db, name)
+    if not state or not state.get("refreshedAt"):
+        return False
+    refreshed = state["refreshedAt"]
+    if refreshed.tzinfo is None:
+        refreshed = refreshed.replace(tzinfo=timezone.utc)
+    fresh_until = refreshed + _max_staleness()
+    if now >= fresh_until:
+        return False
+    _ready_until[name] = min(fresh_until, now + timedelta(seconds=30))
+    return True
+
+
+def hour_aligned(dt: Optional[datetime]) -> bool:
+    return dt is None or (dt.minute == 0 and dt.second == 0 and dt.microsecond == 0)
+
+
+def hour_end(dt: Optional[datetime]) -> bool:
+    """True when ``dt`` is the last BSON millisecond of an hour (``10:59:59.999``)."""
+    if dt is None:
+        return True
+    return hour_aligned(dt.replace(microsecond=dt.microsecond // 1000 * 1000) + timedelta(milliseconds=1))
+
+
+def floor_hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def window_match(start: Optional[datetime], end: Optional[datetime]) -> Optional[Dict[str, Any]]:
+    """Translate a raw ``createdAt`` window (``$gte`` start, ``$lte`` end, as
+    every raw path uses) into a rollup ``h`` filter.
+
+    Returns None unless the window is made of whole hours: the start on an
+    hour boundary and the end on the last millisecond of an hour, because
+    the rollup cannot split an hour. Both answers then cover the same logs.
+    """
+    if not (hour_aligned(start) and hour_end(end)):
+        return None
+    h: Dict[str, Any] = {}
+    if start is not None:
+        h["$gte"] = start
+    if end is not None:
+        h["$lte"] = floor_hour(end)
+    return {"h": h} if h else {}
+
+
+async def rollup_match(
+    db: AsyncIOMotorDatabase,
+    start: Optional[datetime],
+    end: Optional[datetime],
+    **filters: Any,
+) -> Optional[Dict[str, Any]]:
+    """``$match`` for ``HOURLY`` equivalent to a raw timerlogs query, or None
+    when the request has to be answered from the raw log."""
+    window = window_match(start, end)
+    if window is None or not await rollup_available(db):
+        return None
+    return {**window, **{k: v for k, v in filters.items() if v}}
+
+
+def avg_of(sum_field: str, count_field: str) -> Dict[str, Any]:
+    return {"$cond": [
+        {"$gt": [f"${count_field}", 0]},
+        {"$divide": [f"${sum_field}", f"${count_field}"]},
+        None,
+    ]}
+
+
+async def _main():
+    from app.db import get_db, close_db
+
+    db = get_db()
+    await ensure_rollup_indexes(db)
+    print(await refresh_hourly_rollup(db))
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -3,28 +3,35 @@ from __future__ import annotations
 from fastapi import APIRouter, Query
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
-from app.db import get_db
+from app.db import get_db, aggregate, count_documents, distinct
+from app.responses import FastJSONRoute
+from app.cache import cached
+from app.overview import compute_kpis
+from app.pivot import index_cells, series_by_column
+from app.rollups import HOURLY, floor_hour, rollup_match
+from app.routers.simple_dashboard import dashboard_overview
+import asyncio
+import os
 import random
 import math
-from bson import ObjectId
+import operator
+import time
 
-def serialize_doc(doc):
-    """Convert MongoDB document to JSON-serializable format"""
-    if isinstance(doc, dict):
-        return {k: serialize_doc(v) for k, v in doc.items()}
-    elif isinstance(doc, list):
-        return [serialize_doc(item) for item in doc]
-    elif isinstance(doc, ObjectId):
-        return str(doc)
-    elif isinstance(doc, datetime):
-        return doc.isoformat()
+def _reason_name(reason):
+    """Normalize a stopReason value (string, list or null) to a display name"""
+    if isinstance(reason, list):
+        # If it's a list, convert to string or take first element
+        return str(reason) if len(reason) > 1 else (reason[0] if reason else "Unknown")
+    elif isinstance(reason, str):
+        return reason
     else:
-        return doc
+        return str(reason) if reason is not None else "Unknown"
 
-router = APIRouter(prefix="/advanced-charts", tags=["Advanced Charts for ECharts"])
+router = APIRouter(prefix="/advanced-charts", tags=["Advanced Charts for ECharts"], route_class=FastJSONRoute)
 
 @router.get("/line-charts/basic")
-def get_basic_line_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_basic_line_chart():
     """Basic Line Chart"""
     db = get_db()
     
@@ -41,7 +48,7 @@ def get_basic_line_chart():
             {"$sort": {"_id": 1}}
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
+        results = await aggregate(db.timerlogs, pipeline)
         
         return {
             "title": "Daily Production Units",
@@ -59,7 +66,8 @@ def get_basic_line_chart():
         return {"error": str(e)}
 
 @router.get("/line-charts/smoothed")
-def get_smoothed_line_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_smoothed_line_chart():
     """Smoothed Line Chart with multiple series"""
     db = get_db()
     
@@ -85,20 +93,16 @@ def get_smoothed_line_chart():
             {"$sort": {"_id": 1}}
         ]
         
-        production_results = list(db.timerlogs.aggregate(production_pipeline))
-        downtime_results = list(db.timerlogs.aggregate(downtime_pipeline))
+        production_results = await aggregate(db.timerlogs, production_pipeline)
+        downtime_results = await aggregate(db.timerlogs, downtime_pipeline)
         
         # Combine data
         all_dates = sorted(list(set([r["_id"] for r in production_results] + [r["_id"] for r in downtime_results])))
         
-        production_data = []
-        downtime_data = []
-        
-        for date in all_dates:
-            prod = next((r["production"] for r in production_results if r["_id"] == date), 0)
-            down = next((r["downtime"] for r in downtime_results if r["_id"] == date), 0)
-            production_data.append(prod)
-            downtime_data.append(down)
+        production_by_date = {r["_id"]: r["production"] for r in reversed(production_results)}
+        downtime_by_date = {r["_id"]: r["downtime"] for r in reversed(downtime_results)}
+        production_data = [production_by_date.get(date, 0) for date in all_dates]
+        downtime_data = [downtime_by_date.get(date, 0) for date in all_dates]
         
         return {
             "title": "Production vs Downtime Trend",
@@ -125,7 +129,8 @@ def get_smoothed_line_chart():
         return {"error": str(e)}
 
 @router.get("/area-charts/basic")
-def get_basic_area_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_basic_area_chart():
     """Basic Area Chart"""
     db = get_db()
     
@@ -144,23 +149,17 @@ def get_basic_area_chart():
             {"$sort": {"_id.date": 1}}
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
-        
-        # Serialize the results to avoid ObjectId issues
-        results = serialize_doc(results)
+        results = await aggregate(db.timerlogs, pipeline)
         
         # Organize by location
         dates = sorted(list(set([r["_id"]["date"] for r in results])))
-        locations = sorted(list(set([r["_id"]["location"] for r in results if r["_id"]["location"]])))
+        locations = sorted(list(set([str(r["_id"]["location"]) for r in results if r["_id"]["location"]])))
+        
+        cells = index_cells(results, key=lambda r: (r["_id"]["date"], str(r["_id"]["location"])), value=lambda r: r["count"])
+        by_location = series_by_column(cells, dates, locations[:3])  # Limit to 3 locations
         
         series_data = []
-        for location in locations[:3]:  # Limit to 3 locations
-            location_data = []
-            for date in dates:
-                count = next((r["count"] for r in results 
-                            if r["_id"]["date"] == date and r["_id"]["location"] == location), 0)
-                location_data.append(count)
-            
+        for location, location_data in by_location.items():
             series_data.append({
                 "name": str(location) if location else "Unknown",
                 "type": "area",
@@ -185,7 +184,8 @@ def get_basic_area_chart():
         return {"error": str(e)}
 
 @router.get("/area-charts/stacked")
-def get_stacked_area_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_stacked_area_chart():
     """Stacked Area Chart"""
     db = get_db()
     
@@ -204,26 +204,20 @@ def get_stacked_area_chart():
             {"$sort": {"_id.date": 1}}
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
+        results = await aggregate(db.timerlogs, pipeline)
         
-        # Serialize the results to avoid ObjectId issues
-        results = serialize_doc(results)
+        # One pass: sum counts per (date, normalized reason)
+        cells = index_cells(
+            results,
+            key=lambda r: (r["_id"]["date"], _reason_name(r["_id"]["reason"])),
+            value=lambda r: r["count"],
+            combine=operator.add
+        )
         
         # Get top 5 stop reasons - handle array/list values
         reason_counts = {}
-        for r in results:
-            reason = r["_id"]["reason"]
-            
-            # Handle different types of stopReason values
-            if isinstance(reason, list):
-                # If it's a list, convert to string or take first element
-                reason_str = str(reason) if len(reason) > 1 else (reason[0] if reason else "Unknown")
-            elif isinstance(reason, str):
-                reason_str = reason
-            else:
-                reason_str = str(reason) if reason is not None else "Unknown"
-            
-            reason_counts[reason_str] = reason_counts.get(reason_str, 0) + r["count"]
+        for (_, reason_str), count in cells.items():
+            reason_counts[reason_str] = reason_counts.get(reason_str, 0) + count
         
         top_reasons = sorted(reason_counts.items(), key=lambda x: x[1], reverse=True)[:5]
         top_reason_names = [r[0] for r in top_reasons]
@@ -231,27 +225,7 @@ def get_stacked_area_chart():
         dates = sorted(list(set([r["_id"]["date"] for r in results])))
         
         series_data = []
-        for reason_name in top_reason_names:
-            reason_data = []
-            for date in dates:
-                count = 0
-                for r in results:
-                    if r["_id"]["date"] == date:
-                        r_reason = r["_id"]["reason"]
-                        
-                        # Handle different types of stopReason values
-                        if isinstance(r_reason, list):
-                            r_reason_str = str(r_reason) if len(r_reason) > 1 else (r_reason[0] if r_reason else "Unknown")
-                        elif isinstance(r_reason, str):
-                            r_reason_str = r_reason
-                        else:
-                            r_reason_str = str(r_reason) if r_reason is not None else "Unknown"
-                        
-                        if r_reason_str == reason_name:
-                            count += r["count"]
-                
-                reason_data.append(count)
-            
+        for reason_name, reason_data in series_by_column(cells, dates, top_reason_names).items():
             series_data.append({
                 "name": reason_name,
                 "type": "area",
@@ -269,7 +243,8 @@ def get_stacked_area_chart():
         return {"error": str(e)}
 
 @router.get("/scatter-charts/basic")
-def get_basic_scatter_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_basic_scatter_chart():
     """Basic Scatter Chart"""
     db = get_db()
     
@@ -304,7 +279,7 @@ def get_basic_scatter_chart():
             {"$sample": {"size": 200}}  # Sample for performance
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
+        results = await aggregate(db.timerlogs, pipeline)
         
         scatter_data = []
         for r in results:
@@ -334,22 +309,34 @@ def get_basic_scatter_chart():
         return {"error": str(e)}
 
 @router.get("/heatmap-charts/calendar")
-def get_calendar_heatmap():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_calendar_heatmap():
     """Calendar Heatmap"""
     db = get_db()
     
     try:
-        start_date = datetime.now() - timedelta(days=90)
-        
-        pipeline = [
-            {"$match": {"createdAt": {"$gte": start_date}, "stopReason": "Unit Created"}},
-            {"$group": {
-                "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}},
-                "count": {"$sum": 1}
-            }}
-        ]
-        
-        results = list(db.timerlogs.aggregate(pipeline))
+        # Start on an hour boundary so the hourly rollup can answer exactly
+        start_date = floor_hour(datetime.now() - timedelta(days=90))
+        
+        rollup_query = await rollup_match(db, start_date, None, stopReason="Unit Created")
+        if rollup_query is not None:
+            pipeline = [
+                {"$match": rollup_query},
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$h"}},
+                    "count": {"$sum": "$count"}
+                }}
+            ]
+            results = await aggregate(db[HOURLY], pipeline)
+        else:
+            pipeline = [
+                {"$match": {"createdAt": {"$gte": start_date}, "stopReason": "Unit Created"}},
+                {"$group": {
+                    "_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}},
+                    "count": {"$sum": 1}
+                }}
+            ]
+            results = await aggregate(db.timerlogs, pipeline)
         
         # Format for calendar heatmap
         heatmap_data = []
@@ -365,20 +352,22 @@ def get_calendar_heatmap():
         return {"error": str(e)}
 
 @router.get("/gauge-charts/multi")
-def get_multi_gauge_chart():
+@cached(ttl=60, collections=("timerlogs", "machines"))
+async def get_multi_gauge_chart():
     """Multiple Gauge Charts for KPIs"""
     db = get_db()
     
     try:
-        # Calculate various KPIs
-        total_logs = db.timerlogs.count_documents({})
-        production_logs = db.timerlogs.count_documents({"stopReason": "Unit Created"})
+        # Calculate various KPIs (one $facet pass per collection)
+        kpis = await compute_kpis(db, ["totalLogs", "produced"], ["active", "total"])
+        total_logs = kpis["timerlogs"]["totalLogs"] or 0
+        production_logs = kpis["timerlogs"]["produced"] or 0
         
         efficiency = (production_logs / total_logs * 100) if total_logs > 0 else 0
         
         # Machine utilization
-        active_machines = db.machines.count_documents({"status": "active"})
-        total_machines = db.machines.count_documents({})
+        active_machines = kpis["machines"]["active"] or 0
+        total_machines = kpis["machines"]["total"] or 0
         
         utilization = (active_machines / total_machines * 100) if total_machines > 0 else 0
         
@@ -414,13 +403,14 @@ def get_multi_gauge_chart():
         return {"error": str(e)}
 
 @router.get("/radar-charts/performance")
-def get_performance_radar():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_performance_radar():
     """Performance Radar Chart"""
     db = get_db()
     
     try:
         # Calculate metrics for each location
-        locations_raw = db.timerlogs.distinct("locationId")[:3]  # Top 3 locations
+        locations_raw = (await distinct(db.timerlogs, "locationId"))[:3]  # Top 3 locations
         # Convert ObjectIds to strings
         locations = [str(loc) if loc is not None else "Unknown" for loc in locations_raw]
         
@@ -433,8 +423,8 @@ def get_performance_radar():
             # Use the original ObjectId for queries, but display string for output
             original_location = locations_raw[i]
             
-            total = db.timerlogs.count_documents({"locationId": original_location})
-            production = db.timerlogs.count_documents({"locationId": original_location, "stopReason": "Unit Created"})
+            total = await count_documents(db.timerlogs, {"locationId": original_location})
+            production = await count_documents(db.timerlogs, {"locationId": original_location, "stopReason": "Unit Created"})
             
             efficiency = (production / total * 100) if total > 0 else 0
             
@@ -464,15 +454,17 @@ def get_performance_radar():
         return {"error": str(e)}
 
 @router.get("/funnel-charts/conversion")
-def get_funnel_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_funnel_chart():
     """Funnel Chart for Process Flow"""
     db = get_db()
     
     try:
         # Production funnel stages
-        total_starts = db.timerlogs.count_documents({"stopReason": {"$in": ["Started", "Auto-Start"]}})
-        in_progress = db.timerlogs.count_documents({"endedAt": None})
-        completed = db.timerlogs.count_documents({"stopReason": "Unit Created"})
+        kpis = await compute_kpis(db, ["starts", "inProgress", "produced"])
+        total_starts = kpis["timerlogs"]["starts"] or 0
+        in_progress = kpis["timerlogs"]["inProgress"] or 0
+        completed = kpis["timerlogs"]["produced"] or 0
         quality_passed = int(completed * 0.95)  # Simulate 95% quality rate
         shipped = int(quality_passed * 0.98)  # Simulate 98% shipping rate
         
@@ -490,21 +482,19 @@ def get_funnel_chart():
         return {"error": str(e)}
 
 @router.get("/tree-charts/hierarchy")
-def get_tree_chart():
+@cached(ttl=60, collections=("machines",))
+async def get_tree_chart():
     """Tree Chart for Machine Hierarchy"""
     db = get_db()
     
     try:
         # Build machine hierarchy
-        locations = list(db.machines.aggregate([
+        locations = await aggregate(db.machines, [
             {"$group": {
                 "_id": "$locationId",
                 "machines": {"$push": {"id": "$_id", "name": "$name", "class": "$machineClassId"}}
             }}
-        ]))
-        
-        # Serialize the results to avoid ObjectId issues
-        locations = serialize_doc(locations)
+        ])
         
         tree_data = {
             "name": "APMS Factory",
@@ -553,13 +543,14 @@ def get_tree_chart():
         
         return {
             "title": "Machine Hierarchy",
-            "data": serialize_doc(tree_data)
+            "data": tree_data
         }
     except Exception as e:
         return {"error": str(e)}
 
 @router.get("/sankey-charts/flow")
-def get_sankey_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_sankey_chart():
     """Sankey Chart for Process Flow"""
     db = get_db()
     
@@ -571,10 +562,7 @@ def get_sankey_chart():
             {"$limit": 6}
         ]
         
-        reasons = list(db.timerlogs.aggregate(pipeline))
-        
-        # Serialize the results to avoid ObjectId issues
-        reasons = serialize_doc(reasons)
+        reasons = await aggregate(db.timerlogs, pipeline)
         
         nodes = []
         links = []
@@ -599,41 +587,72 @@ def get_sankey_chart():
     except Exception as e:
         return {"error": str(e)}
 
+# key -> chart callable for the comprehensive dashboard (each sub-chart is cached on its own)
+COMPREHENSIVE_CHARTS = {
+    "basicLine": get_basic_line_chart,
+    "smoothedLine": get_smoothed_line_chart,
+    "basicArea": get_basic_area_chart,
+    "stackedArea": get_stacked_area_chart,
+    "scatter": get_basic_scatter_chart,
+    "calendarHeatmap": get_calendar_heatmap,
+    "multiGauge": get_multi_gauge_chart,
+    "radar": get_performance_radar,
+    "funnel": get_funnel_chart,
+    "tree": get_tree_chart,
+    "sankey": get_sankey_chart,
+    # Opt-in so the dashboard page can load its KPI cards in the same round trip
+    "overview": dashboard_overview,
+}
+DEFAULT_COMPREHENSIVE_CHARTS = [k for k in COMPREHENSIVE_CHARTS if k != "overview"]
+
+
+def _max_concurrency() -> int:
+    return max(1, int(os.getenv("COMPREHENSIVE_MAX_CONCURRENCY", "4")))
+
+
+def _chart_timeout() -> float:
+    return float(os.getenv("COMPREHENSIVE_CHART_TIMEOUT_SECONDS", "10"))
+
+
+async def _run_chart(key: str, semaphore: asyncio.Semaphore, timeout: float):
+    """Run one sub-chart under the shared limit; never raises."""
+    async with semaphore:
+        t0 = time.perf_counter()
+        try:
+            data = await asyncio.wait_for(COMPREHENSIVE_CHARTS[key](), timeout)
+            if isinstance(data, dict) and "error" in data:
+                meta = {"status": "error", "error": data["error"]}
+                data = None
+            else:
+                meta = {"status": "ok"}
+        except asyncio.TimeoutError:
+            data, meta = None, {"status": "timeout", "error": f"timed out after {timeout}s"}
+        except Exception as e:
+            data, meta = None, {"status": "error", "error": str(e)}
+        meta["latencyMs"] = round((time.perf_counter() - t0) * 1000, 2)
+        return key, data, meta
+
+
 @router.get("/dashboard/comprehensive")
-def get_comprehensive_chart_data():
+async def get_comprehensive_chart_data(
+    charts: Optional[str] = Query(None, description="Comma-separated chart keys, e.g. basicLine,radar,overview")
+):
     """Get data for all chart types at once"""
-    db = get_db()
+    keys = [k.strip() for k in charts.split(",") if k.strip()] if charts else DEFAULT_COMPREHENSIVE_CHARTS
+    unknown = [k for k in keys if k not in COMPREHENSIVE_CHARTS]
+    if unknown:
+        return {"error": f"Unknown charts: {', '.join(unknown)}", "available": list(COMPREHENSIVE_CHARTS), "status": "error"}
     
-    try:
-        # This would be the main endpoint for loading all chart data
-        basic_line = get_basic_line_chart()
-        smoothed_line = get_smoothed_line_chart()
-        basic_area = get_basic_area_chart()
-        stacked_area = get_stacked_area_chart()
-        scatter = get_basic_scatter_chart()
-        calendar_heatmap = get_calendar_heatmap()
-        multi_gauge = get_multi_gauge_chart()
-        radar = get_performance_radar()
-        funnel = get_funnel_chart()
-        tree = get_tree_chart()
-        sankey = get_sankey_chart()
-        
-        return {
-            "charts": {
-                "basicLine": basic_line,
-                "smoothedLine": smoothed_line,
-                "basicArea": basic_area,
-                "stackedArea": stacked_area,
-                "scatter": scatter,
-                "calendarHeatmap": calendar_heatmap,
-                "multiGauge": multi_gauge,
-                "radar": radar,
-                "funnel": funnel,
-                "tree": tree,
-                "sankey": sankey
-            },
-            "status": "success",
-            "chartCount": 11
-        }
-    except Exception as e:
-        return {"error": str(e), "status": "error"}
+    t0 = time.perf_counter()
+    semaphore = asyncio.Semaphore(_max_concurrency())
+    timeout = _chart_timeout()
+    results = await asyncio.gather(*(_run_chart(k, semaphore, timeout) for k in dict.fromkeys(keys)))
+    
+    failed = [key for key, _, meta in results if meta["status"] != "ok"]
+    return {
+        "charts": {key: data for key, data, _ in results},
+        "meta": {key: meta for key, _, meta in results},
+        "status": "partial" if failed else "success",
+        "chartCount": len(results) - len(failed),
+        "latencyMs": round((time.perf_counter() - t0) * 1000, 2),
+    }
@@ -1,30 +1,28 @@
 from __future__ import annotations
 
-from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional
 
-from fastapi import APIRouter, Body
+from fastapi import APIRouter, Body, Header, Query
+from fastapi.responses import JSONResponse
 
-from app.db import get_db
+from app.columnar import category_kind, columnar_format, columnar_response
+from app.db import get_db, aggregate
+from app.rollups import rollup_available
+from app.queryplan import QueryError, choose_hint, compile_query, estimate_cost, fit_percentiles, route_to_rollup
+from app.responses import FastJSONRoute
+from app.sketches import SKETCH, SKETCH_FIELDS, load_histogram
+from app.streaming import iter_aggregate, ndjson_response, wants_ndjson
 
-router = APIRouter(prefix="/v1/analytics", tags=["analytics"])
+router = APIRouter(prefix="/v1/analytics", tags=["analytics"], route_class=FastJSONRoute)
 
 
-def _parse_dt(s: Optional[str]) -> Optional[datetime]:
-    if not s:
-        return None
-    try:
-        return datetime.fromisoformat(s)
-    except ValueError:
-        return None
-
-
-def _time_key(format: str, field: str) -> Dict[str, Any]:
-    return {"$dateToString": {"format": format, "date": f"${field}"}}
+async def _iterate(rows: List[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    for row in rows:
+        yield row
 
 
 @router.post("/query")
-def analytics_query(
+async def analytics_query(
     payload: Dict[str, Any] = Body(
         ..., example={
             "collection": "timerlogs",
@@ -35,159 +33,84 @@ def analytics_query(
             "sort": {"by": "duration", "order": -1},
         }
     ),
+    format: Optional[str] = Query(None, description="json (default), ndjson, arrow or parquet"),
+    explain: bool = Query(False, description="Return the compiled pipeline and its estimated cost instead of running it"),
+    accept: Optional[str] = Header(None),
 ):
     db = get_db()
-    collection = payload.get("collection")
-    filters = payload.get("filters", {}) or {}
-    group = payload.get("group", {}) or {}
-    metrics = payload.get("metrics", []) or []
-    limit = int(payload.get("limit", 200) or 200)
-    sort = payload.get("sort") or {}
-
-    coll = db[collection]
-
-    match: Dict[str, Any] = {}
-    # generic equality filters (non-empty)
-    for k, v in filters.items():
-        if k in ("from", "to", "timeField"):
-            continue
-        if v is not None and v != "":
-            match[k] = v
-
-    # time window
-    time_field = filters.get("timeField") or group.get("timeField") or "createdAt"
-    dt_from = _parse_dt(filters.get("from"))
-    dt_to = _parse_dt(filters.get("to"))
-    if dt_from or dt_to:
-        match[time_field] = {}
-        if dt_from:
-            match[time_field]["$gte"] = dt_from
-        if dt_to:
-            match[time_field]["$lte"] = dt_to
-
-    pipeline: List[Dict[str, Any]] = []
-
-    # Precompute durationSec if fields exist
-    if collection in ("timerlogs", "timerloghistories", "controllertimers"):
-        pipeline.append(
-            {
-                "$addFields": {
-                    "__durationSec": {
-                        "$cond": [
-                            {
-                                "$and": [
-                                    {"$ne": ["$endedAt", None]},
-                                    {"$ne": [f"${time_field}", None]},
-                                ]
-                            },
-                            {"$divide": [{"$subtract": ["$endedAt", f"${time_field}"]}, 1000]},
-                            None,
-                        ]
-                    }
-                }
-            }
-        )
-
-    if match:
-        pipeline.append({"$match": match})
-
-    # Build group key
-    group_id: Dict[str, Any] = {}
-    cats: List[str] = []
-    time_bucket = (group.get("timeBucket") or "").lower()
-    time_field = group.get("timeField") or time_field
-    if time_bucket:
-        if time_bucket == "day":
-            group_id["t"] = _time_key("%Y-%m-%d", time_field)
-        elif time_bucket == "month":
-            group_id["t"] = _time_key("%Y-%m", time_field)
-        elif time_bucket == "hour":
-            group_id["t"] = _time_key("%Y-%m-%d %H:00", time_field)
-    for b in group.get("by", []) or []:
-        group_id[b] = f"${b}"
-        cats.append(b)
-
-    # Build accumulators
-    accum: Dict[str, Any] = {}
-    for m in metrics:
-        op = (m.get("op") or "").lower()
-        field = m.get("field")
-        out = m.get("as") or f"{op}_{field}"
-        src = f"${field}"
-        if field == "durationSec":
-            src = "$__durationSec"
-        if op == "sum":
-            accum[out] = {"$sum": {"$ifNull": [src, 0]}}
-        elif op == "avg":
-            accum[out] = {"$avg": src}
-        elif op == "min":
-            accum[out] = {"$min": src}
-        elif op == "max":
-            accum[out] = {"$max": src}
-        elif op == "count":
-            accum[out] = {"$sum": 1}
-
-    if group_id:
-        pipeline.append({"$group": {"_id": group_id, **accum}})
-    elif accum:
-        pipeline.append({"$group": {"_id": None, **accum}})
-
-    if sort and sort.get("by"):
-        pipeline.append({"$sort": {sort["by"]: int(sort.get("order", -1))}})
-    elif time_bucket:
-        pipeline.append({"$sort": {"_id.t": 1}})
-
-    if limit:
-        pipeline.append({"$limit": limit})
-
-    rows = list(coll.aggregate(pipeline))
-
-    # normalize result: return dataset-like and series inference
-    columns = ["t", *cats, *[m.get("as") or f"{m.get('op')}_{m.get('field')}" for m in metrics]]
-    data_rows: List[List[Any]] = []
-    for r in rows:
-        rid = r.get("_id") or {}
-        row = [rid.get("t")] if "t" in columns else []
-        for c in cats:
-            row.append(rid.get(c))
-        for m in metrics:
-            key = m.get("as") or f"{m.get('op')}_{m.get('field')}"
-            val = r.get(key)
-            if isinstance(val, (int, float)):
-                row.append(float(val))
-            else:
-                row.append(val)
-        data_rows.append(row)
-
-    return {"columns": columns, "rows": data_rows, "raw": rows}
+    try:
+        plan = compile_query(payload)
+        await route_to_rollup(db, plan)
+        await fit_percentiles(db, plan)
+    except QueryError as e:
+        return JSONResponse(status_code=422, content={"error": str(e)})
+    await choose_hint(db, plan)
+    if explain:
+        try:
+            return {"plan": plan.describe(), "cost": await estimate_cost(db, plan)}
+        except Exception as e:
+            return {"plan": plan.describe(), "error": str(e)}
+
+    coll = db[plan.source]
+    pipeline = plan.pipeline()
+    columns = plan.columns
+    source = "rollup" if plan.from_rollup else "raw"
+    merged = None
+    if plan.from_sketch:
+        # Percentiles are merged here; the sketch rows are few, so streaming gains nothing
+        merged = plan.merge_sketches(await aggregate(coll, pipeline, **plan.options()))
+
+    def cursor() -> AsyncIterator[Dict[str, Any]]:
+        return _iterate(merged) if merged is not None else iter_aggregate(coll, pipeline, **plan.options())
+
+    columnar = columnar_format(format, accept)
+    if columnar:
+        fields = [("t", "timestamp"), *[(c, category_kind(c)) for c in plan.cats], *[(m.alias, "float") for m in plan.metrics]]
+        response = await columnar_response(columnar, cursor(), fields, plan.to_row)
+        response.headers["X-Query-Source"] = source
+        return response
+
+    if wants_ndjson(format):
+        # One {column: value} object per line; the raw documents are not repeated
+        response = ndjson_response(cursor(), lambda r: dict(zip(columns, plan.to_row(r))))
+        response.headers["X-Query-Source"] = source
+        return response
+
+    rows = merged if merged is not None else await aggregate(coll, pipeline, **plan.options())
+    data_rows = [plan.to_row(r) for r in rows]
+
+    return {"columns": columns, "rows": data_rows, "raw": rows, "source": source}
 
 
 @router.get("/timerlogs/heatmap/daily-counts")
-def timerlogs_daily_counts():
+async def timerlogs_daily_counts():
     db = get_db()
     pipeline = [
         {"$addFields": {"day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}}}},
         {"$group": {"_id": "$day", "count": {"$sum": 1}}},
         {"$sort": {"_id": 1}},
     ]
-    rows = list(db["timerlogs"].aggregate(pipeline))
+    rows = await aggregate(db["timerlogs"], pipeline)
     return {"items": [{"day": r["_id"], "count": int(r["count"]) } for r in rows]}
 
 
 @router.get("/timerlogs/histogram")
-def timerlogs_histogram(field: str = "cycle", buckets: int = 20):
+async def timerlogs_histogram(field: str = "cycle", buckets: int = 20):
     db = get_db()
+    if field in SKETCH_FIELDS and await rollup_available(db, SKETCH):
+        # Equal-count bins from the merged hourly sketches, O(sketch buckets)
+        return {"items": await load_histogram(db, field, buckets), "source": "sketch"}
     pipeline = [
         {"$match": {field: {"$ne": None}}},
         {"$bucketAuto": {"groupBy": f"${field}", "buckets": buckets}},
         {"$project": {"_id": 0, "min": "$min", "max": "$max", "count": "$count"}},
     ]
-    rows = list(db["timerlogs"].aggregate(pipeline))
-    return {"items": rows}
+    rows = await aggregate(db["timerlogs"], pipeline)
+    return {"items": rows, "source": "raw"}
 
 
 @router.get("/timerlogs/pareto/stop-reasons")
-def timerlogs_pareto_stop_reason(limit: int = 20):
+async def timerlogs_pareto_stop_reason(limit: int = 20):
     db = get_db()
     pipeline = [
         {"$match": {"stopReason": {"$ne": None}}},
@@ -195,6 +118,6 @@ def timerlogs_pareto_stop_reason(limit: int = 20):
         {"$sort": {"n": -1}},
         {"$limit": limit},
     ]
-    rows = list(db["timerlogs"].aggregate(pipeline))
+    rows = await aggregate(db["timerlogs"], pipeline)
     return {"items": [{"stopReason": r["_id"], "count": int(r["n"]) } for r in rows]}
 
@@ -1,17 +1,23 @@
 from __future__ import annotations
 
 from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
-from app.db import get_db
+from app import anomalies, features, live
+from app.db import get_db, aggregate
+from app.hll import HLL, unique_counts
+from app.rollups import rollup_available
+from app.responses import FastJSONRoute
 
-router = APIRouter(prefix="/dashboard", tags=["Comprehensive Dashboard"])
+router = APIRouter(prefix="/dashboard", tags=["Comprehensive Dashboard"], route_class=FastJSONRoute)
 
 @router.get("/overview")
-def get_dashboard_overview(
+async def get_dashboard_overview(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
-    location_id: Optional[str] = Query(None)
+    location_id: Optional[str] = Query(None),
+    approx: bool = Query(False, description="Count unique timers and machines from HyperLogLog sketches")
 ):
     """Get comprehensive dashboard overview with all key metrics"""
     db = get_db()
@@ -24,6 +30,11 @@ def get_dashboard_overview(
             "$lte": datetime.fromisoformat(end_date)
         }
     
+    unique = None
+    if approx and await rollup_available(db, HLL):
+        counts = await unique_counts(db, date_filter.get("$gte"), date_filter.get("$lte"), location_id)
+        unique = counts.get(None, {"timers": 0, "machines": 0})
+    
     # Location filter
     location_filter = {}
     if location_id:
@@ -38,13 +49,21 @@ def get_dashboard_overview(
             "totalLogs": {"$sum": 1},
             "totalRuntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
             "avgCycleTime": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
-            "uniqueTimers": {"$addToSet": "$timerId"},
-            "uniqueMachines": {"$addToSet": "$machineId"}
+            **({} if unique is not None else {
+                "uniqueTimers": {"$addToSet": "$timerId"},
+                "uniqueMachines": {"$addToSet": "$machineId"}
+            })
         }}
     ]
     
-    production_data = list(db.timerlogs.aggregate(production_pipeline))
+    production_data = await aggregate(db.timerlogs, production_pipeline)
     prod_metrics = production_data[0] if production_data else {}
+    approx_used = unique is not None
+    if unique is None:
+        unique = {
+            "timers": len(prod_metrics.get("uniqueTimers", [])),
+            "machines": len(prod_metrics.get("uniqueMachines", []))
+        }
     
     # Get daily stats metrics
     daily_stats_filter = dict(location_filter)
@@ -64,7 +83,7 @@ def get_dashboard_overview(
         }}
     ]
     
-    daily_stats_data = list(db.timerdailystats.aggregate(daily_stats_pipeline))
+    daily_stats_data = await aggregate(db.timerdailystats, daily_stats_pipeline)
     daily_metrics = daily_stats_data[0] if daily_stats_data else {}
     
     # Get machine status
@@ -76,7 +95,7 @@ def get_dashboard_overview(
         }}
     ]
     
-    machine_status = list(db.machines.aggregate(machine_pipeline))
+    machine_status = await aggregate(db.machines, machine_pipeline)
     machine_status_dict = {item["_id"]: item["count"] for item in machine_status}
     
     # Calculate efficiency
@@ -90,8 +109,9 @@ def get_dashboard_overview(
             "totalLogs": total_logs,
             "efficiency": round(efficiency, 2),
             "avgCycleTime": round((prod_metrics.get("avgCycleTime", 0) or 0) / (60 * 1000), 2),  # minutes
-            "uniqueTimers": len(prod_metrics.get("uniqueTimers", [])),
-            "uniqueMachines": len(prod_metrics.get("uniqueMachines", []))
+            "uniqueTimers": unique["timers"],
+            "uniqueMachines": unique["machines"],
+            "approx": approx_used
         },
         "oee": {
             "overall": round(daily_metrics.get("avgOEE", 0) or 0, 2),
@@ -112,7 +132,7 @@ def get_dashboard_overview(
     }
 
 @router.get("/production-charts")
-def get_production_charts(
+async def get_production_charts(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -145,7 +165,7 @@ def get_production_charts(
         {"$limit": 168}  # Last week hourly data
     ]
     
-    results = list(db.timerlogs.aggregate(pipeline))
+    results = await aggregate(db.timerlogs, pipeline)
     
     chart_data = {
         "xAxis": [r["_id"] for r in results],
@@ -209,20 +229,24 @@ def get_production_charts(
     return chart_data
 
 @router.get("/real-time-status")
-def get_real_time_status(location_id: Optional[str] = Query(None)):
+async def get_real_time_status(location_id: Optional[str] = Query(None)):
     """Get real-time status of all systems"""
     db = get_db()
     
-    # Get latest timer logs (last hour)
-    last_hour = datetime.now() - timedelta(hours=1)
+    # Kept current by the timerlogs watcher; aggregate only when it is not live
+    if live.ready():
+        live.state.prune()
+        return live.state.snapshot(location_id)
     
-    query = {"createdAt": {"$gte": last_hour}}
-    if location_id:
-        query["locationId"] = location_id
+    # Same definitions as the live snapshot: open timers and downtime of any age,
+    # production from logs created in the last hour (timerlogs dates are naive UTC)
+    now = datetime.utcnow()
+    location = {"locationId": location_id} if location_id else {}
+    query = {**location, "createdAt": {"$gte": now - live.WINDOW}}
     
     # Active timers
     active_timers_pipeline = [
-        {"$match": {**query, "endedAt": None}},
+        {"$match": {**location, "endedAt": None}},
         {"$group": {
             "_id": "$timerId",
             "startTime": {"$min": "$createdAt"},
@@ -233,7 +257,7 @@ def get_real_time_status(location_id: Optional[str] = Query(None)):
         {"$sort": {"startTime": -1}}
     ]
     
-    active_timers = list(db.timerlogs.aggregate(active_timers_pipeline))
+    active_timers = await aggregate(db.timerlogs, active_timers_pipeline)
     
     # Recent completed production
     recent_production_pipeline = [
@@ -246,12 +270,12 @@ def get_real_time_status(location_id: Optional[str] = Query(None)):
         {"$limit": 12}  # Last 12 time slots
     ]
     
-    recent_production = list(db.timerlogs.aggregate(recent_production_pipeline))
+    recent_production = await aggregate(db.timerlogs, recent_production_pipeline)
     
     # Machine alerts (simulated from recent downtime)
     alerts_pipeline = [
         {"$match": {
-            **query,
+            **location,
             "stopReason": {"$nin": ["Unit Created", None]},
             "endedAt": None  # Still ongoing
         }},
@@ -264,7 +288,7 @@ def get_real_time_status(location_id: Optional[str] = Query(None)):
         {"$sort": {"startTime": 1}}
     ]
     
-    alerts = list(db.timerlogs.aggregate(alerts_pipeline))
+    alerts = await aggregate(db.timerlogs, alerts_pipeline)
     
     return {
         "activeTimers": len(active_timers),
@@ -276,7 +300,8 @@ def get_real_time_status(location_id: Optional[str] = Query(None)):
             {
                 "machineId": alert["_id"],
                 "type": alert["alertType"],
-                "duration": int((datetime.now() - alert["startTime"]).total_seconds() / 60),  # minutes
+                "startTime": alert["startTime"],
+                "duration": int((now - alert["startTime"]).total_seconds() / 60) if alert["startTime"] else None,  # minutes
                 "location": alert["location"]
             }
             for alert in alerts
@@ -284,8 +309,17 @@ def get_real_time_status(location_id: Optional[str] = Query(None)):
         "systemStatus": "operational" if len(alerts) < 3 else "warning" if len(alerts) < 6 else "critical"
     }
 
+@router.get("/real-time-status/stream")
+async def stream_real_time_status(location_id: Optional[str] = Query(None)):
+    """Server-sent events: a `snapshot` of the real-time status, then `delta` events with changed keys"""
+    return StreamingResponse(
+        live.events(get_db(), location_id),
+        media_type=live.SSE_MEDIA_TYPE,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.get("/efficiency-trends")
-def get_efficiency_trends(
+async def get_efficiency_trends(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -325,7 +359,7 @@ def get_efficiency_trends(
         {"$limit": 100}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     return {
         "xAxis": [r["_id"] for r in results],
@@ -364,7 +398,7 @@ def get_efficiency_trends(
     }
 
 @router.get("/top-performers")
-def get_top_performers(
+async def get_top_performers(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     metric: str = Query("efficiency", description="efficiency, oee, production, availability"),
@@ -397,7 +431,7 @@ def get_top_performers(
         {"$limit": top_n}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     return {
         "data": [
@@ -415,94 +449,60 @@ def get_top_performers(
     }
 
 @router.get("/anomaly-detection")
-def get_anomaly_detection(
+async def get_anomaly_detection(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
-    threshold: float = Query(2.0, description="Standard deviation threshold for anomalies")
+    threshold: float = Query(2.0, description="Standard deviation threshold for anomalies"),
+    method: str = Query("zscore", description="zscore (mean/std) or robust (median/MAD)")
 ):
     """Detect anomalies in production data"""
     db = get_db()
     
-    query = {}
-    if start_date and end_date:
-        query["createdAt"] = {
-            "$gte": datetime.fromisoformat(start_date),
-            "$lte": datetime.fromisoformat(end_date)
+    start = datetime.fromisoformat(start_date) if start_date and end_date else None
+    end = datetime.fromisoformat(end_date) if start_date and end_date else None
+    
+    # Cycles are scored as they complete against each timer's running stats;
+    # thresholds below what is stored (or a cold store) fall back to timerlogs
+    if threshold >= anomalies.store_threshold() and await anomalies.ready(db):
+        source = anomalies.ANOMALIES
+        rows = await anomalies.find_anomalies(db, threshold, method, start, end, location_id)
+    else:
+        source = "timerlogs"
+        query = {}
+        if start is not None:
+            query["createdAt"] = {"$gte": start, "$lte": end}
+        if location_id:
+            query["locationId"] = location_id
+        rows = await aggregate(db.timerlogs, anomalies.raw_pipeline(query, threshold))
+    
+    score = "robustZ" if method == "robust" and source == anomalies.ANOMALIES else "zScore"
+    found = [
+        {
+            "timerId": str(row["timerId"]) if row.get("timerId") else None,
+            "timestamp": row["time"].isoformat(),
+            "duration": round(row["duration"] / (60 * 1000), 2),  # minutes
+            "avgDuration": round(row["mean"] / (60 * 1000), 2),
+            "zScore": round(row[score], 2),
+            "reason": row["reason"],
+            "severity": "high" if abs(row[score]) > threshold * 1.5 else "medium"
         }
-    if location_id:
-        query["locationId"] = location_id
-    
-    # Get cycle time anomalies
-    pipeline = [
-        {"$match": query},
-        {"$addFields": {
-            "cycleTime": {"$subtract": ["$endedAt", "$createdAt"]}
-        }},
-        {"$group": {
-            "_id": "$timerId",
-            "cycles": {"$push": {
-                "time": "$createdAt",
-                "duration": "$cycleTime",
-                "reason": "$stopReason"
-            }},
-            "avgCycle": {"$avg": "$cycleTime"},
-            "stdDev": {"$stdDevPop": "$cycleTime"}
-        }},
-        {"$unwind": "$cycles"},
-        {"$addFields": {
-            "zScore": {
-                "$cond": [
-                    {"$gt": ["$stdDev", 0]},
-                    {"$divide": [
-                        {"$subtract": ["$cycles.duration", "$avgCycle"]},
-                        "$stdDev"
-                    ]},
-                    0
-                ]
-            }
-        }},
-        {"$match": {
-            "$or": [
-                {"zScore": {"$gt": threshold}},
-                {"zScore": {"$lt": {"$multiply": [threshold, -1]}}}
-            ]
-        }},
-        {"$sort": {"cycles.time": -1}},
-        {"$limit": 50}
+        for row in rows
     ]
     
-    anomalies = list(db.timerlogs.aggregate(pipeline))
-    
     return {
-        "anomalies": [
-            {
-                "timerId": str(anomaly["_id"]) if anomaly.get("_id") else None,
-                "timestamp": anomaly["cycles"]["time"].isoformat(),
-                "duration": round(anomaly["cycles"]["duration"] / (60 * 1000), 2),  # minutes
-                "avgDuration": round(anomaly["avgCycle"] / (60 * 1000), 2),
-                "zScore": round(anomaly["zScore"], 2),
-                "reason": anomaly["cycles"]["reason"],
-                "severity": "high" if abs(anomaly["zScore"]) > threshold * 1.5 else "medium"
-            }
-            for anomaly in anomalies
-        ],
+        "anomalies": found,
         "summary": {
-            "totalAnomalies": len(anomalies),
-            "highSeverity": len([a for a in anomalies if abs(a["zScore"]) > threshold * 1.5]),
-            "threshold": threshold
+            "totalAnomalies": len(found),
+            "highSeverity": len([a for a in found if a["severity"] == "high"]),
+            "threshold": threshold,
+            "method": score,
+            "source": source
         }
     }
 
-@router.get("/predictive-maintenance")
-def get_predictive_maintenance(
-    location_id: Optional[str] = Query(None),
-    days_ahead: int = Query(7, description="Days to predict ahead")
-):
-    """Get predictive maintenance recommendations"""
-    db = get_db()
-    
-    # Calculate machine health scores based on recent performance
+async def _machine_health_from_logs(db, location_id: Optional[str]) -> List[Dict[str, Any]]:
+    """Machine health over the last 30 days of raw timerlogs (before the feature store is built)"""
     last_30_days = datetime.now() - timedelta(days=30)
     
     query = {"createdAt": {"$gte": last_30_days}}
@@ -521,6 +521,7 @@ def get_predictive_maintenance(
             "location": {"$first": "$locationId"}
         }},
         {"$addFields": {
+            "machineId": "$_id",
             "downtimeRatio": {"$divide": ["$downtimeEvents", "$totalEvents"]},
             "healthScore": {
                 "$multiply": [
@@ -539,7 +540,23 @@ def get_predictive_maintenance(
         {"$sort": {"healthScore": 1}}
     ]
     
-    machine_health = list(db.timerlogs.aggregate(pipeline))
+    return await aggregate(db.timerlogs, pipeline)
+
+@router.get("/predictive-maintenance")
+async def get_predictive_maintenance(
+    location_id: Optional[str] = Query(None),
+    days_ahead: int = Query(7, description="Days to predict ahead")
+):
+    """Get predictive maintenance recommendations"""
+    db = get_db()
+    
+    # Daily per-machine features: reads at most 90 small rows per machine
+    if await features.ready(db):
+        source = features.FEATURES
+        machine_health = await features.machine_health(db, location_id, days_ahead)
+    else:
+        source = "timerlogs"
+        machine_health = await _machine_health_from_logs(db, location_id)
     
     # Generate maintenance recommendations
     recommendations = []
@@ -561,15 +578,27 @@ def get_predictive_maintenance(
             priority = "medium"
             reason = f"High cycle time variability"
         
+        # A declining trend can bring health below 70% within the forecast horizon
+        until_alert = machine.get("daysUntilAlert")
+        if priority == "low" and until_alert is not None and until_alert <= days_ahead:
+            priority = "medium"
+            reason = f"Health projected below 70% in {until_alert:.0f} days"
+        
         if priority != "low":
+            estimated_days = 3 if priority == "high" else 7
+            if until_alert is not None and priority != "high":
+                estimated_days = max(1, min(estimated_days, int(until_alert)))
             recommendations.append({
-                "machineId": machine["_id"],
+                "machineId": machine["machineId"],
                 "location": machine["location"],
                 "priority": priority,
                 "healthScore": round(health_score, 1),
                 "reason": reason,
                 "recommendedAction": "Schedule inspection" if priority == "medium" else "Immediate maintenance required",
-                "estimatedDays": 3 if priority == "high" else 7
+                "estimatedDays": estimated_days,
+                "projectedHealthScore": machine.get("projectedHealthScore"),
+                "trendPerDay": machine.get("trendPerDay"),
+                "windows": machine.get("windows")
             })
     
     return {
@@ -578,6 +607,8 @@ def get_predictive_maintenance(
             "totalMachines": len(machine_health),
             "highPriority": len([r for r in recommendations if r["priority"] == "high"]),
             "mediumPriority": len([r for r in recommendations if r["priority"] == "medium"]),
-            "averageHealthScore": round(sum(m["healthScore"] for m in machine_health) / len(machine_health), 1) if machine_health else 0
+            "averageHealthScore": round(sum(m["healthScore"] for m in machine_health) / len(machine_health), 1) if machine_health else 0,
+            "daysAhead": days_ahead,
+            "source": source
         }
     }
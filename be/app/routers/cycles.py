@@ -1,14 +1,19 @@
 from __future__ import annotations
 
 from datetime import datetime
-from typing import Optional
+from typing import Any, AsyncIterator, Optional, Tuple
 
 from fastapi import APIRouter, Query
 
 from app.db import get_db
+from app.pagination import (
+    CursorError, Page, bad_cursor, decode_cursor, encode_cursor, fingerprint, keyset_match, sort_keys,
+)
+from app.responses import FastJSONRoute
 from app.schemas import CycleTimesResponse
+from app.streaming import ndjson_response, stream_batch_size, wants_ndjson
 
-router = APIRouter(prefix="/v1", tags=["cycles"])
+router = APIRouter(prefix="/v1", tags=["cycles"], route_class=FastJSONRoute)
 
 
 def _parse_dt(s: Optional[str]) -> Optional[datetime]:
@@ -20,68 +25,116 @@ def _parse_dt(s: Optional[str]) -> Optional[datetime]:
         return None
 
 
-@router.get("/cycle-times", response_model=CycleTimesResponse)
-def cycle_times(
-    timer_id: Optional[str] = Query(None),
-    from_ts: Optional[str] = Query(None, description="ISO datetime"),
-    to_ts: Optional[str] = Query(None, description="ISO datetime"),
-    limit: int = Query(200, le=5000),
-):
-    db = get_db()
-    # Prefer "cycletimers" collection (ada index timerId, clientStartedAt, endAt)
-    match: dict = {}
-    if timer_id:
-        match["timerId"] = timer_id
-    dt_from = _parse_dt(from_ts)
-    dt_to = _parse_dt(to_ts)
-    if dt_from or dt_to:
-        match["clientStartedAt"] = {}
-        if dt_from:
-            match["clientStartedAt"]["$gte"] = dt_from
-        if dt_to:
-            match["clientStartedAt"]["$lte"] = dt_to
-
-    cursor = (
-        db["cycletimers"]
-        .find(match, {"clientStartedAt": 1, "endAt": 1})
-        .sort("clientStartedAt", 1)
-        .limit(limit)
-    )
+async def _cycle_items(
+    db,
+    timer_id: Optional[str],
+    dt_from: Optional[datetime],
+    dt_to: Optional[datetime],
+    limit: int,
+    page: Page,
+    position: Optional[Tuple[str, Any, Any]] = None,
+    query: str = "",
+) -> AsyncIterator[dict]:
+    """One page of cycles in (start time, _id) order.
 
-    items = []
-    for doc in cursor:
-        st = doc.get("clientStartedAt")
-        en = doc.get("endAt")
-        if st and en:
-            cycle = (en - st).total_seconds()
-            items.append({"t": st.isoformat(), "cycleSec": float(cycle)})
+    ``position`` is the decoded cursor of the previous page; the token of
+    the next one is left in ``page.next_cursor``.
+    """
+    source, after_key = (position[0], position[1:]) if position else ("cycletimers", None)
 
-    # Fallback: jika kosong, coba ambil dari timerlogs.cycle
-    if not items:
-        match_logs: dict = {}
+    # Prefer "cycletimers" collection (ada index timerId, clientStartedAt, endAt)
+    if source == "cycletimers":
+        match: dict = {}
         if timer_id:
-            match_logs["timerId"] = timer_id
+            match["timerId"] = timer_id
         if dt_from or dt_to:
-            match_logs["createdAt"] = {}
+            match["clientStartedAt"] = {}
             if dt_from:
-                match_logs["createdAt"]["$gte"] = dt_from
+                match["clientStartedAt"]["$gte"] = dt_from
             if dt_to:
-                match_logs["createdAt"]["$lte"] = dt_to
-        cursor2 = (
-            db["timerlogs"]
-            .find(match_logs, {"createdAt": 1, "cycle": 1})
-            .sort("createdAt", 1)
-            .limit(limit)
+                match["clientStartedAt"]["$lte"] = dt_to
+
+        cursor = (
+            db["cycletimers"]
+            .find(keyset_match(match, "clientStartedAt", after_key), {"clientStartedAt": 1, "endAt": 1})
+            .sort(sort_keys("clientStartedAt"))
+            .limit(limit + 1)
+            .batch_size(min(limit + 1, stream_batch_size()))
         )
-        for doc in cursor2:
-            if doc.get("cycle") is not None and doc.get("createdAt") is not None:
-                created_at = doc["createdAt"]
-                # Handle both datetime objects and strings
-                if isinstance(created_at, str):
-                    time_str = created_at
-                else:
-                    time_str = created_at.isoformat()
-                items.append({"t": time_str, "cycleSec": float(doc["cycle"])})
 
-    return {"items": items}
+        found = False
+        read = 0
+        last = None
+        async for doc in cursor:
+            if read == limit:
+                page.next_cursor = encode_cursor("cycletimers", last["clientStartedAt"], last["_id"], query)
+                break
+            read += 1
+            last = doc
+            st = doc.get("clientStartedAt")
+            en = doc.get("endAt")
+            if st and en:
+                cycle = (en - st).total_seconds()
+                found = True
+                yield {"t": st.isoformat(), "cycleSec": float(cycle)}
+        if found or position is not None:
+            return
+        page.next_cursor = None  # nothing on the first page: fall back to timerlogs
 
+    # Fallback: jika kosong, coba ambil dari timerlogs.cycle
+    match_logs: dict = {}
+    if timer_id:
+        match_logs["timerId"] = timer_id
+    if dt_from or dt_to:
+        match_logs["createdAt"] = {}
+        if dt_from:
+            match_logs["createdAt"]["$gte"] = dt_from
+        if dt_to:
+            match_logs["createdAt"]["$lte"] = dt_to
+    cursor2 = (
+        db["timerlogs"]
+        .find(keyset_match(match_logs, "createdAt", after_key), {"createdAt": 1, "cycle": 1})
+        .sort(sort_keys("createdAt"))
+        .limit(limit + 1)
+        .batch_size(min(limit + 1, stream_batch_size()))
+    )
+    read = 0
+    last = None
+    async for doc in cursor2:
+        if read == limit:
+            page.next_cursor = encode_cursor("timerlogs", last["createdAt"], last["_id"], query)
+            break
+        read += 1
+        last = doc
+        if doc.get("cycle") is not None and doc.get("createdAt") is not None:
+            created_at = doc["createdAt"]
+            # Handle both datetime objects and strings
+            if isinstance(created_at, str):
+                time_str = created_at
+            else:
+                time_str = created_at.isoformat()
+            yield {"t": time_str, "cycleSec": float(doc["cycle"])}
+
+
+@router.get("/cycle-times", response_model=CycleTimesResponse)
+async def cycle_times(
+    timer_id: Optional[str] = Query(None),
+    from_ts: Optional[str] = Query(None, description="ISO datetime"),
+    to_ts: Optional[str] = Query(None, description="ISO datetime"),
+    limit: int = Query(200, ge=1, le=5000),
+    cursor: Optional[str] = Query(None, description="nextCursor of the previous page"),
+    format: Optional[str] = Query(None, description="json (default) or ndjson to stream one item per line"),
+):
+    db = get_db()
+    query = fingerprint(timer_id=timer_id, from_ts=from_ts, to_ts=to_ts)
+    try:
+        position = decode_cursor(cursor, query) if cursor else None
+        if position and position[0] not in ("cycletimers", "timerlogs"):
+            raise CursorError("cursor is not a valid continuation token")
+    except CursorError as e:
+        return bad_cursor(e)
+    page = Page()
+    items = _cycle_items(db, timer_id, _parse_dt(from_ts), _parse_dt(to_ts), limit, page, position, query)
+    if wants_ndjson(format):
+        return ndjson_response(page.with_trailer(items))
+    return {"items": [item async for item in items], "nextCursor": page.next_cursor}
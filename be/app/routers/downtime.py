@@ -5,10 +5,11 @@ from typing import Optional
 
 from fastapi import APIRouter, Query
 
-from app.db import get_db
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
 from app.schemas import DowntimeResponse
 
-router = APIRouter(prefix="/v1/downtime", tags=["downtime"])
+router = APIRouter(prefix="/v1/downtime", tags=["downtime"], route_class=FastJSONRoute)
 
 
 def _parse_dt(s: Optional[str]) -> Optional[datetime]:
@@ -21,7 +22,7 @@ def _parse_dt(s: Optional[str]) -> Optional[datetime]:
 
 
 @router.get("/reasons", response_model=DowntimeResponse)
-def downtime_reasons(
+async def downtime_reasons(
     location_id: Optional[str] = Query(None),
     from_ts: Optional[str] = Query(None, description="ISO datetime"),
     to_ts: Optional[str] = Query(None, description="ISO datetime"),
@@ -64,7 +65,7 @@ def downtime_reasons(
     ]
 
     try:
-        agg = list(db["timerlogs"].aggregate(pipeline))
+        agg = await aggregate(db["timerlogs"], pipeline)
     except Exception as e:
         # Return empty result if aggregation fails
         agg = []
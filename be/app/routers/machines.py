@@ -2,13 +2,38 @@ from __future__ import annotations
 
 from fastapi import APIRouter, Query
 from datetime import datetime, timedelta
-from typing import Optional, List, Dict, Any
-from app.db import get_db
+from typing import Optional, List, Dict, Any, Hashable
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
+from app.pivot import heatmap_triples, index_cells, series_by_column
 
-router = APIRouter(prefix="/machines", tags=["Machines Analytics"])
+router = APIRouter(prefix="/machines", tags=["Machines Analytics"], route_class=FastJSONRoute)
+
+async def _machines_with_log_stats(db, machine_match, log_match, accumulators):
+    """Load the machine set and one ``$group`` of its timerlogs by machineId.
+
+    Replaces a correlated ``$lookup`` per machine: timerlogs are scanned
+    once and joined to the (small) machines list in memory.
+    """
+    machines = await aggregate(db.machines, [
+        {"$match": machine_match},
+        {"$project": {"name": 1, "machineClassId": 1, "locationId": 1}}
+    ])
+    
+    group_match = dict(log_match)
+    if machine_match:
+        # Only the selected machines' logs are needed
+        group_match["machineId"] = {"$in": [m["_id"] for m in machines]}
+    
+    stats = await aggregate(db.timerlogs, [
+        {"$match": group_match},
+        {"$group": {"_id": "$machineId", **accumulators}}
+    ])
+    by_machine = {s["_id"]: s for s in stats if isinstance(s["_id"], Hashable)}
+    return [(m, by_machine.get(m["_id"], {})) for m in machines]
 
 @router.get("/utilization-chart")
-def get_machine_utilization_chart(
+async def get_machine_utilization_chart(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -18,9 +43,6 @@ def get_machine_utilization_chart(
     """Get machine utilization data"""
     db = get_db()
     
-    # Join machines with timer logs to get utilization data
-    pipeline = []
-    
     # Match criteria
     match_stage = {}
     if location_id:
@@ -28,78 +50,53 @@ def get_machine_utilization_chart(
     if machine_class_id:
         match_stage["machineClassId"] = machine_class_id
     
-    if match_stage:
-        pipeline.append({"$match": match_stage})
-    
-    # Lookup timer logs
-    lookup_match = {}
+    # Timer log filter
+    log_match = {}
     if start_date and end_date:
-        lookup_match["createdAt"] = {
+        log_match["createdAt"] = {
             "$gte": datetime.fromisoformat(start_date),
             "$lte": datetime.fromisoformat(end_date)
         }
     
-    pipeline.extend([
-        {"$lookup": {
-            "from": "timerlogs",
-            "let": {"machineId": "$_id"},
-            "pipeline": [
-                {"$match": {
-                    "$expr": {"$eq": ["$machineId", "$$machineId"]},
-                    **lookup_match
-                }},
-                {"$group": {
-                    "_id": None,
-                    "totalRuntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
-                    "logCount": {"$sum": 1},
-                    "productiveTime": {"$sum": {
-                        "$cond": [
-                            {"$eq": ["$stopReason", "Unit Created"]},
-                            {"$subtract": ["$endedAt", "$createdAt"]},
-                            0
-                        ]
-                    }}
-                }}
-            ],
-            "as": "utilization"
-        }},
-        {"$addFields": {
-            "utilizationData": {"$arrayElemAt": ["$utilization", 0]}
-        }},
-        {"$project": {
-            "machineName": "$name",
-            "machineClass": "$machineClassId",
-            "location": "$locationId",
-            "totalRuntime": {"$ifNull": ["$utilizationData.totalRuntime", 0]},
-            "logCount": {"$ifNull": ["$utilizationData.logCount", 0]},
-            "productiveTime": {"$ifNull": ["$utilizationData.productiveTime", 0]},
-            "utilizationRate": {
-                "$cond": [
-                    {"$gt": ["$utilizationData.totalRuntime", 0]},
-                    {"$multiply": [
-                        {"$divide": ["$utilizationData.productiveTime", "$utilizationData.totalRuntime"]},
-                        100
-                    ]},
-                    0
-                ]
-            }
-        }},
-        {"$sort": {"utilizationRate": -1}}
-    ])
-    
-    results = list(db.machines.aggregate(pipeline))
+    joined = await _machines_with_log_stats(db, match_stage, log_match, {
+        "totalRuntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
+        "logCount": {"$sum": 1},
+        "productiveTime": {"$sum": {
+            "$cond": [
+                {"$eq": ["$stopReason", "Unit Created"]},
+                {"$subtract": ["$endedAt", "$createdAt"]},
+                0
+            ]
+        }}
+    })
+    
+    results = []
+    for machine, stats in joined:
+        total_runtime = stats.get("totalRuntime") or 0
+        productive_time = stats.get("productiveTime") or 0
+        results.append({
+            "_id": machine["_id"],
+            "machineName": machine.get("name"),
+            "machineClass": machine.get("machineClassId"),
+            "location": machine.get("locationId"),
+            "totalRuntime": total_runtime,
+            "logCount": stats.get("logCount") or 0,
+            "productiveTime": productive_time,
+            "utilizationRate": productive_time / total_runtime * 100 if total_runtime > 0 else 0
+        })
+    results.sort(key=lambda r: r["utilizationRate"], reverse=True)
     
     if chart_type == "heatmap":
         # Create heatmap data
         locations = sorted(list(set([r["location"] for r in results if r["location"]])))
         machines = [r["machineName"] or f"Machine {i}" for i, r in enumerate(results)]
         
-        data = []
-        for i, machine in enumerate(machines):
-            for j, location in enumerate(locations):
-                machine_data = next((r for r in results if r["machineName"] == machine and r["location"] == location), None)
-                utilization = machine_data["utilizationRate"] if machine_data else 0
-                data.append([i, j, round(utilization, 2)])
+        cells = index_cells(
+            results,
+            key=lambda r: (r["machineName"], r["location"]),
+            value=lambda r: round(r["utilizationRate"], 2)
+        )
+        data = heatmap_triples(cells, machines, locations)
         
         return {
             "data": data,
@@ -125,7 +122,7 @@ def get_machine_utilization_chart(
     }
 
 @router.get("/status-distribution")
-def get_machine_status_distribution(
+async def get_machine_status_distribution(
     location_id: Optional[str] = Query(None),
     chart_type: str = Query("pie", description="pie, doughnut, bar")
 ):
@@ -146,7 +143,7 @@ def get_machine_status_distribution(
         {"$sort": {"count": -1}}
     ])
     
-    results = list(db.machines.aggregate(pipeline))
+    results = await aggregate(db.machines, pipeline)
     
     if chart_type in ["pie", "doughnut"]:
         return {
@@ -171,7 +168,7 @@ def get_machine_status_distribution(
     }
 
 @router.get("/performance-matrix")
-def get_machine_performance_matrix(
+async def get_machine_performance_matrix(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -184,67 +181,37 @@ def get_machine_performance_matrix(
     if location_id:
         match_stage["locationId"] = location_id
     
-    lookup_match = {}
+    log_match = {}
     if start_date and end_date:
-        lookup_match["createdAt"] = {
+        log_match["createdAt"] = {
             "$gte": datetime.fromisoformat(start_date),
             "$lte": datetime.fromisoformat(end_date)
         }
     
-    pipeline = [
-        {"$match": match_stage},
-        {"$lookup": {
-            "from": "timerlogs",
-            "let": {"machineId": "$_id"},
-            "pipeline": [
-                {"$match": {
-                    "$expr": {"$eq": ["$machineId", "$$machineId"]},
-                    **lookup_match
-                }},
-                {"$group": {
-                    "_id": None,
-                    "totalLogs": {"$sum": 1},
-                    "productiveLogs": {"$sum": {
-                        "$cond": [{"$eq": ["$stopReason", "Unit Created"]}, 1, 0]
-                    }},
-                    "totalRuntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
-                    "avgCycleTime": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}}
-                }}
-            ],
-            "as": "performance"
-        }},
-        {"$addFields": {
-            "perfData": {"$arrayElemAt": ["$performance", 0]}
-        }},
-        {"$project": {
-            "machineName": "$name",
-            "machineClass": "$machineClassId",
-            "location": "$locationId",
-            "efficiency": {
-                "$cond": [
-                    {"$gt": ["$perfData.totalLogs", 0]},
-                    {"$multiply": [
-                        {"$divide": ["$perfData.productiveLogs", "$perfData.totalLogs"]},
-                        100
-                    ]},
-                    0
-                ]
-            },
-            "utilization": {
-                "$cond": [
-                    {"$gt": ["$perfData.totalRuntime", 0]},
-                    {"$divide": ["$perfData.totalRuntime", 28800000]}, # 8 hours in ms
-                    0
-                ]
-            },
-            "totalLogs": {"$ifNull": ["$perfData.totalLogs", 0]},
-            "avgCycleTime": {"$ifNull": ["$perfData.avgCycleTime", 0]}
+    joined = await _machines_with_log_stats(db, match_stage, log_match, {
+        "totalLogs": {"$sum": 1},
+        "productiveLogs": {"$sum": {
+            "$cond": [{"$eq": ["$stopReason", "Unit Created"]}, 1, 0]
         }},
-        {"$match": {"totalLogs": {"$gt": 0}}},
-        {"$limit": top_n}
-    ]
-    
-    results = list(db.machines.aggregate(pipeline))
+        "totalRuntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
+        "avgCycleTime": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}}
+    })
+    
+    results = []
+    for machine, stats in joined:
+        total_logs = stats.get("totalLogs") or 0
+        if total_logs <= 0:
+            continue
+        total_runtime = stats.get("totalRuntime") or 0
+        results.append({
+            "machineName": machine.get("name"),
+            "efficiency": (stats.get("productiveLogs") or 0) / total_logs * 100,
+            "utilization": total_runtime / 28800000 if total_runtime > 0 else 0,  # 8 hours in ms
+            "totalLogs": total_logs,
+            "avgCycleTime": stats.get("avgCycleTime") or 0
+        })
+        if len(results) >= top_n:
+            break
     
     # Format for scatter plot
     scatter_data = []
@@ -264,7 +231,7 @@ def get_machine_performance_matrix(
     }
 
 @router.get("/downtime-ranking")
-def get_machine_downtime_ranking(
+async def get_machine_downtime_ranking(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -277,50 +244,34 @@ def get_machine_downtime_ranking(
     if location_id:
         match_stage["locationId"] = location_id
     
-    lookup_match = {"stopReason": {"$ne": "Unit Created"}}
+    log_match = {"stopReason": {"$ne": "Unit Created"}}
     if start_date and end_date:
-        lookup_match["createdAt"] = {
+        log_match["createdAt"] = {
             "$gte": datetime.fromisoformat(start_date),
             "$lte": datetime.fromisoformat(end_date)
         }
     
-    pipeline = [
-        {"$match": match_stage},
-        {"$lookup": {
-            "from": "timerlogs",
-            "let": {"machineId": "$_id"},
-            "pipeline": [
-                {"$match": {
-                    "$expr": {"$eq": ["$machineId", "$$machineId"]},
-                    **lookup_match
-                }},
-                {"$group": {
-                    "_id": None,
-                    "downtimeEvents": {"$sum": 1},
-                    "totalDowntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
-                    "avgDowntime": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
-                    "maxDowntime": {"$max": {"$subtract": ["$endedAt", "$createdAt"]}}
-                }}
-            ],
-            "as": "downtime"
-        }},
-        {"$addFields": {
-            "downtimeData": {"$arrayElemAt": ["$downtime", 0]}
-        }},
-        {"$project": {
-            "machineName": "$name",
-            "location": "$locationId",
-            "downtimeEvents": {"$ifNull": ["$downtimeData.downtimeEvents", 0]},
-            "totalDowntime": {"$ifNull": ["$downtimeData.totalDowntime", 0]},
-            "avgDowntime": {"$ifNull": ["$downtimeData.avgDowntime", 0]},
-            "maxDowntime": {"$ifNull": ["$downtimeData.maxDowntime", 0]}
-        }},
-        {"$match": {"downtimeEvents": {"$gt": 0}}},
-        {"$sort": {"totalDowntime": -1}},
-        {"$limit": top_n}
+    joined = await _machines_with_log_stats(db, match_stage, log_match, {
+        "downtimeEvents": {"$sum": 1},
+        "totalDowntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
+        "avgDowntime": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
+        "maxDowntime": {"$max": {"$subtract": ["$endedAt", "$createdAt"]}}
+    })
+    
+    results = [
+        {
+            "machineName": machine.get("name"),
+            "location": machine.get("locationId"),
+            "downtimeEvents": stats.get("downtimeEvents") or 0,
+            "totalDowntime": stats.get("totalDowntime") or 0,
+            "avgDowntime": stats.get("avgDowntime") or 0,
+            "maxDowntime": stats.get("maxDowntime") or 0
+        }
+        for machine, stats in joined
+        if (stats.get("downtimeEvents") or 0) > 0
     ]
-    
-    results = list(db.machines.aggregate(pipeline))
+    results.sort(key=lambda r: r["totalDowntime"], reverse=True)
+    results = results[:top_n]
     
     return {
         "xAxis": [r["machineName"] or f"Machine {i}" for i, r in enumerate(results)],
@@ -346,7 +297,7 @@ def get_machine_downtime_ranking(
     }
 
 @router.get("/machine-classes")
-def get_machine_class_analytics(
+async def get_machine_class_analytics(
     chart_type: str = Query("bar", description="bar, pie, treemap"),
     metric: str = Query("count", description="count, efficiency, utilization")
 ):
@@ -372,7 +323,7 @@ def get_machine_class_analytics(
         {"$sort": {"machineCount": -1}}
     ]
     
-    results = list(db.machines.aggregate(pipeline))
+    results = await aggregate(db.machines, pipeline)
     
     if chart_type == "treemap":
         return {
@@ -417,7 +368,7 @@ def get_machine_class_analytics(
     }
 
 @router.get("/availability-timeline")
-def get_machine_availability_timeline(
+async def get_machine_availability_timeline(
     machine_id: Optional[str] = Query(None),
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
@@ -479,19 +430,18 @@ def get_machine_availability_timeline(
         {"$sort": {"_id.time": 1}}
     ]
     
-    results = list(db.timerlogs.aggregate(pipeline))
+    results = await aggregate(db.timerlogs, pipeline)
     
     # Group by machine
     machines = sorted(list(set([r["_id"]["machine"] for r in results if r["_id"]["machine"]])))
     times = sorted(list(set([r["_id"]["time"] for r in results])))
     
-    series_data = {}
-    for machine in machines:
-        series_data[machine] = []
-        for time in times:
-            availability = next((r["availability"] for r in results 
-                               if r["_id"]["time"] == time and r["_id"]["machine"] == machine), 0)
-            series_data[machine].append(round(availability, 2))
+    cells = index_cells(
+        results,
+        key=lambda r: (r["_id"]["time"], r["_id"]["machine"]),
+        value=lambda r: round(r["availability"], 2)
+    )
+    series_data = series_by_column(cells, times, machines)
     
     return {
         "xAxis": times,
@@ -506,7 +456,7 @@ def get_machine_availability_timeline(
     }
 
 @router.get("/machine-summary")
-def get_machine_summary():
+async def get_machine_summary():
     """Get overall machine summary statistics"""
     db = get_db()
     
@@ -521,7 +471,7 @@ def get_machine_summary():
         }}
     ]
     
-    result = list(db.machines.aggregate(pipeline))
+    result = await aggregate(db.machines, pipeline)
     
     if not result:
         return {
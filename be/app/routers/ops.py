@@ -0,0 +1,132 @@
+from __future__ import annotations
+
+from typing import Optional
+
+from fastapi import APIRouter, Query
+
+from app import anomalies, background, compression, dailystats, features, hll, indexes, live, open_timers, watchers
+from app.cache import cache_stats, get_cache
+from app.db import get_db
+from app.responses import FastJSONRoute
+from app.rollups import HOURLY, rollup_available
+from app.sketches import SKETCH
+from app.singleflight import group
+from app.watermarks import get_state
+
+router = APIRouter(prefix="/v1/ops", tags=["ops"], route_class=FastJSONRoute)
+
+
+@router.get("/cache")
+async def cache_status():
+    return {**cache_stats(), "responses": compression.stats}
+
+
+@router.delete("/cache")
+async def cache_clear():
+    await get_cache().clear()
+    return {"ok": True}
+
+
+@router.get("/singleflight")
+async def singleflight_status():
+    return group.snapshot()
+
+
+@router.get("/rollups")
+async def rollup_status():
+    db = get_db()
+    state = await get_state(db, HOURLY) or {}
+    sketch = await get_state(db, SKETCH) or {}
+    distinct = await get_state(db, hll.HLL) or {}
+    return {
+        "collection": HOURLY,
+        "watermark": str(state["watermark"]) if state.get("watermark") else None,
+        "refreshedAt": state["refreshedAt"].isoformat() if state.get("refreshedAt") else None,
+        "routing": await rollup_available(db),
+        "sketch": {
+            "collection": SKETCH,
+            "watermark": str(sketch["watermark"]) if sketch.get("watermark") else None,
+            "refreshedAt": sketch["refreshedAt"].isoformat() if sketch.get("refreshedAt") else None,
+            "routing": await rollup_available(db, SKETCH),
+        },
+        "hll": {
+            "collection": hll.HLL,
+            "watermark": str(distinct["watermark"]) if distinct.get("watermark") else None,
+            "refreshedAt": distinct["refreshedAt"].isoformat() if distinct.get("refreshedAt") else None,
+            "routing": await rollup_available(db, hll.HLL),
+        },
+        "lastRun": background.last_runs.get("rollups"),
+    }
+
+
+@router.get("/dailystats")
+async def dailystats_status():
+    db = get_db()
+    state = await get_state(db, dailystats.STATE_NAME) or {}
+    return {
+        "collection": dailystats.DAILY,
+        "watermark": str(state["watermark"]) if state.get("watermark") else None,
+        "refreshedAt": state["refreshedAt"].isoformat() if state.get("refreshedAt") else None,
+        "lastRun": background.last_runs.get("dailystats"),
+    }
+
+
+@router.get("/features")
+async def feature_status():
+    db = get_db()
+    state = await get_state(db, features.STATE_NAME) or {}
+    return {
+        "collection": features.FEATURES,
+        "watermark": str(state["watermark"]) if state.get("watermark") else None,
+        "refreshedAt": state["refreshedAt"].isoformat() if state.get("refreshedAt") else None,
+        "lastRun": background.last_runs.get("features"),
+    }
+
+
+@router.get("/anomalies")
+async def anomaly_status():
+    db = get_db()
+    state = await get_state(db, anomalies.STATE_NAME) or {}
+    return {
+        "collection": anomalies.ANOMALIES,
+        "models": await db[anomalies.MODELS].estimated_document_count(),
+        "watermark": state["watermark"].isoformat() if state.get("watermark") else None,
+        "refreshedAt": state["refreshedAt"].isoformat() if state.get("refreshedAt") else None,
+        "lastRun": background.last_runs.get("anomalies"),
+    }
+
+
+@router.get("/watchers")
+async def watcher_status():
+    return {
+        **watchers.snapshot(),
+        "realTimeSubscribers": live.subscriber_count(),
+        "openTimers": {
+            "ready": open_timers.ready(),
+            "open": len(open_timers.registry.logs),
+            "activeTimers": open_timers.registry.active_timers(),
+            "lastRun": background.last_runs.get("open-timers"),
+        },
+    }
+
+
+@router.get("/indexes")
+async def index_status(
+    explain: bool = Query(False, description="Explain registered pipelines and report COLLSCANs"),
+    router_name: Optional[str] = Query(None, alias="router", description="Limit explain to one router"),
+):
+    db = get_db()
+    result = {
+        "missing": await indexes.missing_indexes(db),
+        "bootstrap": background.last_runs.get("indexes"),
+    }
+    if explain:
+        report = await indexes.explain_probes(db, router_name)
+        result["explain"] = report
+        result["collscans"] = [e for e in report if e.get("collscan")]
+    return result
+
+
+@router.post("/indexes")
+async def index_create():
+    return await indexes.ensure_indexes(get_db())
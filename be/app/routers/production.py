@@ -5,10 +5,11 @@ from typing import Optional
 
 from fastapi import APIRouter, Query
 
-from app.db import get_db
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
 from app.schemas import ProductionSummaryResponse
 
-router = APIRouter(prefix="/v1/production", tags=["production"])
+router = APIRouter(prefix="/v1/production", tags=["production"], route_class=FastJSONRoute)
 
 
 def _parse_dt(s: Optional[str]) -> Optional[datetime]:
@@ -21,7 +22,7 @@ def _parse_dt(s: Optional[str]) -> Optional[datetime]:
 
 
 @router.get("/summary", response_model=ProductionSummaryResponse)
-def production_summary(
+async def production_summary(
     location_id: Optional[str] = Query(None),
     from_ts: Optional[str] = Query(None, description="ISO datetime"),
     to_ts: Optional[str] = Query(None, description="ISO datetime"),
@@ -54,7 +55,7 @@ def production_summary(
         {"$sort": {"totalTons": -1}},
     ]
 
-    agg = list(db["counts"].aggregate(pipeline))
+    agg = await aggregate(db["counts"], pipeline)
     items = [
         {
             "timerId": str(a.get("_id")) if a.get("_id") else None,
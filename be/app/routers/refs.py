@@ -3,20 +3,21 @@ from __future__ import annotations
 from fastapi import APIRouter
 
 from app.db import get_db
+from app.responses import FastJSONRoute
 
-router = APIRouter(prefix="/v1/refs", tags=["refs"])
+router = APIRouter(prefix="/v1/refs", tags=["refs"], route_class=FastJSONRoute)
 
 
 @router.get("/basic")
-def refs_basic():
+async def refs_basic():
     db = get_db()
     locs = [
         {"_id": str(d.get("_id")), "name": d.get("name")}
-        for d in db["locations"].find({}, {"name": 1}).sort("name", 1)
+        async for d in db["locations"].find({}, {"name": 1}).sort("name", 1)
     ]
     mcs = [
         {"_id": str(d.get("_id")), "name": d.get("name")}
-        for d in db["machineclasses"].find({}, {"name": 1}).sort("name", 1)
+        async for d in db["machineclasses"].find({}, {"name": 1}).sort("name", 1)
     ]
     return {"locations": locs, "machineclasses": mcs}
 
@@ -5,9 +5,10 @@ from typing import Optional
 
 from fastapi import APIRouter, Query
 
-from app.db import get_db
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
 
-router = APIRouter(prefix="/v1/production", tags=["production"])
+router = APIRouter(prefix="/v1/production", tags=["production"], route_class=FastJSONRoute)
 
 
 def _parse_dt(s: Optional[str]) -> Optional[datetime]:
@@ -20,7 +21,7 @@ def _parse_dt(s: Optional[str]) -> Optional[datetime]:
 
 
 @router.get("/runrate-timeseries")
-def runrate_timeseries(
+async def runrate_timeseries(
     timer_id: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
     from_ts: Optional[str] = Query(None),
@@ -59,7 +60,7 @@ def runrate_timeseries(
         {"$sort": {"_id": 1}},
     ]
 
-    agg = list(db["counts"].aggregate(pipeline))
+    agg = await aggregate(db["counts"], pipeline)
     items = [
         {
             "day": a.get("_id"),
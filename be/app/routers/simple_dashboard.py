@@ -3,56 +3,37 @@ from __future__ import annotations
 from fastapi import APIRouter, Query
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
-from app.db import get_db
-from bson import ObjectId
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
+from app.cache import cached
+from app.overview import compute_kpis
 
-def serialize_doc(doc):
-    """Convert MongoDB document to JSON-serializable format"""
-    if isinstance(doc, dict):
-        return {k: serialize_doc(v) for k, v in doc.items()}
-    elif isinstance(doc, list):
-        return [serialize_doc(item) for item in doc]
-    elif isinstance(doc, ObjectId):
-        return str(doc)
-    elif isinstance(doc, datetime):
-        return doc.isoformat()
-    else:
-        return doc
+router = APIRouter(prefix="/simple-dashboard", tags=["Simple Dashboard"], route_class=FastJSONRoute)
 
-router = APIRouter(prefix="/simple-dashboard", tags=["Simple Dashboard"])
-
-@router.get("/overview")
-def get_simple_dashboard_overview():
-    """Get simple dashboard overview"""
+@cached(ttl=30, collections=("timerlogs", "machines"))
+async def dashboard_overview(profile: bool = False, approx: bool = False):
+    """Simple dashboard overview; shared by the route and the comprehensive dashboard"""
     db = get_db()
     
     try:
-        # Get basic production metrics
-        total_logs = db.timerlogs.count_documents({})
-        
-        # Get production units (Unit Created)
-        production_count = db.timerlogs.count_documents({"stopReason": "Unit Created"})
-        
-        # Get machine count
-        machine_count = db.machines.count_documents({})
-        
-        # Get location count
-        location_count = len(db.timerlogs.distinct("locationId"))
-        
-        # Get unique timers and machines from logs
-        unique_timers = len(db.timerlogs.distinct("timerId"))
-        unique_machines = len(db.timerlogs.distinct("machineId")) or machine_count
-        
-        # Calculate average cycle time (simplified)
-        cycle_pipeline = [
-            {"$match": {"cycle": {"$exists": True, "$gt": 0}}},
-            {"$group": {"_id": None, "avgCycle": {"$avg": "$cycle"}}}
-        ]
-        cycle_result = list(db.timerlogs.aggregate(cycle_pipeline))
-        avg_cycle_time = cycle_result[0]["avgCycle"] / 1000 if cycle_result and cycle_result[0]["avgCycle"] else 120  # seconds
-        
-        # Get downtime count
-        downtime_count = db.timerlogs.count_documents({"stopReason": {"$ne": "Unit Created", "$ne": None}})
+        # All KPIs in one $facet pass over timerlogs (or the hourly rollup) plus one over machines
+        kpis = await compute_kpis(
+            db,
+            ["totalLogs", "produced", "locations", "timers", "machines", "avgCycle", "downtime"],
+            ["total"],
+            profile=profile,
+            approx=approx
+        )
+        logs = kpis["timerlogs"]
+        
+        total_logs = logs["totalLogs"] or 0
+        production_count = logs["produced"] or 0
+        machine_count = kpis["machines"]["total"] or 0
+        location_count = logs["locations"] or 0
+        unique_timers = logs["timers"] or 0
+        unique_machines = logs["machines"] or machine_count
+        avg_cycle_time = logs["avgCycle"] / 1000 if logs["avgCycle"] else 120  # seconds
+        downtime_count = logs["downtime"] or 0
         
         # Calculate simple efficiency
         efficiency = (production_count / total_logs * 100) if total_logs > 0 else 0
@@ -98,6 +79,10 @@ def get_simple_dashboard_overview():
                 "status": "operational",
                 "dataPoints": total_logs,
                 "productionRate": round(efficiency, 1)
+            },
+            "meta": {
+                "source": kpis["source"],
+                "timings": kpis["timings"]
             }
         }
     except Exception as e:
@@ -134,8 +119,20 @@ def get_simple_dashboard_overview():
             }
         }
 
+@router.get("/overview")
+async def get_simple_dashboard_overview(
+    profile: bool = Query(False, description="Include per-facet timings from explain"),
+    approx: bool = Query(False, description="Count unique locations, timers and machines from HyperLogLog sketches")
+):
+    """Get simple dashboard overview"""
+    return await dashboard_overview(profile=profile, approx=approx)
+
+# Encoded responses of this route are cached along with dashboard_overview's result
+get_simple_dashboard_overview.cache_route = dashboard_overview.cache_route
+
 @router.get("/recent-activity")
-def get_recent_activity():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_recent_activity():
     """Get recent activity data"""
     db = get_db()
     
@@ -153,7 +150,7 @@ def get_recent_activity():
             {"$sort": {"_id": 1}}
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
+        results = await aggregate(db.timerlogs, pipeline)
         
         return {
             "hourlyData": {
@@ -175,7 +172,8 @@ def get_recent_activity():
         }
 
 @router.get("/machine-status")
-def get_machine_status():
+@cached(ttl=300, collections=("machines",))
+async def get_machine_status():
     """Get machine status summary"""
     db = get_db()
     
@@ -186,8 +184,7 @@ def get_machine_status():
             {"$sort": {"count": -1}}
         ]
         
-        status_results = list(db.machines.aggregate(pipeline))
-        status_results = serialize_doc(status_results)
+        status_results = await aggregate(db.machines, pipeline)
         
         # Get machine locations
         location_pipeline = [
@@ -195,8 +192,7 @@ def get_machine_status():
             {"$sort": {"machines": -1}}
         ]
         
-        location_results = list(db.machines.aggregate(location_pipeline))
-        location_results = serialize_doc(location_results)
+        location_results = await aggregate(db.machines, location_pipeline)
         
         return {
             "statusDistribution": [
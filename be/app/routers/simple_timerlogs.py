@@ -3,21 +3,24 @@ from __future__ import annotations
 from fastapi import APIRouter, Query
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
-from app.db import get_db
+from app.db import get_db, aggregate, count_documents
+from app.responses import FastJSONRoute
+from app.cache import cached
 
-router = APIRouter(prefix="/simple-timerlogs", tags=["Simple Timer Logs"])
+router = APIRouter(prefix="/simple-timerlogs", tags=["Simple Timer Logs"], route_class=FastJSONRoute)
 
 @router.get("/stats")
-def get_simple_timer_logs_stats():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_simple_timer_logs_stats():
     """Get simple timer logs statistics"""
     db = get_db()
     
     try:
         # Simple count query
-        total_count = db.timerlogs.count_documents({})
+        total_count = await count_documents(db.timerlogs, {})
         
         # Get some recent logs
-        recent_logs = list(db.timerlogs.find().sort("_id", -1).limit(10))
+        recent_logs = await db.timerlogs.find().sort("_id", -1).limit(10).to_list(None)
         
         # Get unique stop reasons
         pipeline = [
@@ -26,7 +29,7 @@ def get_simple_timer_logs_stats():
             {"$limit": 10}
         ]
         
-        stop_reasons = list(db.timerlogs.aggregate(pipeline))
+        stop_reasons = await aggregate(db.timerlogs, pipeline)
         
         # Convert ObjectIds to strings
         processed_stop_reasons = []
@@ -45,7 +48,8 @@ def get_simple_timer_logs_stats():
         return {"error": str(e), "totalCount": 0}
 
 @router.get("/pie-chart")
-def get_simple_pie_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_simple_pie_chart():
     """Get simple pie chart data for stop reasons"""
     db = get_db()
     
@@ -56,7 +60,7 @@ def get_simple_pie_chart():
             {"$limit": 10}
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
+        results = await aggregate(db.timerlogs, pipeline)
         
         return {
             "data": [
@@ -71,7 +75,8 @@ def get_simple_pie_chart():
         return {"error": str(e), "data": []}
 
 @router.get("/bar-chart")
-def get_simple_bar_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_simple_bar_chart():
     """Get simple bar chart data"""
     db = get_db()
     
@@ -82,7 +87,7 @@ def get_simple_bar_chart():
             {"$limit": 10}
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
+        results = await aggregate(db.timerlogs, pipeline)
         
         return {
             "xAxis": [str(r["_id"]) if r["_id"] is not None else "Unknown" for r in results],
@@ -98,7 +103,8 @@ def get_simple_bar_chart():
         return {"error": str(e), "xAxis": [], "series": []}
 
 @router.get("/line-chart")
-def get_simple_line_chart():
+@cached(ttl=60, collections=("timerlogs",))
+async def get_simple_line_chart():
     """Get simple line chart data by date"""
     db = get_db()
     
@@ -116,7 +122,7 @@ def get_simple_line_chart():
             {"$limit": 30}
         ]
         
-        results = list(db.timerlogs.aggregate(pipeline))
+        results = await aggregate(db.timerlogs, pipeline)
         
         return {
             "xAxis": [str(r["_id"]) if r["_id"] is not None else "Unknown" for r in results],
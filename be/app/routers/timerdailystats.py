@@ -3,12 +3,16 @@ from __future__ import annotations
 from fastapi import APIRouter, Query
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
-from app.db import get_db
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
+from app.cache import cached
+from app.pivot import heatmap_triples, index_cells, series_by_column
 
-router = APIRouter(prefix="/timerdailystats", tags=["Timer Daily Stats"])
+router = APIRouter(prefix="/timerdailystats", tags=["Timer Daily Stats"], route_class=FastJSONRoute)
 
 @router.get("/line-chart")
-def get_daily_stats_line_chart(
+@cached(ttl=300, collections=("timerdailystats",))
+async def get_daily_stats_line_chart(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -53,7 +57,7 @@ def get_daily_stats_line_chart(
         {"$limit": limit}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     return {
         "xAxis": [r["_id"] for r in results],
@@ -85,7 +89,8 @@ def get_daily_stats_line_chart(
     }
 
 @router.get("/multi-metric-area")
-def get_daily_stats_multi_metric_area(
+@cached(ttl=300, collections=("timerdailystats",))
+async def get_daily_stats_multi_metric_area(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -114,7 +119,7 @@ def get_daily_stats_multi_metric_area(
         }}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     return {
         "xAxis": [r["date"] for r in results],
@@ -129,7 +134,8 @@ def get_daily_stats_multi_metric_area(
     }
 
 @router.get("/production-trend")
-def get_production_trend(
+@cached(ttl=300, collections=("timerdailystats",))
+async def get_production_trend(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_ids: Optional[str] = Query(None, description="Comma-separated location IDs"),
@@ -170,32 +176,24 @@ def get_production_trend(
         {"$sort": {"_id.period": 1, "_id.location": 1}}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     # Organize by location
     locations = sorted(list(set([r["_id"]["location"] for r in results if r["_id"]["location"]])))
     periods = sorted(list(set([r["_id"]["period"] for r in results])))
     
-    series_data = {}
-    for location in locations:
-        series_data[location] = {
-            "production": [],
-            "efficiency": [],
-            "runtime": [],
-            "downtime": []
+    cells = index_cells(results, key=lambda r: (r["_id"]["period"], r["_id"]["location"]))
+    empty = {"totalProduced": 0, "avgEfficiency": 0, "totalRuntime": 0, "totalDowntime": 0}
+    by_location = series_by_column(cells, periods, locations, fill=empty)
+    series_data = {
+        location: {
+            "production": [r["totalProduced"] for r in rows],
+            "efficiency": [round(r["avgEfficiency"] or 0, 2) for r in rows],
+            "runtime": [r["totalRuntime"] for r in rows],
+            "downtime": [r["totalDowntime"] for r in rows]
         }
-        for period in periods:
-            result = next((r for r in results if r["_id"]["period"] == period and r["_id"]["location"] == location), None)
-            if result:
-                series_data[location]["production"].append(result["totalProduced"])
-                series_data[location]["efficiency"].append(round(result["avgEfficiency"] or 0, 2))
-                series_data[location]["runtime"].append(result["totalRuntime"])
-                series_data[location]["downtime"].append(result["totalDowntime"])
-            else:
-                series_data[location]["production"].append(0)
-                series_data[location]["efficiency"].append(0)
-                series_data[location]["runtime"].append(0)
-                series_data[location]["downtime"].append(0)
+        for location, rows in by_location.items()
+    }
     
     return {
         "xAxis": periods,
@@ -219,7 +217,8 @@ def get_production_trend(
     }
 
 @router.get("/oee-breakdown")
-def get_oee_breakdown(
+@cached(ttl=300, collections=("timerdailystats",))
+async def get_oee_breakdown(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -249,7 +248,7 @@ def get_oee_breakdown(
         {"$sort": {"_id": 1}}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     if chart_type == "radar":
         # Average values for radar chart
@@ -294,7 +293,8 @@ def get_oee_breakdown(
     }
 
 @router.get("/efficiency-heatmap")
-def get_efficiency_heatmap(
+@cached(ttl=300, collections=("timerdailystats",))
+async def get_efficiency_heatmap(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     granularity: str = Query("daily", description="daily, weekly, monthly")
@@ -326,18 +326,19 @@ def get_efficiency_heatmap(
         }}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     # Format for heatmap
     data = []
     times = sorted(list(set([r["_id"]["time"] for r in results])))
     locations = sorted(list(set([r["_id"]["location"] for r in results if r["_id"]["location"]])))
     
-    for i, time in enumerate(times):
-        for j, location in enumerate(locations):
-            efficiency = next((r["avgEfficiency"] for r in results 
-                             if r["_id"]["time"] == time and r["_id"]["location"] == location), 0)
-            data.append([i, j, round(efficiency or 0, 2)])
+    cells = index_cells(
+        results,
+        key=lambda r: (r["_id"]["time"], r["_id"]["location"]),
+        value=lambda r: round(r["avgEfficiency"] or 0, 2)
+    )
+    data = heatmap_triples(cells, times, locations)
     
     return {
         "data": data,
@@ -353,7 +354,8 @@ def get_efficiency_heatmap(
     }
 
 @router.get("/downtime-analysis")
-def get_downtime_analysis(
+@cached(ttl=300, collections=("timerdailystats",))
+async def get_downtime_analysis(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None),
@@ -383,7 +385,7 @@ def get_downtime_analysis(
         {"$sort": {"totalDowntime": -1}}
     ]
     
-    results = list(db.timerdailystats.aggregate(pipeline))
+    results = await aggregate(db.timerdailystats, pipeline)
     
     if chart_type == "pie":
         return {
@@ -414,7 +416,8 @@ def get_downtime_analysis(
     }
 
 @router.get("/performance-kpis")
-def get_performance_kpis(
+@cached(ttl=300, collections=("timerdailystats",))
+async def get_performance_kpis(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     location_id: Optional[str] = Query(None)
@@ -447,7 +450,7 @@ def get_performance_kpis(
         }}
     ]
     
-    result = list(db.timerdailystats.aggregate(pipeline))
+    result = await aggregate(db.timerdailystats, pipeline)
     
     if not result:
         return {
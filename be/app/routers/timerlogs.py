@@ -3,29 +3,43 @@ from __future__ import annotations
 from fastapi import APIRouter, Query
 from datetime import datetime, timedelta
 from typing import Optional, List, Dict, Any
-from app.db import get_db
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
+from app.cache import cached
+from app.hll import HLL, unique_counts
+from app.pagination import (
+    CursorError, Page, bad_cursor, decode_cursor, encode_cursor, fingerprint, keyset_match, sort_keys,
+)
+from app.pivot import index_cells, series_by_column
+from app.rollups import HOURLY, ROLLUP_KEYS, avg_of, rollup_available, rollup_match
+from app.streaming import iter_aggregate, ndjson_response, wants_ndjson
 
-router = APIRouter(prefix="/timerlogs", tags=["Timer Logs"])
+router = APIRouter(prefix="/timerlogs", tags=["Timer Logs"], route_class=FastJSONRoute)
 
 @router.get("/line-chart")
-def get_timer_logs_line_chart(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_line_chart(
     start_date: Optional[str] = Query(None, description="Start date (YYYY-MM-DD)"),
     end_date: Optional[str] = Query(None, description="End date (YYYY-MM-DD)"),
     location_id: Optional[str] = Query(None, description="Location ID filter"),
     machine_class_id: Optional[str] = Query(None, description="Machine Class ID filter"),
     stop_reason: Optional[str] = Query(None, description="Stop reason filter"),
     group_by: str = Query("hour", description="Group by: hour, day, week, month"),
-    limit: int = Query(1000, description="Maximum number of records")
+    limit: int = Query(1000, description="Maximum number of records"),
+    approx: bool = Query(False, description="Count unique timers from HyperLogLog sketches")
 ):
     """Get timer logs data for line chart visualization"""
     db = get_db()
     
     # Build query
     query = {}
+    dt_from = dt_to = None
     if start_date and end_date:
+        dt_from = datetime.fromisoformat(start_date)
+        dt_to = datetime.fromisoformat(end_date)
         query["createdAt"] = {
-            "$gte": datetime.fromisoformat(start_date),
-            "$lte": datetime.fromisoformat(end_date)
+            "$gte": dt_from,
+            "$lte": dt_to
         }
     if location_id:
         query["locationId"] = location_id
@@ -36,26 +50,52 @@ def get_timer_logs_line_chart(
     
     # Aggregation pipeline
     group_format = {
-        "hour": {"$dateToString": {"format": "%Y-%m-%d %H:00", "date": "$createdAt"}},
-        "day": {"$dateToString": {"format": "%Y-%m-%d", "date": "$createdAt"}},
-        "week": {"$dateToString": {"format": "%Y-W%U", "date": "$createdAt"}},
-        "month": {"$dateToString": {"format": "%Y-%m", "date": "$createdAt"}}
+        "hour": "%Y-%m-%d %H:00",
+        "day": "%Y-%m-%d",
+        "week": "%Y-W%U",
+        "month": "%Y-%m"
     }
     
-    pipeline = [
-        {"$match": query},
-        {"$group": {
-            "_id": group_format[group_by],
-            "count": {"$sum": 1},
-            "totalDuration": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
-            "avgDuration": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
-            "uniqueTimers": {"$addToSet": "$timerId"}
-        }},
-        {"$sort": {"_id": 1}},
-        {"$limit": limit}
-    ]
-    
-    results = list(db.timerlogs.aggregate(pipeline))
+    rollup_query = None
+    if not machine_class_id:
+        rollup_query = await rollup_match(db, dt_from, dt_to, locationId=location_id, stopReason=stop_reason)
+    
+    # The sketches are per location only, so other filters need the exact sets
+    unique_timers = None
+    if approx and not machine_class_id and not stop_reason and await rollup_available(db, HLL):
+        counts = await unique_counts(db, dt_from, dt_to, location_id, bucket=group_format[group_by])
+        unique_timers = {k: c["timers"] for k, c in counts.items()}
+    timer_set = {} if unique_timers is not None else {"uniqueTimers": {"$addToSet": "$timerId"}}
+    
+    if rollup_query is not None:
+        pipeline = [
+            {"$match": rollup_query},
+            {"$group": {
+                "_id": {"$dateToString": {"format": group_format[group_by], "date": "$h"}},
+                "count": {"$sum": "$count"},
+                "totalDuration": {"$sum": "$durSum"},
+                "durCount": {"$sum": "$durCount"},
+                **timer_set
+            }},
+            {"$addFields": {"avgDuration": avg_of("totalDuration", "durCount")}},
+            {"$sort": {"_id": 1}},
+            {"$limit": limit}
+        ]
+        results = await aggregate(db[HOURLY], pipeline)
+    else:
+        pipeline = [
+            {"$match": query},
+            {"$group": {
+                "_id": {"$dateToString": {"format": group_format[group_by], "date": "$createdAt"}},
+                "count": {"$sum": 1},
+                "totalDuration": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
+                "avgDuration": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
+                **timer_set
+            }},
+            {"$sort": {"_id": 1}},
+            {"$limit": limit}
+        ]
+        results = await aggregate(db.timerlogs, pipeline)
     
     # Format for ECharts
     return {
@@ -74,13 +114,18 @@ def get_timer_logs_line_chart(
             {
                 "name": "Unique Timers",
                 "type": "line",
-                "data": [len(r["uniqueTimers"]) for r in results]
+                "data": [
+                    unique_timers.get(r["_id"], 0) if unique_timers is not None else len(r["uniqueTimers"])
+                    for r in results
+                ]
             }
-        ]
+        ],
+        "approx": unique_timers is not None
     }
 
 @router.get("/stacked-area")
-def get_timer_logs_stacked_area(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_stacked_area(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     group_by: str = Query("day", description="Group by: hour, day, week"),
@@ -115,18 +160,14 @@ def get_timer_logs_stacked_area(
         {"$sort": {"_id.date": 1, "_id.category": 1}}
     ]
     
-    results = list(db.timerlogs.aggregate(pipeline))
+    results = await aggregate(db.timerlogs, pipeline)
     
     # Organize data for stacked chart
     dates = sorted(list(set([r["_id"]["date"] for r in results])))
     categories = sorted(list(set([r["_id"]["category"] for r in results if r["_id"]["category"]])))
     
-    series_data = {}
-    for category in categories:
-        series_data[category] = []
-        for date in dates:
-            count = next((r["count"] for r in results if r["_id"]["date"] == date and r["_id"]["category"] == category), 0)
-            series_data[category].append(count)
+    cells = index_cells(results, key=lambda r: (r["_id"]["date"], r["_id"]["category"]), value=lambda r: r["count"])
+    series_data = series_by_column(cells, dates, categories)
     
     return {
         "xAxis": dates,
@@ -142,7 +183,8 @@ def get_timer_logs_stacked_area(
     }
 
 @router.get("/bar-chart")
-def get_timer_logs_bar_chart(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_bar_chart(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     group_by: str = Query("stopReason", description="Group by: stopReason, locationId, machineClassId, operator"),
@@ -152,26 +194,48 @@ def get_timer_logs_bar_chart(
     db = get_db()
     
     query = {}
+    dt_from = dt_to = None
     if start_date and end_date:
+        dt_from = datetime.fromisoformat(start_date)
+        dt_to = datetime.fromisoformat(end_date)
         query["createdAt"] = {
-            "$gte": datetime.fromisoformat(start_date),
-            "$lte": datetime.fromisoformat(end_date)
+            "$gte": dt_from,
+            "$lte": dt_to
         }
     
-    pipeline = [
-        {"$match": query},
-        {"$group": {
-            "_id": f"${group_by}",
-            "count": {"$sum": 1},
-            "totalDuration": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
-            "avgDuration": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
-            "uniqueTimers": {"$addToSet": "$timerId"}
-        }},
-        {"$sort": {"count": -1}},
-        {"$limit": top_n}
-    ]
-    
-    results = list(db.timerlogs.aggregate(pipeline))
+    rollup_query = None
+    if group_by in ROLLUP_KEYS:
+        rollup_query = await rollup_match(db, dt_from, dt_to)
+    
+    if rollup_query is not None:
+        pipeline = [
+            {"$match": rollup_query},
+            {"$group": {
+                "_id": f"${group_by}",
+                "count": {"$sum": "$count"},
+                "totalDuration": {"$sum": "$durSum"},
+                "durCount": {"$sum": "$durCount"},
+                "uniqueTimers": {"$addToSet": "$timerId"}
+            }},
+            {"$addFields": {"avgDuration": avg_of("totalDuration", "durCount")}},
+            {"$sort": {"count": -1}},
+            {"$limit": top_n}
+        ]
+        results = await aggregate(db[HOURLY], pipeline)
+    else:
+        pipeline = [
+            {"$match": query},
+            {"$group": {
+                "_id": f"${group_by}",
+                "count": {"$sum": 1},
+                "totalDuration": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
+                "avgDuration": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
+                "uniqueTimers": {"$addToSet": "$timerId"}
+            }},
+            {"$sort": {"count": -1}},
+            {"$limit": top_n}
+        ]
+        results = await aggregate(db.timerlogs, pipeline)
     
     return {
         "xAxis": [r["_id"] or "Unknown" for r in results],
@@ -195,7 +259,8 @@ def get_timer_logs_bar_chart(
     }
 
 @router.get("/heatmap")
-def get_timer_logs_heatmap(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_heatmap(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     x_axis: str = Query("hour", description="X-axis: hour, dayOfWeek, day"),
@@ -205,30 +270,49 @@ def get_timer_logs_heatmap(
     db = get_db()
     
     query = {}
+    dt_from = dt_to = None
     if start_date and end_date:
+        dt_from = datetime.fromisoformat(start_date)
+        dt_to = datetime.fromisoformat(end_date)
         query["createdAt"] = {
-            "$gte": datetime.fromisoformat(start_date),
-            "$lte": datetime.fromisoformat(end_date)
+            "$gte": dt_from,
+            "$lte": dt_to
         }
     
     x_axis_formats = {
-        "hour": {"$hour": "$createdAt"},
-        "dayOfWeek": {"$dayOfWeek": "$createdAt"},
-        "day": {"$dayOfMonth": "$createdAt"}
+        "hour": "$hour",
+        "dayOfWeek": "$dayOfWeek",
+        "day": "$dayOfMonth"
     }
     
-    pipeline = [
-        {"$match": query},
-        {"$group": {
-            "_id": {
-                "x": x_axis_formats[x_axis],
-                "y": f"${y_axis}"
-            },
-            "count": {"$sum": 1}
-        }}
-    ]
-    
-    results = list(db.timerlogs.aggregate(pipeline))
+    rollup_query = None
+    if y_axis in ROLLUP_KEYS:
+        rollup_query = await rollup_match(db, dt_from, dt_to)
+    
+    if rollup_query is not None:
+        pipeline = [
+            {"$match": rollup_query},
+            {"$group": {
+                "_id": {
+                    "x": {x_axis_formats[x_axis]: "$h"},
+                    "y": f"${y_axis}"
+                },
+                "count": {"$sum": "$count"}
+            }}
+        ]
+        results = await aggregate(db[HOURLY], pipeline)
+    else:
+        pipeline = [
+            {"$match": query},
+            {"$group": {
+                "_id": {
+                    "x": {x_axis_formats[x_axis]: "$createdAt"},
+                    "y": f"${y_axis}"
+                },
+                "count": {"$sum": 1}
+            }}
+        ]
+        results = await aggregate(db.timerlogs, pipeline)
     
     # Format for ECharts heatmap
     data = []
@@ -243,15 +327,18 @@ def get_timer_logs_heatmap(
     }
 
 @router.get("/scatter")
-def get_timer_logs_scatter(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_scatter(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     x_field: str = Query("createdAt", description="X-axis field"),
     y_field: str = Query("duration", description="Y-axis field"),
     color_by: Optional[str] = Query("stopReason", description="Color by field"),
-    limit: int = Query(1000)
+    limit: int = Query(1000, ge=1),
+    cursor: Optional[str] = Query(None, description="nextCursor of the previous page"),
+    format: Optional[str] = Query(None, description="json (default) or ndjson to stream one point per line")
 ):
-    """Get timer logs data for scatter plot"""
+    """Get timer logs data for scatter plot, one page at a time in (createdAt, _id) order"""
     db = get_db()
     
     query = {}
@@ -261,36 +348,75 @@ def get_timer_logs_scatter(
             "$lte": datetime.fromisoformat(end_date)
         }
     
+    fp = fingerprint(start_date=start_date, end_date=end_date)
+    try:
+        position = decode_cursor(cursor, fp) if cursor else None
+        if position and position[0] != "timerlogs":
+            raise CursorError("cursor is not a valid continuation token")
+    except CursorError as e:
+        return bad_cursor(e)
+    
     pipeline = [
-        {"$match": query},
+        {"$match": keyset_match(query, "createdAt", position[1:] if position else None)},
+        {"$sort": dict(sort_keys("createdAt"))},
+        # One extra row tells whether there is a next page
+        {"$limit": limit + 1},
         {"$addFields": {
             "duration": {"$subtract": ["$endedAt", "$createdAt"]}
         }},
-        {"$limit": limit}
+        # Only the plotted fields (and the page key) leave the server
+        {"$project": {"_id": 1, "createdAt": 1, **{f: 1 for f in (x_field, y_field, color_by) if f}}}
     ]
     
-    results = list(db.timerlogs.aggregate(pipeline))
+    page = Page()
     
-    # Format for scatter plot
-    data = []
-    for r in results:
+    def to_point(r):
         x_val = r.get(x_field)
         y_val = r.get(y_field)
-        if x_val is not None and y_val is not None:
-            point = [x_val, y_val]
-            if color_by and r.get(color_by):
-                point.append(r[color_by])
-            data.append(point)
+        if x_val is None or y_val is None:
+            return None
+        point = [x_val, y_val]
+        if color_by and r.get(color_by):
+            point.append(r[color_by])
+        return point
+    
+    if wants_ndjson(format):
+        async def points():
+            read = 0
+            last = None
+            async for r in iter_aggregate(db.timerlogs, pipeline):
+                if read == limit:
+                    page.next_cursor = encode_cursor("timerlogs", last["createdAt"], last["_id"], fp)
+                    break
+                read += 1
+                last = r
+                point = to_point(r)
+                if point is not None:
+                    yield point
+        
+        # The next-page token is the last line
+        return ndjson_response(page.with_trailer(points()))
+    
+    results = await aggregate(db.timerlogs, pipeline)
+    if len(results) > limit:
+        last = results[limit - 1]
+        page.next_cursor = encode_cursor("timerlogs", last["createdAt"], last["_id"], fp)
+        results = results[:limit]
+    
+    # Format for scatter plot
+    data = [p for p in map(to_point, results) if p is not None]
     
     return {
         "data": data,
         "xField": x_field,
         "yField": y_field,
-        "colorBy": color_by
+        "colorBy": color_by,
+        "nextCursor": page.next_cursor
     }
 
 @router.get("/pie-chart")
-def get_timer_logs_pie_chart(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_pie_chart(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     group_by: str = Query("stopReason", description="Group by field"),
@@ -316,7 +442,7 @@ def get_timer_logs_pie_chart(
         {"$limit": top_n}
     ]
     
-    results = list(db.timerlogs.aggregate(pipeline))
+    results = await aggregate(db.timerlogs, pipeline)
     
     return {
         "data": [
@@ -329,7 +455,8 @@ def get_timer_logs_pie_chart(
     }
 
 @router.get("/gauge")
-def get_timer_logs_gauge(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_gauge(
     start_date: Optional[str] = Query(None),
     end_date: Optional[str] = Query(None),
     metric: str = Query("efficiency", description="Metric to show: efficiency, utilization, avgDuration")
@@ -355,7 +482,7 @@ def get_timer_logs_gauge(
         }}
     ]
     
-    result = list(db.timerlogs.aggregate(pipeline))
+    result = await aggregate(db.timerlogs, pipeline)
     
     if not result:
         return {"value": 0, "max": 100}
@@ -375,28 +502,40 @@ def get_timer_logs_gauge(
         return {"value": round(value, 2), "max": 480, "unit": "min"}  # Max 8 hours
 
 @router.get("/stats")
-def get_timer_logs_stats(
+@cached(ttl=60, collections=("timerlogs",))
+async def get_timer_logs_stats(
     start_date: Optional[str] = Query(None),
-    end_date: Optional[str] = Query(None)
+    end_date: Optional[str] = Query(None),
+    approx: bool = Query(False, description="Count unique values from HyperLogLog sketches")
 ):
     """Get overall timer logs statistics"""
     db = get_db()
     
     query = {}
+    dt_from = dt_to = None
     if start_date and end_date:
+        dt_from = datetime.fromisoformat(start_date)
+        dt_to = datetime.fromisoformat(end_date)
         query["createdAt"] = {
-            "$gte": datetime.fromisoformat(start_date),
-            "$lte": datetime.fromisoformat(end_date)
+            "$gte": dt_from,
+            "$lte": dt_to
         }
     
+    unique = None
+    if approx and await rollup_available(db, HLL):
+        unique = (await unique_counts(db, dt_from, dt_to)).get(None, {"timers": 0, "locations": 0, "machines": 0})
+    sets = {} if unique is not None else {
+        "uniqueTimers": {"$addToSet": "$timerId"},
+        "uniqueLocations": {"$addToSet": "$locationId"},
+        "uniqueMachines": {"$addToSet": "$machineId"},
+    }
+    
     pipeline = [
         {"$match": query},
         {"$group": {
             "_id": None,
             "totalLogs": {"$sum": 1},
-            "uniqueTimers": {"$addToSet": "$timerId"},
-            "uniqueLocations": {"$addToSet": "$locationId"},
-            "uniqueMachines": {"$addToSet": "$machineId"},
+            **sets,
             "avgDuration": {"$avg": {"$subtract": ["$endedAt", "$createdAt"]}},
             "maxDuration": {"$max": {"$subtract": ["$endedAt", "$createdAt"]}},
             "minDuration": {"$min": {"$subtract": ["$endedAt", "$createdAt"]}},
@@ -404,7 +543,7 @@ def get_timer_logs_stats(
         }}
     ]
     
-    result = list(db.timerlogs.aggregate(pipeline))
+    result = await aggregate(db.timerlogs, pipeline)
     
     if not result:
         return {
@@ -419,13 +558,21 @@ def get_timer_logs_stats(
         }
     
     data = result[0]
+    approx_used = unique is not None
+    if unique is None:
+        unique = {
+            "timers": len(data["uniqueTimers"]),
+            "locations": len(data["uniqueLocations"]),
+            "machines": len(data["uniqueMachines"]),
+        }
     return {
         "totalLogs": data["totalLogs"],
-        "uniqueTimers": len(data["uniqueTimers"]),
-        "uniqueLocations": len(data["uniqueLocations"]),
-        "uniqueMachines": len(data["uniqueMachines"]),
+        "uniqueTimers": unique["timers"],
+        "uniqueLocations": unique["locations"],
+        "uniqueMachines": unique["machines"],
         "avgDuration": data["avgDuration"] or 0,
         "maxDuration": data["maxDuration"] or 0,
         "minDuration": data["minDuration"] or 0,
-        "totalDuration": data["totalDuration"] or 0
+        "totalDuration": data["totalDuration"] or 0,
+        "approx": approx_used
     }
@@ -5,9 +5,10 @@ from typing import Optional
 
 from fastapi import APIRouter, Query
 
-from app.db import get_db
+from app.db import get_db, aggregate
+from app.responses import FastJSONRoute
 
-router = APIRouter(prefix="/v1/utilization", tags=["utilization"])
+router = APIRouter(prefix="/v1/utilization", tags=["utilization"], route_class=FastJSONRoute)
 
 
 def _parse_dt(s: Optional[str]) -> Optional[datetime]:
@@ -20,7 +21,7 @@ def _parse_dt(s: Optional[str]) -> Optional[datetime]:
 
 
 @router.get("/daily")
-def utilization_daily(
+async def utilization_daily(
     location_id: Optional[str] = Query(None),
     from_ts: Optional[str] = Query(None),
     to_ts: Optional[str] = Query(None),
@@ -78,7 +79,7 @@ def utilization_daily(
     ]
 
     try:
-        agg = list(db["timerlogs"].aggregate(pipeline))
+        agg = await aggregate(db["timerlogs"], pipeline)
     except Exception as e:
         # Return empty result if aggregation fails
         agg = []
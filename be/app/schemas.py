@@ -39,4 +39,5 @@ class CycleTimeItem(BaseModel):
 
 class CycleTimesResponse(BaseModel):
     items: List[CycleTimeItem]
+    nextCursor: Optional[str] = None
 
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict
+
+
+class SingleFlight:
+    """Share one in-flight execution between concurrent callers of the same key.
+
+    The shared work runs in its own task, so a caller that gets cancelled
+    (client disconnect) does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _done(self, key: str, task: asyncio.Future) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # mark as retrieved even when every waiter went away
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], label: str = "default") -> Any:
+        stats = self.stats.setdefault(label, {"calls": 0, "executions": 0, "coalesced": 0})
+        stats["calls"] += 1
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t, key=key: self._done(key, t))
+            stats["executions"] += 1
+        else:
+            stats["coalesced"] += 1
+        return await asyncio.shield(task)
+
+    def snapshot(self) -> Dict[str, Any]:
+        calls = sum(s["calls"] for s in self.stats.values())
+        coalesced = sum(s["coalesced"] for s in self.stats.values())
+        return {
+            "enabled": singleflight_enabled(),
+            "inFlight": len(self._inflight),
+            "calls": calls,
+            "executions": sum(s["executions"] for s in self.stats.values()),
+            "coalesced": coalesced,
+            "coalescedRatio": round(coalesced / calls, 4) if calls else 0,
+            "operations": self.stats,
+        }
+
+
+group = SingleFlight()
+
+
+def singleflight_enabled() -> bool:
+    return os.getenv("SINGLEFLIGHT_ENABLED", "1").lower() not in ("0", "false", "no")
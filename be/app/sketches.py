@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import asyncio
+import math
+import os
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+from app.db import aggregate
+from app.rebuild import bucket_ranges, rebuild, touched
+from app.rollups import DURATION_MS, HOUR_OF_CREATED_AT, ROLLUP_KEYS, mark_refreshed
+from app.watermarks import changed_logs, get_state, set_watermark
+
+SKETCH = "timerlogs_hourly_sketch"
+
+# Sketched values: cycle seconds as recorded, and endedAt - createdAt in seconds
+SKETCH_FIELDS = {
+    "cycle": "$cycle",
+    "durationSec": {"$divide": [DURATION_MS, 1000]},
+}
+
+# Quantiles are within 1% of the true value. Stored bucket keys depend on it,
+# so changing it requires dropping SKETCH and its etl_state entry.
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+_LN_GAMMA = math.log(GAMMA)
+
+_lock = asyncio.Lock()
+
+
+def _lag_seconds() -> float:
+    return float(os.getenv("ROLLUP_LAG_SECONDS", "5"))
+
+
+def _batch_hours() -> int:
+    return int(os.getenv("ROLLUP_BATCH_HOURS", "168"))
+
+
+def bucket_key(x: Any) -> Dict[str, Any]:
+    """DDSketch bucket of a positive value: ``ceil(log_gamma(x))``; null for
+    zero and negative values, which are counted in a bucket of their own."""
+    return {"$cond": [
+        {"$gt": [x, 0]},
+        {"$ceil": {"$divide": [{"$ln": x}, _LN_GAMMA]}},
+        None,
+    ]}
+
+
+def bucket_value(k: Optional[int]) -> float:
+    """Representative value of bucket ``k``, within ``RELATIVE_ACCURACY`` of
+    anything in ``(gamma^(k-1), gamma^k]``."""
+    if k is None:
+        return 0.0
+    return 2 * GAMMA ** k / (GAMMA + 1)
+
+
+def sketch_pipeline(hours: List[datetime], built_at: datetime) -> List[Dict[str, Any]]:
+    """Recompute whole hours of ``SKETCH``: timerlogs counted per (hour, rollup keys, field, bucket)."""
+    return [
+        {"$match": {"$or": bucket_ranges(hours, timedelta(hours=1))}},
+        {"$project": {
+            "_id": 0,
+            "h": HOUR_OF_CREATED_AT,
+            **{k: 1 for k in ROLLUP_KEYS},
+            "v": [{"f": f, "x": expr} for f, expr in SKETCH_FIELDS.items()],
+        }},
+        {"$unwind": "$v"},
+        {"$match": {"v.x": {"$type": "number"}}},
+        {"$group": {
+            "_id": {"h": "$h", **{k: f"${k}" for k in ROLLUP_KEYS}, "f": "$v.f", "k": bucket_key("$v.x")},
+            "n": {"$sum": 1},
+        }},
+        {"$addFields": {
+            "h": "$_id.h",
+            **{k: f"$_id.{k}" for k in ROLLUP_KEYS},
+            "f": "$_id.f",
+            "k": "$_id.k",
+            "builtAt": {"$literal": built_at},
+        }},
+        {"$merge": {"into": SKETCH, "on": "_id", "whenMatched": "replace", "whenNotMatched": "insert"}},
+    ]
+
+
+async def rebuild_hours(db: AsyncIOMotorDatabase, hours: List[datetime]) -> int:
+    """Recompute ``hours`` of ``SKETCH`` now (e.g. for logs a watcher saw change)."""
+    async with _lock:
+        return await rebuild(db, SKETCH, sorted(hours), "h", sketch_pipeline, _batch_hours())
+
+
+async def refresh_hourly_sketch(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    """Recompute the hours of ``SKETCH`` that received or closed timerlogs since
+    the last run (own ``_id`` and ``endedAt`` watermarks), so durations of
+    logs closed after insert are counted."""
+    async with _lock:
+        filters, high, closed_high = changed_logs(await get_state(db, SKETCH), _lag_seconds())
+        hours = await touched(db, filters, HOUR_OF_CREATED_AT)
+        await rebuild(db, SKETCH, hours, "h", sketch_pipeline, _batch_hours())
+        await set_watermark(db, SKETCH, high, closedWatermark=closed_high)
+        mark_refreshed(SKETCH)
+        return {"watermark": str(high), "hours": len(hours)}
+
+
+async def ensure_sketch_indexes(db: AsyncIOMotorDatabase) -> None:
+    await db[SKETCH].create_index([("f", 1), ("h", 1), ("locationId", 1)])
+    await db[SKETCH].create_index([("h", 1)])
+
+
+def merge_pipeline(match: Dict[str, Any], group_id: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Merge the matched hourly sketches per ``group_id`` (plus field and bucket):
+    the result has one row per non-empty bucket, not per log."""
+    return [
+        {"$match": match},
+        {"$group": {"_id": {**group_id, "f": "$f", "k": "$k"}, "n": {"$sum": "$n"}}},
+    ]
+
+
+def quantiles(buckets: Iterable[Tuple[Optional[int], int]], qs: Sequence[float]) -> List[Optional[float]]:
+    """Values at ranks ``qs`` (0..1) of a merged sketch given as (bucket, count) pairs."""
+    ordered = sorted(buckets, key=lambda b: -math.inf if b[0] is None else b[0])
+    total = sum(n for _, n in ordered)
+    if not total:
+        return [None for _ in qs]
+    out = []
+    for q in qs:
+        rank = q * (total - 1)
+        seen = 0
+        for k, n in ordered:
+            seen += n
+            if seen > rank:
+                out.append(bucket_value(k))
+                break
+    return out
+
+
+def histogram(buckets: Iterable[Tuple[Optional[int], int]], n_bins: int) -> List[Dict[str, Any]]:
+    """Equal-count bins like ``$bucketAuto``: each sketch bucket goes to the bin
+    its first rank falls in, so bins never split a bucket."""
+    ordered = sorted(buckets, key=lambda b: -math.inf if b[0] is None else b[0])
+    total = sum(n for _, n in ordered)
+    bins: List[Dict[str, Any]] = []
+    seen = 0
+    for k, n in ordered:
+        i = min(seen * n_bins // total, n_bins - 1) if total else 0
+        low = 0.0 if k is None else GAMMA ** (k - 1)
+        high = 0.0 if k is None else GAMMA ** k
+        if bins and bins[-1]["_bin"] == i:
+            bins[-1]["max"] = high
+            bins[-1]["count"] += n
+        else:
+            bins.append({"_bin": i, "min": low, "max": high, "count": n})
+        seen += n
+    return [{"min": b["min"], "max": b["max"], "count": b["count"]} for b in bins]
+
+
+async def load_histogram(db: AsyncIOMotorDatabase, field: str, n_bins: int) -> List[Dict[str, Any]]:
+    rows = await aggregate(db[SKETCH], merge_pipeline({"f": field}, {}))
+    return histogram(((r["_id"].get("k"), r["n"]) for r in rows), n_bins)
+
+
+async def _main():
+    from app.db import get_db, close_db
+
+    db = get_db()
+    await ensure_sketch_indexes(db)
+    print(await refresh_hourly_sketch(db))
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import os
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from fastapi.responses import StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorCollection
+
+from app.responses import dumps
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def stream_batch_size() -> int:
+    """Documents per getMore round trip for streamed cursors."""
+    return int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+
+def _chunk_bytes() -> int:
+    return int(os.getenv("STREAM_CHUNK_BYTES", "65536"))
+
+
+def wants_ndjson(format: Optional[str]) -> bool:
+    return (format or "").lower() == "ndjson"
+
+
+def dumps_line(row: Any) -> bytes:
+    return dumps(row) + b"\n"
+
+
+def iter_aggregate(coll: AsyncIOMotorCollection, pipeline: List[Dict[str, Any]], **options: Any) -> AsyncIterator[Dict[str, Any]]:
+    """Async cursor over an aggregation, fetched ``stream_batch_size()`` docs at a time.
+
+    Unlike ``app.db.aggregate`` this is not coalesced and never materializes
+    the full result.
+    """
+    return coll.aggregate(pipeline, batchSize=stream_batch_size(), allowDiskUse=True, **options)
+
+
+async def _encode(rows: AsyncIterator[Any], transform: Optional[Callable[[Any], Any]]) -> AsyncIterator[bytes]:
+    limit = _chunk_bytes()
+    buf: List[bytes] = []
+    size = 0
+    async for row in rows:
+        if transform is not None:
+            row = transform(row)
+            if row is None:
+                continue
+        line = dumps_line(row)
+        buf.append(line)
+        size += len(line)
+        if size >= limit:
+            yield b"".join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b"".join(buf)
+
+
+def ndjson_response(
+    rows: AsyncIterator[Any],
+    transform: Optional[Callable[[Any], Any]] = None,
+) -> StreamingResponse:
+    """Stream ``rows`` as newline-delimited JSON.
+
+    Lines are written in chunks of about ``STREAM_CHUNK_BYTES`` as the
+    cursor yields them; ``transform`` maps each row and may drop it by
+    returning None.
+    """
+    return StreamingResponse(_encode(rows, transform), media_type=NDJSON_MEDIA_TYPE)
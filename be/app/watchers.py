@@ -0,0 +1,236 @@
+from __future__ import annotations
+
+import asyncio
+import inspect
+import logging
+import os
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo.errors import OperationFailure, PyMongoError
+
+from app import background, dailystats, hll, rollups, sketches
+from app.cache import invalidate
+from app.watermarks import get_watermark, id_upper_bound, set_watermark
+
+logger = logging.getLogger(__name__)
+
+WATCHED = ("timerlogs", "counts", "machines")
+
+# $changeStream on a standalone server / resume token no longer in the oplog
+_NOT_REPLICA_SET = (40573,)
+_HISTORY_LOST = (260, 280, 286)
+
+Event = Dict[str, Any]
+_listeners: Dict[str, List[Callable[[Event], Any]]] = {}
+
+# (collection, locationId, day) changes waiting for the next flush
+_pending: Set[Tuple[str, Optional[str], Optional[datetime]]] = set()
+# timerlogs changes the rollups have not been refreshed for yet, and the hours they fall in
+_rollup_pending: Set[Tuple[str, Optional[str], Optional[datetime]]] = set()
+_rollup_hours: Set[datetime] = set()
+_rollup_due: Optional[float] = None
+
+stats: Dict[str, Dict[str, Any]] = {c: {"mode": None, "events": 0, "lastEventAt": None, "error": None} for c in WATCHED}
+
+
+def watchers_enabled() -> bool:
+    return os.getenv("WATCHERS_ENABLED", "1").lower() not in ("0", "false", "no")
+
+
+def _poll_seconds() -> float:
+    return float(os.getenv("WATCH_POLL_SECONDS", "2"))
+
+
+def _poll_batch() -> int:
+    return int(os.getenv("WATCH_POLL_BATCH", "1000"))
+
+
+def _flush_seconds() -> float:
+    return float(os.getenv("WATCH_FLUSH_SECONDS", "1"))
+
+
+def _rollup_debounce() -> float:
+    return float(os.getenv("WATCH_ROLLUP_DEBOUNCE_SECONDS", "10"))
+
+
+def _token_every() -> int:
+    return int(os.getenv("WATCH_TOKEN_SAVE_EVERY", "100"))
+
+
+def subscribe(collection: str, fn: Callable[[Event], Any]) -> None:
+    """Call ``fn(event)`` (sync or async) for every change to ``collection``.
+
+    Events are ``{"collection", "op", "id", "doc"}``; ``doc`` is the full
+    document after the change, or None for deletes.
+    """
+    _listeners.setdefault(collection, []).append(fn)
+
+
+def _created(doc: Optional[Dict[str, Any]], _id: Any) -> Optional[datetime]:
+    created = (doc or {}).get("createdAt")
+    if not isinstance(created, datetime):
+        created = getattr(_id, "generation_time", None)
+        if created is None:
+            return None
+    if created.tzinfo:
+        created = created.astimezone(timezone.utc).replace(tzinfo=None)
+    return created
+
+
+def _day(doc: Optional[Dict[str, Any]], _id: Any) -> Optional[datetime]:
+    created = _created(doc, _id)
+    return created.replace(hour=0, minute=0, second=0, microsecond=0) if created else None
+
+
+async def _handle(collection: str, op: str, _id: Any, doc: Optional[Dict[str, Any]]) -> None:
+    event = {"collection": collection, "op": op, "id": _id, "doc": doc}
+    s = stats[collection]
+    s["events"] += 1
+    s["lastEventAt"] = datetime.now(timezone.utc).isoformat()
+
+    for fn in _listeners.get(collection, ()):
+        try:
+            result = fn(event)
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.warning("watch listener on %s failed: %s", collection, e)
+
+    # Deletes carry no document: invalidate the whole collection
+    location = doc.get("locationId") if doc else None
+    change = (collection, str(location) if location is not None else None, _day(doc, _id) if doc else None)
+    _pending.add(change)
+    if collection == "timerlogs":
+        created = _created(doc, _id) if doc else None
+        _schedule_rollup(change, created.replace(minute=0, second=0, microsecond=0) if created else None)
+
+
+def _schedule_rollup(change: Tuple[str, Optional[str], Optional[datetime]], hour: Optional[datetime]) -> None:
+    global _rollup_due
+    _rollup_pending.add(change)
+    if hour is not None:
+        _rollup_hours.add(hour)
+    if _rollup_due is None:
+        _rollup_due = time.monotonic() + _rollup_debounce()
+
+
+async def _watch_stream(db: AsyncIOMotorDatabase, collection: str) -> None:
+    name = f"watch:{collection}"
+    token = await get_watermark(db, name)
+    unsaved = 0
+    async with db[collection].watch(full_document="updateLookup", resume_after=token) as stream:
+        stats[collection]["mode"] = "changeStream"
+        async for change in stream:
+            op = change["operationType"]
+            if op in ("insert", "update", "replace", "delete"):
+                await _handle(collection, op, change["documentKey"]["_id"], change.get("fullDocument"))
+            unsaved += 1
+            if unsaved >= _token_every():
+                await set_watermark(db, name, stream.resume_token)
+                unsaved = 0
+        if unsaved:
+            await set_watermark(db, name, stream.resume_token)
+
+
+async def _poll(db: AsyncIOMotorDatabase, collection: str) -> None:
+    """Fallback for servers without change streams: new ``_id``s only, so
+    updates and deletes are picked up by TTL expiry instead."""
+    name = f"poll:{collection}"
+    watermark = await get_watermark(db, name) or id_upper_bound(0)
+    stats[collection]["mode"] = "poll"
+    batch = _poll_batch()
+    while True:
+        docs = await db[collection].find({"_id": {"$gt": watermark}}).sort("_id", 1).limit(batch).to_list(None)
+        for doc in docs:
+            await _handle(collection, "insert", doc["_id"], doc)
+        if docs:
+            watermark = docs[-1]["_id"]
+            await set_watermark(db, name, watermark)
+        if len(docs) < batch:
+            await asyncio.sleep(_poll_seconds())
+
+
+async def watch(db: AsyncIOMotorDatabase, collection: str) -> None:
+    """Follow ``collection`` until cancelled.
+
+    Uses a change stream resumed from the persisted token (or from now on
+    the first run) and falls back to ``_id`` polling when the server is not
+    a replica set. Transient errors are retried.
+    """
+    while True:
+        try:
+            await _watch_stream(db, collection)
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            if e.code in _NOT_REPLICA_SET:
+                logger.info("change streams unavailable for %s, polling instead", collection)
+                await _poll(db, collection)
+                return
+            if e.code in _HISTORY_LOST:
+                # Resume point fell off the oplog: start over from now; TTLs cover the gap
+                logger.warning("resume token for %s expired, restarting the change stream", collection)
+                await set_watermark(db, f"watch:{collection}", None)
+                await invalidate([(collection, None, None)])
+                continue
+            stats[collection]["error"] = str(e)
+            logger.warning("watching %s failed: %s", collection, e)
+        except PyMongoError as e:
+            stats[collection]["error"] = str(e)
+            logger.warning("watching %s failed: %s", collection, e)
+        await asyncio.sleep(_poll_seconds())
+
+
+async def flush(db: AsyncIOMotorDatabase) -> Dict[str, Any]:
+    """Invalidate the cache entries touched since the last flush and, once the
+    debounce period after the first timerlog change is over, recompute the
+    rollup hours (and daily stats days) those changes fall in.
+
+    Inserts and updates, such as a log being closed, carry the document and
+    so its hour; deletes do not and are left to the TTLs and to rebuilds.
+    The periodic watermark refreshes still run for anything not seen here.
+    """
+    global _rollup_due
+    result: Dict[str, Any] = {}
+    if _pending:
+        changes = list(_pending)
+        _pending.clear()
+        result["invalidated"] = await invalidate(changes)
+    if _rollup_due is not None and time.monotonic() >= _rollup_due:
+        changes = list(_rollup_pending)
+        hours = sorted(_rollup_hours)
+        _rollup_pending.clear()
+        _rollup_hours.clear()
+        _rollup_due = None
+        result["rollupHours"] = await rollups.rebuild_hours(db, hours)
+        result["sketchHours"] = await sketches.rebuild_hours(db, hours)
+        result["hll"] = await hll.refresh_hll(db)
+        if dailystats.refresh_interval() > 0:
+            days = {h.replace(hour=0) for h in hours}
+            result["dailystats"] = await dailystats.refresh_daily_stats(db, days=days)
+        # Entries recomputed from the rollup before it caught up
+        result["invalidated"] = result.get("invalidated", 0) + await invalidate(changes)
+    return result
+
+
+def start(db: AsyncIOMotorDatabase) -> None:
+    if not watchers_enabled():
+        return
+    for collection in WATCHED:
+        background.start(f"watch:{collection}", watch(db, collection))
+    background.start_periodic("watch-flush", _flush_seconds(), lambda: flush(db))
+
+
+def snapshot() -> Dict[str, Any]:
+    return {
+        "enabled": watchers_enabled(),
+        "collections": stats,
+        "pending": len(_pending),
+        "rollupPending": len(_rollup_pending),
+        "rollupHours": len(_rollup_hours),
+        "lastFlush": background.last_runs.get("watch-flush"),
+        "listeners": {c: len(fns) for c, fns in _listeners.items()},
+    }
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorDatabase
+
+STATE_COLLECTION = "etl_state"
+
+
+async def get_state(db: AsyncIOMotorDatabase, name: str) -> Optional[Dict[str, Any]]:
+    return await db[STATE_COLLECTION].find_one({"_id": name})
+
+
+async def get_watermark(db: AsyncIOMotorDatabase, name: str) -> Optional[Any]:
+    state = await get_state(db, name)
+    return state.get("watermark") if state else None
+
+
+async def set_watermark(db: AsyncIOMotorDatabase, name: str, value: Any, **extra: Any) -> None:
+    await db[STATE_COLLECTION].update_one(
+        {"_id": name},
+        {"$set": {"watermark": value, "refreshedAt": datetime.now(timezone.utc), **extra}},
+        upsert=True,
+    )
+
+
+def id_upper_bound(lag_seconds: float) -> ObjectId:
+    """Smallest ObjectId for ``now - lag``: a half-open ``_id`` range ending here
+    leaves room for writers whose ids land slightly out of order."""
+    return ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=lag_seconds))
+
+
+def id_range(low: Optional[ObjectId], high: ObjectId) -> Dict[str, Any]:
+    bounds: Dict[str, Any] = {"$lt": high}
+    if low is not None:
+        bounds["$gte"] = low
+    return {"_id": bounds}
+
+
+def changed_logs(
+    state: Optional[Dict[str, Any]], lag_seconds: float
+) -> Tuple[List[Dict[str, Any]], ObjectId, datetime]:
+    """Timerlogs filters for logs inserted (``_id``) or closed (``endedAt``)
+    since the marks in ``state``, and the (``watermark``, ``closedWatermark``)
+    to store once they are processed.
+
+    Logs are inserted open and closed later, so a view holding durations has
+    to revisit the log when ``endedAt`` is set. Closures written more than
+    the lag after their ``endedAt`` are only seen by the watchers or by an
+    explicit rebuild.
+    """
+    state = state or {}
+    low, high = state.get("watermark"), id_upper_bound(lag_seconds)
+    closed_low = state.get("closedWatermark")
+    closed_high = datetime.utcnow() - timedelta(seconds=lag_seconds)
+    filters: List[Dict[str, Any]] = []
+    if low is None or low < high:
+        filters.append(id_range(low, high))
+    # On the first run the _id range already covers every log
+    if low is not None and (closed_low is None or closed_low < closed_high):
+        ended: Dict[str, Any] = {"$lt": closed_high}
+        if closed_low is not None:
+            ended["$gte"] = closed_low
+        filters.append({"endedAt": ended})
+    return filters, high, closed_high
@@ -0,0 +1,92 @@
+"""JSON encode benchmark: serialize_doc + jsonable_encoder + json.dumps vs FastJSONResponse.
+
+Payloads mimic the chart responses (raw aggregation rows with ObjectId
+and datetime values, plus dense numeric series). The old path is what a
+dict returned from an endpoint went through before ``FastJSONRoute``.
+
+    python -m benchmarks.bench_json
+    python -m benchmarks.bench_json --rows 100000 --runs 5
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from fastapi.encoders import jsonable_encoder
+
+from app.responses import FastJSONResponse
+
+
+def serialize_doc(doc):
+    """The per-router converter the response class replaced."""
+    if isinstance(doc, dict):
+        return {k: serialize_doc(v) for k, v in doc.items()}
+    elif isinstance(doc, list):
+        return [serialize_doc(item) for item in doc]
+    elif isinstance(doc, ObjectId):
+        return str(doc)
+    elif isinstance(doc, datetime):
+        return doc.isoformat()
+    else:
+        return doc
+
+
+def make_payload(rows: int):
+    start = datetime(2024, 1, 1)
+    locations = [ObjectId() for _ in range(8)]
+    raw = [
+        {
+            "_id": {"date": (start + timedelta(hours=i % 720)).strftime("%Y-%m-%d %H:00"), "location": random.choice(locations)},
+            "machineId": ObjectId(),
+            "createdAt": start + timedelta(seconds=i * 37),
+            "count": random.randint(0, 500),
+            "avgCycle": random.uniform(10, 900),
+        }
+        for i in range(rows)
+    ]
+    series = [{"name": f"M{m}", "data": [round(random.uniform(0, 100), 2) for _ in range(rows // 20)]} for m in range(20)]
+    return {"title": "bench", "raw": raw, "series": series}
+
+
+def old_encode(payload):
+    content = jsonable_encoder(serialize_doc(payload))
+    # starlette.responses.JSONResponse.render
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def new_encode(payload):
+    return FastJSONResponse(payload).body
+
+
+def _best_of(runs: int, fn, payload):
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        out = fn(payload)
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    random.seed(3)
+
+    payload = make_payload(args.rows)
+    old_s, old_out = _best_of(args.runs, old_encode, payload)
+    new_s, new_out = _best_of(args.runs, new_encode, payload)
+    assert json.loads(old_out) == json.loads(new_out), "encoded payloads differ"
+    print(f"rows={args.rows} bytes={len(new_out)}")
+    print(f"serialize_doc + jsonable_encoder + json : {old_s:.4f}s")
+    print(f"FastJSONResponse                        : {new_s:.4f}s")
+    print(f"speedup                                 : {old_s / new_s:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Machine analytics benchmark: per-machine $lookup vs one $group + in-memory join.
+
+Seeds a throwaway database (``BENCH_MONGODB_DB``, default ``apms_bench``;
+``MONGODB_DB`` is ignored) with 500 machines and their timerlogs, then times the previous correlated-$lookup pipeline
+against ``/machines/utilization-chart`` as implemented now. Needs a
+reachable MongoDB at ``MONGODB_URI``.
+
+    python -m benchmarks.bench_machines
+    python -m benchmarks.bench_machines --machines 500 --logs-per-machine 400 --runs 5
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+# Seeding drops collections: never follow MONGODB_DB from the environment or .env
+os.environ["MONGODB_DB"] = os.getenv("BENCH_MONGODB_DB", "apms_bench")
+os.environ["CACHE_ENABLED"] = "0"
+os.environ["SINGLEFLIGHT_ENABLED"] = "0"
+
+from app.db import get_db, close_db  # noqa: E402
+from app.routers.machines import get_machine_utilization_chart  # noqa: E402
+
+REASONS = ["Unit Created"] * 6 + ["Idle", "Jam", "Maintenance", "Changeover"]
+WINDOW_START = datetime(2024, 1, 1)
+WINDOW_END = datetime(2024, 1, 31)
+
+
+async def seed(db, machines: int, logs_per_machine: int):
+    if not db.name.endswith("_bench"):
+        raise SystemExit(f"refusing to drop collections in {db.name!r}: the bench database name must end in _bench")
+    await db.machines.drop()
+    await db.timerlogs.drop()
+    docs = [
+        {"name": f"Machine {i:03d}", "locationId": f"L{i % 8}", "machineClassId": f"C{i % 5}", "status": "active"}
+        for i in range(machines)
+    ]
+    ids = (await db.machines.insert_many(docs)).inserted_ids
+    batch = []
+    for mid in ids:
+        for _ in range(logs_per_machine):
+            created = WINDOW_START + timedelta(minutes=random.randint(0, 60 * 24 * 45))
+            batch.append({
+                "machineId": mid,
+                "locationId": "L0",
+                "timerId": f"T{random.randint(0, 50)}",
+                "stopReason": random.choice(REASONS),
+                "createdAt": created,
+                "endedAt": created + timedelta(seconds=random.randint(20, 900)),
+            })
+            if len(batch) >= 10000:
+                await db.timerlogs.insert_many(batch)
+                batch = []
+    if batch:
+        await db.timerlogs.insert_many(batch)
+    await db.timerlogs.create_index([("machineId", 1), ("createdAt", 1)])
+    await db.timerlogs.create_index([("createdAt", 1)])
+
+
+def lookup_pipeline():
+    """The utilization pipeline as it was before batching."""
+    return [
+        {"$lookup": {
+            "from": "timerlogs",
+            "let": {"machineId": "$_id"},
+            "pipeline": [
+                {"$match": {
+                    "$expr": {"$eq": ["$machineId", "$$machineId"]},
+                    "createdAt": {"$gte": WINDOW_START, "$lte": WINDOW_END},
+                }},
+                {"$group": {
+                    "_id": None,
+                    "totalRuntime": {"$sum": {"$subtract": ["$endedAt", "$createdAt"]}},
+                    "logCount": {"$sum": 1},
+                    "productiveTime": {"$sum": {"$cond": [
+                        {"$eq": ["$stopReason", "Unit Created"]},
+                        {"$subtract": ["$endedAt", "$createdAt"]},
+                        0,
+                    ]}},
+                }},
+            ],
+            "as": "utilization",
+        }},
+        {"$sort": {"_id": 1}},
+    ]
+
+
+async def _best_of(runs: int, fn):
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        await fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--machines", type=int, default=500)
+    parser.add_argument("--logs-per-machine", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--no-seed", action="store_true")
+    args = parser.parse_args()
+
+    db = get_db()
+    if not args.no_seed:
+        random.seed(11)
+        await seed(db, args.machines, args.logs_per_machine)
+
+    async def old():
+        await db.machines.aggregate(lookup_pipeline()).to_list(None)
+
+    async def new():
+        await get_machine_utilization_chart(
+            start_date=WINDOW_START.isoformat(),
+            end_date=WINDOW_END.isoformat(),
+            location_id=None,
+            machine_class_id=None,
+            chart_type="bar",
+        )
+
+    old_s = await _best_of(args.runs, old)
+    new_s = await _best_of(args.runs, new)
+    n_logs = await db.timerlogs.estimated_document_count()
+    print(f"machines={args.machines} timerlogs={n_logs} database={db.name}")
+    print(f"per-machine $lookup : {old_s:.3f}s")
+    print(f"$group + join       : {new_s:.3f}s")
+    print(f"speedup             : {old_s / new_s:.1f}x")
+    close_db()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,85 @@
+"""Wire format benchmark: JSON vs gzip-JSON vs MessagePack (plain and typed arrays).
+
+Payloads mimic ``/machines/availability-timeline`` (one series per
+machine x every hour) and ``/timerdailystats/efficiency-heatmap``
+(``[x, y, value]`` triples). Reports encoded size and best-of-N encode
+time, including compression where it applies.
+
+    python -m benchmarks.bench_msgpack
+    python -m benchmarks.bench_msgpack --machines 200 --hours 720 --runs 5
+"""
+from __future__ import annotations
+
+import argparse
+import gzip
+import random
+import time
+from datetime import datetime, timedelta
+
+from app.pivot import heatmap_triples, index_cells, series_by_column
+from app.responses import dumps, packb
+
+
+def availability_timeline(machines: int, hours: int):
+    start = datetime(2024, 1, 1)
+    times = [(start + timedelta(hours=h)).strftime("%Y-%m-%d %H:00") for h in range(hours)]
+    names = [f"Machine {m:03d}" for m in range(machines)]
+    rows = [(t, n, round(random.uniform(0, 100), 2)) for t in times for n in names if random.random() < 0.8]
+    series = series_by_column(index_cells(rows, key=lambda r: (r[0], r[1]), value=lambda r: r[2]), times, names)
+    return {
+        "xAxis": times,
+        "series": [{"name": n, "type": "line", "data": data} for n, data in series.items()],
+    }
+
+
+def efficiency_heatmap(locations: int, days: int):
+    start = datetime(2024, 1, 1)
+    dates = [(start + timedelta(days=d)).strftime("%Y-%m-%d") for d in range(days)]
+    locs = [f"L{i}" for i in range(locations)]
+    cells = {(d, l): round(random.uniform(40, 100), 1) for d in dates for l in locs}
+    return {"xAxis": dates, "yAxis": locs, "data": heatmap_triples(cells, dates, locs)}
+
+
+ENCODINGS = {
+    "json": lambda p: dumps(p),
+    "json+gzip": lambda p: gzip.compress(dumps(p), 6),
+    "msgpack": lambda p: packb(p),
+    "msgpack typed": lambda p: packb(p, typed_arrays=True),
+    "msgpack typed+gzip": lambda p: gzip.compress(packb(p, typed_arrays=True), 6),
+}
+
+
+def _best_of(runs: int, fn, payload):
+    best = float("inf")
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        out = fn(payload)
+        best = min(best, time.perf_counter() - t0)
+    return best, len(out)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--machines", type=int, default=100)
+    parser.add_argument("--hours", type=int, default=720)
+    parser.add_argument("--locations", type=int, default=20)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+    random.seed(5)
+
+    payloads = {
+        f"availability-timeline {args.machines}x{args.hours}": availability_timeline(args.machines, args.hours),
+        f"efficiency-heatmap {args.locations}x{args.days}": efficiency_heatmap(args.locations, args.days),
+    }
+    for label, payload in payloads.items():
+        print(label)
+        base = None
+        for name, encode in ENCODINGS.items():
+            seconds, size = _best_of(args.runs, encode, payload)
+            base = base or size
+            print(f"  {name:<20} {size:>10} bytes {size / base:>6.0%} {seconds * 1000:>9.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""Pivot benchmark: next()-scan per cell vs app.pivot single-pass indexing.
+
+Rows mimic the availability-timeline aggregation output (one row per
+machine x hour). The old approach is skipped once its projected runtime
+exceeds ``--budget`` seconds; the projection scales the largest measured
+run by the cells x rows ratio.
+
+    python -m benchmarks.bench_pivot
+    python -m benchmarks.bench_pivot --sizes 200x720 --budget 120
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from app.pivot import index_cells, series_by_column
+
+
+def make_rows(machines: int, hours: int, fill_ratio: float = 0.8):
+    start = datetime(2024, 1, 1)
+    times = [(start + timedelta(hours=h)).strftime("%Y-%m-%d %H:00") for h in range(hours)]
+    rows = []
+    for m in range(machines):
+        for t in times:
+            if random.random() < fill_ratio:
+                rows.append({"_id": {"time": t, "machine": f"M{m:04d}"}, "availability": random.uniform(0, 100)})
+    random.shuffle(rows)
+    return rows
+
+
+def old_pivot(results):
+    machines = sorted(list(set([r["_id"]["machine"] for r in results if r["_id"]["machine"]])))
+    times = sorted(list(set([r["_id"]["time"] for r in results])))
+    series_data = {}
+    for machine in machines:
+        series_data[machine] = []
+        for t in times:
+            availability = next((r["availability"] for r in results
+                                 if r["_id"]["time"] == t and r["_id"]["machine"] == machine), 0)
+            series_data[machine].append(round(availability, 2))
+    return series_data
+
+
+def new_pivot(results):
+    machines = sorted(list(set([r["_id"]["machine"] for r in results if r["_id"]["machine"]])))
+    times = sorted(list(set([r["_id"]["time"] for r in results])))
+    cells = index_cells(
+        results,
+        key=lambda r: (r["_id"]["time"], r["_id"]["machine"]),
+        value=lambda r: round(r["availability"], 2),
+    )
+    return series_by_column(cells, times, machines)
+
+
+def _timed(fn, rows):
+    t0 = time.perf_counter()
+    out = fn(rows)
+    return time.perf_counter() - t0, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10x24,25x72,50x168,200x720", help="machines x hours list")
+    parser.add_argument("--budget", type=float, default=20.0, help="max projected seconds for the old approach")
+    args = parser.parse_args()
+    random.seed(7)
+
+    ref = None  # (seconds, work) of the largest old run actually measured
+    print(f"{'machines x hours':>18} {'rows':>8} {'old (s)':>12} {'new (s)':>10} {'speedup':>10}")
+    for size in args.sizes.split(","):
+        machines, hours = (int(x) for x in size.lower().split("x"))
+        rows = make_rows(machines, hours)
+        work = machines * hours * len(rows)
+        new_s, new_out = _timed(new_pivot, rows)
+
+        projected = ref[0] * work / ref[1] if ref else 0.0
+        if projected <= args.budget:
+            old_s, old_out = _timed(old_pivot, rows)
+            assert old_out == new_out, "pivot results differ"
+            ref = (old_s, work)
+            old_label = f"{old_s:.4f}"
+        else:
+            old_s = projected
+            old_label = f"~{projected:.1f}*"
+        print(f"{size:>18} {len(rows):>8} {old_label:>12} {new_s:>10.4f} {old_s / new_s:>9.0f}x")
+    print("* projected from the largest measured run")
+
+
+if __name__ == "__main__":
+    main()
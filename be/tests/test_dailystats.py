@@ -0,0 +1,82 @@
+"""Daily stats against a live MongoDB (``MONGODB_URI``, default the dev
+server); skipped when none is reachable. Each test works in a throwaway
+database that is dropped afterwards.
+
+    python -m pytest tests
+"""
+from __future__ import annotations
+
+import asyncio
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+motor_asyncio = pytest.importorskip("motor.motor_asyncio")
+
+from app.dailystats import DAILY, rebuild_days  # noqa: E402
+
+DAY = datetime(2024, 1, 2)
+
+
+def _log(location_id: str, timer_id: str, minute: int) -> dict:
+    start = DAY + timedelta(hours=8, minutes=minute)
+    return {
+        "locationId": location_id,
+        "timerId": timer_id,
+        "stopReason": "Unit Created",
+        "createdAt": start,
+        "endedAt": start + timedelta(seconds=30),
+    }
+
+
+async def _with_db(test) -> None:
+    uri = os.getenv("MONGODB_URI", "mongodb://localhost:27018")
+    client = motor_asyncio.AsyncIOMotorClient(uri, serverSelectionTimeoutMS=1000)
+    try:
+        await client.admin.command("ping")
+    except Exception as e:
+        client.close()
+        pytest.skip(f"no MongoDB at {uri}: {e}")
+    db = client[f"test_dailystats_{uuid.uuid4().hex[:8]}"]
+    try:
+        await test(db)
+    finally:
+        await client.drop_database(db.name)
+        client.close()
+
+
+def test_imported_row_is_the_only_row_of_its_key():
+    async def test(db):
+        await db[DAILY].insert_one({"date": DAY, "locationId": "L1", "timerId": "T1", "totalProduced": 5})
+        await db.timerlogs.insert_many([_log("L1", "T1", m) for m in range(3)] + [_log("L1", "T2", m) for m in range(2)])
+
+        await rebuild_days(db, [DAY])
+
+        rows = await db[DAILY].find({"date": {"$gte": DAY, "$lt": DAY + timedelta(days=1)}}).to_list(None)
+        by_key = {}
+        for r in rows:
+            by_key.setdefault((r["locationId"], r["timerId"]), []).append(r)
+        assert len(by_key[("L1", "T1")]) == 1
+        assert "builtFrom" not in by_key[("L1", "T1")][0]
+        assert [r["builtFrom"] for r in by_key[("L1", "T2")]] == ["timerlogs"]
+        assert sum(r["totalProduced"] for r in rows) == 5 + 2
+
+    asyncio.run(_with_db(test))
+
+
+def test_rebuild_drops_built_row_once_an_import_covers_it():
+    async def test(db):
+        await db.timerlogs.insert_many([_log("L1", "T1", m) for m in range(3)])
+        await rebuild_days(db, [DAY])
+        assert await db[DAILY].count_documents({"builtFrom": "timerlogs"}) == 1
+
+        await db[DAILY].insert_one({"date": DAY, "locationId": "L1", "timerId": "T1", "totalProduced": 5})
+        await rebuild_days(db, [DAY])
+
+        rows = await db[DAILY].find({}).to_list(None)
+        assert [r["totalProduced"] for r in rows] == [5]
+        assert "builtFrom" not in rows[0]
+
+    asyncio.run(_with_db(test))
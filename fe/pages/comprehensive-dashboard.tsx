@@ -346,6 +346,29 @@ const ChartComponent = ({ title, data, type = 'line', style = {} }: {
   );
 };
 
+// Backend chart key -> chart type used by this page
+const CHART_TYPES: { [key: string]: string } = {
+  basicLine: 'basicLine',
+  smoothedLine: 'smoothedLine',
+  basicArea: 'basicArea',
+  stackedArea: 'stackedArea',
+  scatter: 'basicScatter',
+  calendarHeatmap: 'calendarHeatmap',
+  multiGauge: 'multiGauge',
+  radar: 'performanceRadar',
+  funnel: 'conversionFunnel',
+  tree: 'treeHierarchy',
+  sankey: 'sankeyFlow',
+  overview: 'overview',
+};
+
+interface ComprehensiveResponse {
+  charts: { [key: string]: ChartData | DashboardData | null };
+  meta: { [key: string]: { status: 'ok' | 'error' | 'timeout'; latencyMs: number; error?: string } };
+  status: 'success' | 'partial';
+  chartCount: number;
+}
+
 export default function ComprehensiveDashboard() {
   const [dashboardData, setDashboardData] = useState<DashboardData | null>(null);
   const [charts, setCharts] = useState<{ [key: string]: ChartData }>({});
@@ -363,36 +386,19 @@ export default function ComprehensiveDashboard() {
         const healthCheck = await getJSON<{ ok: boolean }>('/health');
         console.log('Health check result:', healthCheck);
 
-        // Load dashboard overview
-        console.log('Loading dashboard overview...');
-        const overview = await getJSON<DashboardData>('/simple-dashboard/overview');
-        console.log('Dashboard overview:', overview);
-        setDashboardData(overview);
-
-        // Load chart data in parallel
-        const chartPromises = [
-          getJSON<ChartData>('/advanced-charts/line-charts/basic').then(data => ({ type: 'basicLine', data })),
-          getJSON<ChartData>('/advanced-charts/line-charts/smoothed').then(data => ({ type: 'smoothedLine', data })),
-          getJSON<ChartData>('/advanced-charts/area-charts/basic').then(data => ({ type: 'basicArea', data })),
-          getJSON<ChartData>('/advanced-charts/area-charts/stacked').then(data => ({ type: 'stackedArea', data })),
-          getJSON<ChartData>('/advanced-charts/scatter-charts/basic').then(data => ({ type: 'basicScatter', data })),
-          getJSON<ChartData>('/advanced-charts/heatmap-charts/calendar').then(data => ({ type: 'calendarHeatmap', data })),
-          getJSON<ChartData>('/advanced-charts/gauge-charts/multi').then(data => ({ type: 'multiGauge', data })),
-          getJSON<ChartData>('/advanced-charts/radar-charts/performance').then(data => ({ type: 'performanceRadar', data })),
-          getJSON<ChartData>('/advanced-charts/funnel-charts/conversion').then(data => ({ type: 'conversionFunnel', data })),
-          getJSON<ChartData>('/advanced-charts/tree-charts/hierarchy').then(data => ({ type: 'treeHierarchy', data })),
-          getJSON<ChartData>('/advanced-charts/sankey-charts/flow').then(data => ({ type: 'sankeyFlow', data })),
-          getJSON<ChartData>('/simple-dashboard/overview').then(data => ({ type: 'overview', data }))
-        ];
-
-        const chartResults = await Promise.allSettled(chartPromises);
-        const newCharts: { [key: string]: ChartData } = {};
+        // Load the overview and every chart in one request; the backend fans out in parallel
+        console.log('Loading dashboard data...');
+        const keys = Object.keys(CHART_TYPES).join(',');
+        const result = await getJSON<ComprehensiveResponse>(`/advanced-charts/dashboard/comprehensive?charts=${keys}`);
+        console.log('Comprehensive dashboard:', result.status, result.meta);
+        setDashboardData((result.charts.overview as DashboardData) ?? null);
 
-        chartResults.forEach((result, index) => {
-          if (result.status === 'fulfilled') {
-            newCharts[result.value.type] = result.value.data;
+        const newCharts: { [key: string]: ChartData } = {};
+        Object.entries(result.charts).forEach(([key, data]) => {
+          if (data) {
+            newCharts[CHART_TYPES[key] ?? key] = data as ChartData;
           } else {
-            console.error(`Chart ${index} failed:`, result.reason);
+            console.error(`Chart ${key} failed:`, result.meta[key]);
           }
         });
 